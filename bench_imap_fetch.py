@@ -0,0 +1,231 @@
+"""
+Benchmark de descarga de notificaciones: un FETCH por correo vs FETCH por
+lotes, y sincronización incremental por UID frente a revisar todo el período.
+También informa los bytes enviados por el servidor frente al tamaño RFC822
+completo de los correos (solo se descarga la parte de texto).
+
+Levanta un servidor IMAP local mínimo (solo los comandos que usa EmailReader)
+que agrega una latencia fija por comando para simular el viaje de ida y
+vuelta a Gmail.
+
+Uso:
+    python bench_imap_fetch.py
+    python bench_imap_fetch.py --messages 500 --latency-ms 40 --batch-sizes 1,25,100 --new 10
+"""
+import argparse
+import contextlib
+import email
+import imaplib
+import io
+import random
+import re
+import socketserver
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from utils.email_reader import FETCH_BATCH_SIZE, EmailReader
+
+SENDER = "notificaciones@notificacionesbcp.com.pe"
+
+# Los UID no coinciden con los números de secuencia, como en un buzón real
+UID_OFFSET = 1000
+UID_VALIDITY = 1
+
+
+def build_mailbox(count: int) -> list[bytes]:
+    """Notificaciones sintéticas del BCP (texto plano, alternativa HTML y logo adjunto)"""
+    logo = random.Random(0).randbytes(15000)
+    messages = []
+    start = datetime.now() - timedelta(days=89)
+    for i in range(count):
+        fecha = start + timedelta(hours=i * 89 * 24 // max(count, 1))
+        texto = (
+            "Estimado cliente:\n"
+            f"Se realizó una compra con tu tarjeta terminada en 1234 el {fecha:%d/%m/%Y}.\n"
+            f"Monto: S/ {10 + i % 90}.{i % 100:02d} en <b>COMERCIO {i % 40}</b>\n"
+            "Gracias por tu preferencia.\n"
+        )
+        msg = EmailMessage()
+        msg['From'] = SENDER
+        msg['To'] = "cliente@gmail.com"
+        msg['Subject'] = "Realizaste un consumo con tu Tarjeta de Crédito BCP"
+        msg['Date'] = fecha.strftime("%a, %d %b %Y %H:%M:%S -0500")
+        msg.set_content(texto)
+        msg.add_alternative(f"<html><body><p>{texto.replace(chr(10), '<br>')}</p></body></html>", subtype='html')
+        msg.add_attachment(logo, maintype='image', subtype='png', filename='logo.png')
+        messages.append(msg.as_bytes())
+    return messages
+
+
+def parse_message_set(value: str, first: int, last: int) -> list[int]:
+    """'1:3,7,9:*' -> [1, 2, 3, 7, 9, ..., last], limitado a [first, last]"""
+    nums = []
+    for part in value.split(','):
+        a, _, b = part.partition(':')
+        a = last if a == '*' else int(a)
+        b = a if not b else (last if b == '*' else int(b))
+        nums.extend(range(min(a, b), max(a, b) + 1))
+    return [num for num in nums if first <= num <= last]
+
+
+def bodystructure(part) -> bytes:
+    """BODYSTRUCTURE (sin datos de extensión) de un mensaje o parte"""
+    if part.is_multipart():
+        children = b"".join(bodystructure(child) for child in part.get_payload())
+        return b'(%s "%s")' % (children, part.get_content_subtype().upper().encode())
+    params = b" ".join(b'"%s" "%s"' % (key.upper().encode(), value.encode()) for key, value in part.get_params()[1:])
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper().encode()
+    return b'("%s" "%s" %s NIL NIL "%s" %d)' % (
+        part.get_content_maintype().upper().encode(), part.get_content_subtype().upper().encode(),
+        b"(%s)" % params if params else b"NIL", encoding, len(part.get_payload().encode())
+    )
+
+
+def section_payload(message, section: str) -> bytes:
+    """Contenido sin decodificar de la parte indicada ('1', '1.2', ...)"""
+    part = message
+    for number in section.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part.get_payload().encode()
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """Atiende un subconjunto de IMAP4rev1 sobre un buzón en memoria"""
+
+    # Sin Nagle, para que la única espera por comando sea la latencia simulada
+    disable_nagle_algorithm = True
+
+    def write(self, data: bytes):
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+
+    def send(self, line: bytes):
+        self.write(line + b"\r\n")
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send(b"* OK [CAPABILITY IMAP4rev1] Fake IMAP listo")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *rest = line.rstrip(b"\r\n").split(b" ", 2)
+            args = rest[0] if rest else b""
+            command = command.upper()
+            if command == b"UID":
+                command, _, args = args.partition(b" ")
+                command = b"UID " + command.upper()
+            time.sleep(self.server.latency)
+            first_uid, last_uid = UID_OFFSET + 1, UID_OFFSET + len(mailbox)
+
+            if command == b"CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1")
+            elif command == b"SELECT":
+                self.send(b"* %d EXISTS" % len(mailbox))
+                self.send(b"* OK [UIDVALIDITY %d] UIDs validos" % UID_VALIDITY)
+                self.send(b"* OK [UIDNEXT %d] Proximo UID" % (last_uid + 1))
+                self.send(tag + b" OK [READ-WRITE] SELECT completado")
+                continue
+            elif command == b"UID SEARCH":
+                # Todos los correos son del remitente; solo se respeta el criterio UID
+                match = re.search(rb"UID (\S+)", args)
+                uids = parse_message_set(match.group(1).decode(), first_uid, last_uid) if match else \
+                    range(first_uid, last_uid + 1)
+                self.send(b"* SEARCH " + b" ".join(b"%d" % uid for uid in uids))
+            elif command == b"UID FETCH":
+                uid_set, _, items = args.partition(b" ")
+                section = re.search(rb"BODY\.PEEK\[([\d.]+)\]", items)
+                for uid in parse_message_set(uid_set.decode(), first_uid, last_uid):
+                    num, raw = uid - UID_OFFSET, mailbox[uid - UID_OFFSET - 1]
+                    if b"BODYSTRUCTURE" in items:
+                        structure = bodystructure(email.message_from_bytes(raw))
+                        self.send(b"* %d FETCH (UID %d BODYSTRUCTURE %s)" % (num, uid, structure))
+                    elif section:
+                        body = section_payload(email.message_from_bytes(raw), section.group(1).decode())
+                        self.write(b"* %d FETCH (UID %d BODY[%s] {%d}\r\n" % (
+                            num, uid, section.group(1), len(body)) + body + b")\r\n")
+                    else:
+                        self.write(b"* %d FETCH (UID %d RFC822 {%d}\r\n" % (num, uid, len(raw)) + raw + b")\r\n")
+            elif command == b"LOGOUT":
+                self.send(b"* BYE Hasta luego")
+                self.send(tag + b" OK LOGOUT completado")
+                return
+            self.send(tag + b" OK " + command + b" completado")
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: list[bytes], latency: float):
+        super().__init__(("127.0.0.1", 0), FakeImapHandler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.bytes_sent = 0
+
+
+class LocalEmailReader(EmailReader):
+    """EmailReader que se conecta sin TLS al servidor local"""
+
+    def __init__(self, port: int, batch_size: int):
+        super().__init__("cliente@gmail.com", "secreto", batch_size=batch_size)
+        self.port = port
+
+    def connect(self):
+        self.imap = imaplib.IMAP4("127.0.0.1", self.port)
+        self.imap.login(self.email_user, self.email_password)
+        return True
+
+
+def run(server: FakeImapServer, batch_size: int, uid_validity: int = None,
+        last_uid: int = None) -> tuple[float, int, int, int]:
+    """
+    Sincroniza 90 días (o desde la marca dada); retorna segundos,
+    transacciones, nueva marca y bytes enviados por el servidor
+    """
+    server.bytes_sent = 0
+    reader = LocalEmailReader(server.server_address[1], batch_size)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        transactions = reader.fetch_notifications(
+            days_back=90, bank='BCP', uid_validity=uid_validity, last_uid=last_uid
+        )
+    return time.perf_counter() - start, len(transactions), reader.last_uid, server.bytes_sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=300, help="Correos en el buzón")
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="Latencia por comando IMAP")
+    parser.add_argument("--batch-sizes", default="1,10,50,200", help="Tamaños de lote separados por coma")
+    parser.add_argument("--new", type=int, default=5, help="Correos nuevos para la sincronización incremental")
+    args = parser.parse_args()
+
+    server = FakeImapServer(build_mailbox(args.messages), args.latency_ms / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    full_size = sum(len(raw) for raw in server.mailbox) / 1e6
+    print(f"{args.messages} correos ({full_size:.1f} MB en RFC822), latencia {args.latency_ms:.0f} ms por comando")
+    print(f"{'lote':>6} {'segundos':>10} {'correos/s':>10} {'MB':>8} {'transacciones':>14}")
+    try:
+        for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+            elapsed, found, mark, sent = run(server, batch_size)
+            print(f"{batch_size:>6} {elapsed:>10.2f} {args.messages / elapsed:>10.0f} {sent / 1e6:>8.2f} {found:>14}")
+
+        # Llegan correos nuevos: sincronizar desde la marca vs revisar todo de nuevo
+        server.mailbox.extend(build_mailbox(args.new))
+        full, found_full, _, _ = run(server, FETCH_BATCH_SIZE)
+        incremental, found_new, _, _ = run(server, FETCH_BATCH_SIZE, UID_VALIDITY, mark)
+        print(f"\nCon {args.new} correos nuevos (lote {FETCH_BATCH_SIZE}):")
+        print(f"  todo el período: {full:.2f} s, {found_full} transacciones")
+        print(f"  incremental por UID: {incremental:.2f} s, {found_new} transacciones")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Benchmark de carga de transacciones: ruta ORM anterior vs carga columnar.
+
+Uso:
+    DATABASE_URL=sqlite:////tmp/bench.db python bench_load_transactions.py
+    python bench_load_transactions.py --sizes 10000,100000
+"""
+import argparse
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault("DATABASE_URL", "sqlite:////tmp/gastosync_bench.db")
+
+from utils.database import SessionLocal, Transaction, engine, init_db
+from utils.data_manager import TRANSACTION_CACHE, ensure_data_exists, load_transactions, save_transactions_bulk
+
+# Usuarios reservados para el benchmark (uno por tamaño)
+BENCH_USER_OFFSET = 900000
+
+
+def load_transactions_orm(user_id: int):
+    """Ruta anterior: objetos ORM -> dicts -> DataFrame"""
+    ensure_data_exists(user_id)
+    db = SessionLocal()
+    try:
+        transactions = db.query(Transaction).filter(Transaction.user_id == user_id).all()
+        data = [{
+            'fecha': t.fecha,
+            'monto': t.monto,
+            'descripcion': t.descripcion,
+            'categoria': t.categoria,
+            'tipo': t.tipo,
+            'moneda': t.moneda
+        } for t in transactions]
+        return pd.DataFrame(data)
+    finally:
+        db.close()
+
+
+def seed(user_id: int, size: int):
+    """Genera transacciones sintéticas para un usuario si aún no existen"""
+    db = SessionLocal()
+    try:
+        existing = db.query(Transaction).filter(Transaction.user_id == user_id).count()
+    finally:
+        db.close()
+    if existing >= size:
+        return
+
+    rng = np.random.default_rng(size)
+    start = datetime(2020, 1, 1)
+    chunk = 100000
+    for offset in range(existing, size, chunk):
+        n = min(chunk, size - offset)
+        df = pd.DataFrame({
+            'fecha': [start + timedelta(minutes=int(m)) for m in rng.integers(0, 60 * 24 * 365 * 5, n)],
+            'monto': rng.uniform(1, 500, n).round(2),
+            'descripcion': [f"COMERCIO {offset + i}" for i in range(n)],
+            'categoria': rng.choice(['Casa', 'Transporte', 'Alimentación', 'Salud', 'Entretenimiento'], n),
+            'moneda': rng.choice(['PEN', 'USD'], n, p=[0.9, 0.1]),
+            'banco': 'BCP'
+        })
+        save_transactions_bulk(df, user_id=user_id)
+
+
+def timed(func, user_id: int, repeat: int):
+    best = None
+    for _ in range(repeat):
+        # Medir la consulta, no la caché de transacciones
+        TRANSACTION_CACHE.bump(user_id)
+        start = time.perf_counter()
+        df = func(user_id)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df.memory_usage(deep=True).sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine.echo = False
+    init_db()
+
+    results = []
+    for size in [int(s) for s in args.sizes.split(",")]:
+        user_id = BENCH_USER_OFFSET + size
+        seed(user_id, size)
+        orm_time, orm_bytes = timed(load_transactions_orm, user_id, args.repeat)
+        col_time, col_bytes = timed(load_transactions, user_id, args.repeat)
+        results.append({
+            'filas': size,
+            'orm_s': round(orm_time, 3),
+            'columnar_s': round(col_time, 3),
+            'aceleración': round(orm_time / col_time, 2),
+            'orm_MB': round(orm_bytes / 1e6, 1),
+            'columnar_MB': round(col_bytes / 1e6, 1),
+        })
+
+    print("\n=== Resultados ===")
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
@@ -7,18 +8,26 @@ import io
 from utils.email_parser import parse_email_content
 from utils.email_reader import EmailReader
 from utils.data_manager import (
-    load_transactions, save_transaction, load_categories,
-    save_categories, load_categories_with_budget,
+    load_transactions, save_transaction,
+    save_categories,
     update_category_budget, get_budget_history,
-    update_category_notes, is_duplicate_transaction
+    update_category_notes,
+    partition_duplicate_transactions, save_transactions_bulk,
+    get_transaction_years, load_budget_matrix,
+    update_transaction, delete_transactions, load_transactions_page,
+    diff_transactions, new_transaction_rows, apply_transaction_changes, apply_changes_to_frame,
+    rename_category, frame_memory_bytes, record_session_memory, get_session_memory_metrics,
+    TRANSACTION_CACHE
 )
+from utils.aggregations import get_spending_summary, get_category_totals, get_monthly_category_totals, get_merchant_totals
+from utils.fx import BASE_CURRENCY, REPORTING_CURRENCY, available_currencies, convert_amounts, currency_symbol
 from utils.auth import register_user, validate_login
 import os
-from utils.database import init_db
+from utils.database import init_db, get_pool_metrics, open_request_session
 # Add import for new functions
-from utils.email_manager import get_email_accounts, save_email_account, decrypt_password, update_last_sync, delete_email_account, update_email_account
+from utils.email_manager import get_account_password, save_email_account, update_last_sync, delete_email_account, update_email_account
+from utils.cache import cached_categories, cached_categories_with_budget, cached_email_accounts
 from sqlalchemy.orm import Session
-from utils.database import get_db, Transaction, SessionLocal # Assuming these are defined elsewhere
 from utils.password_reset import initiate_password_reset, reset_password
 import time
 
@@ -31,9 +40,10 @@ except Exception as e:
     print(f"Error al crear tablas: {str(e)}")
 
 # Función para actualizar las transacciones
-def update_transactions():
+def update_transactions(**filters):
+    """Carga en la sesión las transacciones del usuario que cumplen los filtros (aplicados en SQL)"""
     print("\n=== Actualizando transacciones ===")
-    st.session_state.transactions = load_transactions(user_id=st.session_state.user_id)
+    st.session_state.transactions = load_transactions(user_id=st.session_state.user_id, db=db_session, **filters)
     print(f"Transacciones cargadas: {len(st.session_state.transactions) if not st.session_state.transactions.empty else 0}")
 
 # Función refresh_page
@@ -43,6 +53,7 @@ def refresh_page():
     user_id = st.session_state.user_id
     username = st.session_state.username
     synced_transactions = st.session_state.synced_transactions
+    pending_sync_marks = st.session_state.pending_sync_marks
 
     # Guardar la página actual
     if 'nav_radio' in st.session_state:
@@ -50,16 +61,51 @@ def refresh_page():
 
     # Limpiar estados específicos que necesitan actualización
     for key in list(st.session_state.keys()):
-        if key not in ['user_id', 'username', 'synced_transactions', 'current_page']:
+        if key not in ['user_id', 'username', 'synced_transactions', 'pending_sync_marks', 'current_page', '_db_session']:
             del st.session_state[key]
 
     # Restaurar estados preservados
     st.session_state.user_id = user_id
     st.session_state.username = username
     st.session_state.synced_transactions = synced_transactions
+    st.session_state.pending_sync_marks = pending_sync_marks
 
     st.rerun()
 
+def save_pending_sync_marks():
+    """
+    Guarda la marca de UIDs de cada cuenta sincronizada recién cuando no
+    quedan transacciones pendientes: si la sesión termina antes de guardarlas
+    o descartarlas, la siguiente sincronización vuelve a leer esos correos.
+    """
+    if st.session_state.synced_transactions:
+        return
+    # Las que no se pudieron guardar se reintentan en la siguiente ejecución
+    st.session_state.pending_sync_marks = {
+        account_id: mark
+        for account_id, mark in st.session_state.pending_sync_marks.items()
+        if not update_last_sync(
+            account_id, st.session_state.user_id, uid_validity=mark[0], last_uid=mark[1], db=db_session
+        )
+    }
+
+def month_range(year: int, month: int) -> tuple[datetime, datetime]:
+    """Retorna el inicio del mes y el inicio del mes siguiente"""
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return start, end
+
+# Métricas internas para dimensionar el despliegue (GASTOSYNC_DIAGNOSTICS=1)
+DIAGNOSTICS = os.getenv("GASTOSYNC_DIAGNOSTICS") == "1"
+
+# Tamaños de página disponibles en "Gestionar Transacciones"
+PAGE_SIZES = [25, 50, 100, 200]
+
+MONTH_NAMES = ['Enero', 'Febrero', 'Marzo', 'Abril',
+               'Mayo', 'Junio', 'Julio', 'Agosto',
+               'Septiembre', 'Octubre', 'Noviembre',
+               'Diciembre']
+
 # Configuración de la página
 st.set_page_config(
     page_title="GastoSync",
@@ -74,6 +120,15 @@ if 'username' not in st.session_state:
     st.session_state.username = None
 if 'synced_transactions' not in st.session_state:
     st.session_state.synced_transactions = []
+if 'pending_sync_marks' not in st.session_state:
+    st.session_state.pending_sync_marks = {}
+
+# Unidad de trabajo: una sola sesión de base de datos por ejecución del script.
+# Si la ejecución anterior terminó con st.rerun()/st.stop(), se cierra aquí.
+if '_db_session' in st.session_state:
+    st.session_state._db_session.close()
+db_session = open_request_session()
+st.session_state._db_session = db_session
 
 # Estilos CSS personalizados
 st.markdown("""
@@ -159,10 +214,9 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Inicializar estado de la sesión
-if 'categories' not in st.session_state:
-    st.session_state.categories = load_categories(user_id=st.session_state.user_id)
 if 'transactions' not in st.session_state:
-    update_transactions()
+    # Cada página carga solo el período que muestra
+    st.session_state.transactions = pd.DataFrame(columns=['fecha', 'monto', 'descripcion', 'categoria', 'tipo', 'moneda'])
 
 def show_login_page():
     st.markdown('<div class="auth-form">', unsafe_allow_html=True)
@@ -183,7 +237,7 @@ def show_login_page():
             submit = st.form_submit_button("Login")
 
             if submit:
-                success, message, user = validate_login(email, password)
+                success, message, user = validate_login(email, password, db=db_session)
                 if success:
                     st.session_state.user_id = user.id
                     st.session_state.username = user.username
@@ -204,7 +258,7 @@ def show_login_page():
 
             if st.form_submit_button("Enviar Instrucciones"):
                 if reset_email:
-                    success, message = initiate_password_reset(reset_email)
+                    success, message = initiate_password_reset(reset_email, db=db_session)
                     if success:
                         st.success(message)
                     else:
@@ -244,7 +298,7 @@ def show_register_page():
             if password != password_confirm:
                 st.error("Las contraseñas no coinciden")
             else:
-                success, message = register_user(email, username, password)
+                success, message = register_user(email, username, password, db=db_session)
                 if success:
                     st.success(message)
                     st.session_state.show_register = False
@@ -279,7 +333,7 @@ if not st.session_state.user_id:
                 if new_password != confirm_password:
                     st.error("Las contraseñas no coinciden")
                 else:
-                    success, message = reset_password(reset_token, new_password)
+                    success, message = reset_password(reset_token, new_password, db=db_session)
                     if success:
                         st.success(message)
                         st.info("Por favor, inicia sesión con tu nueva contraseña")
@@ -298,9 +352,13 @@ if not st.session_state.user_id:
             show_register_page()
         else:
             show_login_page()
+    db_session.close()
     st.stop()
 
 # Si hay usuario logueado, mostrar la aplicación normal
+# Categorías del usuario desde la caché (se invalida al escribir)
+st.session_state.categories = cached_categories(st.session_state.user_id)
+
 # Inicializar el estado de la página actual si no existe
 if 'current_page' not in st.session_state:
     st.session_state.current_page = "🏠 Dashboard"
@@ -313,6 +371,9 @@ with st.sidebar:
     if st.button("Cerrar Sesión"):
         st.session_state.user_id = None
         st.session_state.username = None
+        # Las pendientes y sus marcas de UID son de este usuario: no deben pasar al siguiente
+        st.session_state.synced_transactions = []
+        st.session_state.pending_sync_marks = {}
         st.rerun()
 
     # Contenedor para el menú de navegación
@@ -336,78 +397,116 @@ with st.sidebar:
 
     page = menu_options[selected]
 
+    if DIAGNOSTICS:
+        with st.expander("Diagnóstico"):
+            st.caption("Pool de conexiones")
+            st.json(get_pool_metrics())
+            st.caption("Caché de transacciones (este proceso)")
+            st.json(TRANSACTION_CACHE.stats())
+            st.caption("Memoria de DataFrames por sesión (este proceso)")
+            st.json({
+                'esta_sesion_MB': round(frame_memory_bytes({k: st.session_state[k] for k in list(st.session_state.keys())}) / 1e6, 3),
+                **get_session_memory_metrics()
+            })
+
 # Mapear las opciones del menú a las páginas
 if page == "Dashboard":
     st.header("📊 Dashboard de Gastos")
 
-    # Forzar recarga de transacciones
-    update_transactions()
+    years = get_transaction_years(user_id=st.session_state.user_id, db=db_session)
 
-    if st.session_state.transactions.empty:
+    if not years:
         st.info("No hay transacciones registradas aún.")
     else:
-        # Selector de mes y año
-        col1, col2 = st.columns(2)
+        # Selector de mes, año y moneda de reporte
+        col1, col2, col3 = st.columns(3)
         with col1:
             year = st.selectbox(
                 "Año",
-                options=sorted(st.session_state.transactions['fecha'].dt.year.unique()),
-                index=len(st.session_state.transactions['fecha'].dt.year.unique()) - 1
+                options=years,
+                index=len(years) - 1
             )
         with col2:
             month = st.selectbox(
                 "Mes",
                 options=list(range(1, 13)),
                 index=datetime.now().month - 1,
-                format_func=lambda x: ['Enero', 'Febrero', 'Marzo', 'Abril', 
-                                    'Mayo', 'Junio', 'Julio', 'Agosto',
-                                    'Septiembre', 'Octubre', 'Noviembre', 
-                                    'Diciembre'][x-1]
+                format_func=lambda x: MONTH_NAMES[x-1]
+            )
+        with col3:
+            monedas = available_currencies(db=db_session)
+            moneda = st.selectbox(
+                "Moneda",
+                options=monedas,
+                index=monedas.index(REPORTING_CURRENCY) if REPORTING_CURRENCY in monedas else 0
             )
+        simbolo = currency_symbol(moneda)
 
-        # Filtrar transacciones por mes y año
-        filtered_df = st.session_state.transactions[
-            (st.session_state.transactions['fecha'].dt.year == year) &
-            (st.session_state.transactions['fecha'].dt.month == month)
-        ]
+        start, end = month_range(year, month)
 
-        # Summary metrics
-        total_gastos = filtered_df['monto'].sum()
-        promedio_diario = total_gastos / filtered_df['fecha'].dt.day.nunique() if not filtered_df.empty else 0
+        # Métricas calculadas en la base de datos, convertidas a la moneda de reporte
+        resumen = get_spending_summary(st.session_state.user_id, start, end, moneda=moneda, db=db_session)
+        if resumen['sin_tipo_cambio']:
+            st.warning(
+                f"{resumen['sin_tipo_cambio']} transacciones no se incluyen en los totales porque "
+                f"no hay tipo de cambio para su moneda (ver python -m utils.fx import)"
+            )
 
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("Total Gastos", f"S/. {total_gastos:.2f}")
+            st.metric("Total Gastos", f"{simbolo} {resumen['total']:.2f}")
         with col2:
-            st.metric("Promedio Diario", f"S/. {promedio_diario:.2f}")
+            st.metric("Promedio Diario", f"{simbolo} {resumen['promedio_diario']:.2f}")
 
         # Gráfico de barras por categoría
         st.subheader("Gastos por Categoría")
 
-        gastos_por_categoria = filtered_df.groupby('categoria')['monto'].sum().reset_index()
+        gastos_por_categoria = get_category_totals(st.session_state.user_id, start, end, moneda=moneda, db=db_session)
         if not gastos_por_categoria.empty:
             fig = px.bar(
                 gastos_por_categoria,
                 x='categoria',
                 y='monto',
                 title='Gastos por Categoría',
-                labels={'categoria': 'Categoría', 'monto': 'Monto (S/.)'}
+                labels={'categoria': 'Categoría', 'monto': f'Monto ({simbolo})'}
             )
             fig.update_layout(xaxis_tickangle=-45)
             st.plotly_chart(fig)
 
+        # Principales comercios del mes (agrupados por merchant_id)
+        with st.expander("🏪 Principales Comercios"):
+            comercios = get_merchant_totals(st.session_state.user_id, start, end, moneda=moneda, db=db_session)
+            if not comercios.empty:
+                st.dataframe(
+                    comercios,
+                    hide_index=True,
+                    column_config={
+                        'comercio': 'Comercio',
+                        'monto': st.column_config.NumberColumn('Monto', format=f"{simbolo} %.2f"),
+                        'transacciones': 'Transacciones'
+                    }
+                )
+
+        # Cargar solo las transacciones del mes seleccionado para el listado
+        update_transactions(start=start, end=end)
+        filtered_df = st.session_state.transactions
+
         # Tabla de transacciones
         st.subheader("Listado de Transacciones")
         if not filtered_df.empty:
             # Formatear la fecha
             display_df = filtered_df.copy()
+            # Conversión vectorizada de todas las filas a la moneda de reporte
+            display_df['monto_reporte'] = convert_amounts(display_df, moneda, db=db_session)
             display_df['fecha'] = display_df['fecha'].dt.strftime('%Y-%m-%d %H:%M')
             st.dataframe(
                 display_df,
-                column_order=['fecha', 'monto', 'descripcion', 'categoria'],
+                column_order=['fecha', 'monto', 'moneda', 'monto_reporte', 'descripcion', 'categoria'],
                 column_config={
                     'fecha': 'Fecha',
-                    'monto': st.column_config.NumberColumn('Monto', format="S/. %.2f"),
+                    'monto': st.column_config.NumberColumn('Monto', format="%.2f"),
+                    'moneda': 'Moneda',
+                    'monto_reporte': st.column_config.NumberColumn(f'Monto ({moneda})', format=f"{simbolo} %.2f"),
                     'descripcion': 'Descripción',
                     'categoria': 'Categoría'
                 }
@@ -439,8 +538,7 @@ elif page == "Ingresar Gasto":
                 'categoria': categoria,
                 'moneda': 'PEN'
             }
-            if save_transaction(transaction, user_id=st.session_state.user_id):
-                update_transactions()
+            if save_transaction(transaction, user_id=st.session_state.user_id, db=db_session):
                 st.success("✅ ¡Gasto guardado exitosamente!")
                 st.rerun()
             else:
@@ -454,7 +552,7 @@ elif page == "Gestionar Categorías":
     if st.button("Agregar Categoría"):
         if new_category and new_category not in st.session_state.categories:
             st.session_state.categories.append(new_category)
-            if save_categories(st.session_state.categories, user_id=st.session_state.user_id):
+            if save_categories(st.session_state.categories, user_id=st.session_state.user_id, db=db_session):
                 st.success(f"Categoría '{new_category}' agregada!")
             else:
                 st.error("Error al guardar la categoría")
@@ -466,19 +564,33 @@ elif page == "Gestionar Categorías":
     for category in st.session_state.categories:
         st.write(f"- {category}")
 
+    # Renombrar: las transacciones referencian la categoría por id
+    st.subheader("Renombrar Categoría")
+    with st.form("rename_category"):
+        categoria_actual = st.selectbox("Categoría", options=st.session_state.categories)
+        nuevo_nombre = st.text_input("Nuevo nombre")
+        if st.form_submit_button("Renombrar"):
+            success, message = rename_category(
+                categoria_actual, nuevo_nombre, st.session_state.user_id, db=db_session
+            )
+            if success:
+                st.success(message)
+                st.rerun()
+            else:
+                st.error(message)
+
 elif page == "Gestionar Transacciones":
     st.title("📊 Gestionar Transacciones")
 
-    # Forzar recarga de transacciones
-    update_transactions()
+    years = get_transaction_years(user_id=st.session_state.user_id, db=db_session) or [datetime.now().year]
 
     # Filtros
-    col1, col2, col3 = st.columns(3)
+    col1, col2, col3, col4 = st.columns(4)
     with col1:
         year = st.selectbox(
             "Año",
-            options=sorted(st.session_state.transactions['fecha'].dt.year.unique()),
-            index=len(st.session_state.transactions['fecha'].dt.year.unique()) - 1,
+            options=years,
+            index=len(years) - 1,
             key='trans_year'
         )
     with col2:
@@ -486,121 +598,232 @@ elif page == "Gestionar Transacciones":
             "Mes",
             options=list(range(1, 13)),
             index=datetime.now().month - 1,
-            format_func=lambda x: ['Enero', 'Febrero', 'Marzo', 'Abril', 
-                                'Mayo', 'Junio', 'Julio', 'Agosto',
-                                'Septiembre', 'Octubre', 'Noviembre', 
-                                'Diciembre'][x-1],
+            format_func=lambda x: MONTH_NAMES[x-1],
             key='trans_month'
         )
     with col3:
-        # Obtener categorías únicas de las transacciones
-        categorias = ['Todas'] + sorted(st.session_state.transactions['categoria'].unique().tolist())
+        categorias = ['Todas'] + sorted(st.session_state.categories)
         categoria_filtro = st.selectbox(
             "Categoría",
             options=categorias,
             key='trans_category'
         )
+    with col4:
+        page_size = st.selectbox(
+            "Por página",
+            options=PAGE_SIZES,
+            index=PAGE_SIZES.index(50),
+            key='trans_page_size'
+        )
 
-    # Filtrar transacciones por fecha
-    filtered_df = st.session_state.transactions[
-        (st.session_state.transactions['fecha'].dt.year == year) &
-        (st.session_state.transactions['fecha'].dt.month == month)
-    ]
+    start, end = month_range(year, month)
+    categoria = None if categoria_filtro == 'Todas' else categoria_filtro
+
+    # El cursor de paginación vuelve a la primera página al cambiar los filtros
+    filtros = (year, month, categoria, page_size)
+    if st.session_state.get('trans_filters') != filtros:
+        st.session_state.trans_filters = filtros
+        st.session_state.trans_cursor = None
+    cursor = st.session_state.trans_cursor
+
+    # Cargar solo una página del mes (y categoría) seleccionados, paginando en SQL.
+    # La página queda en memoria mientras no cambie la versión de los datos
+    # del usuario; la edición en lote la actualiza en el lugar.
+    page_key = (filtros, cursor, TRANSACTION_CACHE.version(st.session_state.user_id))
+    cached_page = st.session_state.get('trans_page')
+    if cached_page is not None and cached_page[0] == page_key:
+        filtered_df, prev_cursor, next_cursor = cached_page[1:]
+    else:
+        filtered_df, prev_cursor, next_cursor = load_transactions_page(
+            user_id=st.session_state.user_id,
+            start=start,
+            end=end,
+            categoria=categoria,
+            page_size=page_size,
+            after=cursor[1] if cursor and cursor[0] == 'after' else None,
+            before=cursor[1] if cursor and cursor[0] == 'before' else None,
+            db=db_session
+        )
+        st.session_state.trans_page = (page_key, filtered_df, prev_cursor, next_cursor)
 
-    # Aplicar filtro de categoría si no es "Todas"
-    if categoria_filtro != 'Todas':
-        filtered_df = filtered_df[filtered_df['categoria'] == categoria_filtro]
+    if filtered_df.empty and cursor is not None:
+        # La página quedó vacía (p. ej. tras eliminar); volver al inicio
+        st.session_state.trans_cursor = None
+        st.rerun()
 
     if filtered_df.empty:
         st.info("No hay transacciones para los filtros seleccionados")
     else:
-        # Mostrar resumen
-        total_filtrado = filtered_df['monto'].sum()
+        # Mostrar resumen de todo el período, calculado en la base de datos
+        resumen = get_spending_summary(
+            st.session_state.user_id, start, end, categoria=categoria, moneda=BASE_CURRENCY, db=db_session
+        )
         st.metric(
             "Total Filtrado",
-            f"S/. {total_filtrado:.2f}",
-            help="Suma total de las transacciones filtradas"
+            f"{currency_symbol(BASE_CURRENCY)} {resumen['total']:.2f}",
+            help=f"Suma total de las {resumen['transacciones']} transacciones filtradas, "
+                 f"convertidas a {BASE_CURRENCY} con el tipo de cambio de su día"
+                 + (f" ({resumen['sin_tipo_cambio']} sin tipo de cambio no se suman)" if resumen['sin_tipo_cambio'] else "")
         )
 
-        # Mostrar todas las transacciones con capacidad de edición
-        st.write("### Transacciones del Período")
+        # Navegación entre páginas
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("⬅️ Más recientes", disabled=prev_cursor is None, key='trans_prev'):
+                st.session_state.trans_cursor = ('before', prev_cursor)
+                st.rerun()
+        with col2:
+            if st.button("Más antiguas ➡️", disabled=next_cursor is None, key='trans_next'):
+                st.session_state.trans_cursor = ('after', next_cursor)
+                st.rerun()
 
-        for idx, row in filtered_df.iterrows():
-            with st.expander(f"{row['fecha'].strftime('%Y-%m-%d')} - {row['descripcion']} - S/. {row['monto']:.2f}", expanded=False):
-                with st.form(f"edit_transaction_{idx}"):
-                    col1, col2 = st.columns(2)
+        if 'trans_flash' in st.session_state:
+            st.success(f"✅ {st.session_state.pop('trans_flash')}")
+        for aviso in st.session_state.pop('trans_warnings', []):
+            st.warning(aviso)
+
+        modo_lote = st.toggle("✏️ Edición en lote", key='trans_bulk_mode')
+
+        if modo_lote:
+            st.write("### Editar Transacciones del Período")
+            st.caption("Edita las celdas, agrega o elimina filas y guarda todos los cambios juntos.")
+
+            # La clave cambia tras guardar para descartar el estado del editor
+            editor_version = st.session_state.get('trans_editor_version', 0)
+            editado_df = st.data_editor(
+                # Categoría y descripción como texto editable (en memoria pueden ser categóricas)
+                filtered_df.astype({'categoria': object, 'descripcion': object}),
+                key=f"trans_editor_{editor_version}",
+                num_rows="dynamic",
+                hide_index=True,
+                column_order=['fecha', 'descripcion', 'monto', 'categoria', 'moneda'],
+                disabled=['id', 'tipo', 'moneda'],
+                column_config={
+                    'fecha': st.column_config.DatetimeColumn("Fecha", format="YYYY-MM-DD", required=True),
+                    'descripcion': st.column_config.TextColumn("Descripción", required=True),
+                    'monto': st.column_config.NumberColumn("Monto", format="%.2f", min_value=0.0, required=True),
+                    'categoria': st.column_config.SelectboxColumn(
+                        "Categoría", options=st.session_state.categories, required=True
+                    ),
+                    'moneda': st.column_config.TextColumn("Moneda"),
+                }
+            )
 
-                    with col1:
-                        new_date = st.date_input(
-                            "Fecha",
-                            value=row['fecha'].date(),
-                            key=f"date_{idx}"
-                        )
-                        new_amount = st.number_input(
-                            "Monto",
-                            value=float(row['monto']),
-                            step=0.1,
-                            key=f"amount_{idx}"
+            cambios, eliminadas = diff_transactions(filtered_df, editado_df)
+            nuevas = new_transaction_rows(editado_df)
+            st.caption(f"{len(cambios)} filas modificadas, {len(nuevas)} nuevas, {len(eliminadas)} eliminadas")
+            if st.button("💾 Guardar cambios", key='trans_bulk_save', disabled=not (cambios or eliminadas or len(nuevas))):
+                success, messages = True, []
+                if cambios or eliminadas:
+                    success, message = apply_transaction_changes(
+                        cambios, eliminadas, st.session_state.user_id, db=db_session
+                    )
+                    messages.append(message)
+                if success and len(nuevas):
+                    # Las filas agregadas se insertan con las mismas validaciones que una importación
+                    inserted, rejects = save_transactions_bulk(nuevas, user_id=st.session_state.user_id, db=db_session)
+                    messages.append(f"{inserted} transacciones agregadas")
+                    st.session_state.trans_warnings = [
+                        f"Fila nueva \"{nuevas.at[idx, 'descripcion']}\" no guardada: {motivo}" for idx, motivo in rejects
+                    ]
+                if success:
+                    if len(nuevas):
+                        # Hay filas nuevas en la página: volver a consultarla
+                        st.session_state.pop('trans_page', None)
+                    else:
+                        # Actualizar la página en memoria sin volver a consultarla
+                        apply_changes_to_frame(filtered_df, cambios, eliminadas)
+                        st.session_state.trans_page = (
+                            (filtros, cursor, TRANSACTION_CACHE.version(st.session_state.user_id)),
+                            filtered_df, prev_cursor, next_cursor
                         )
+                    st.session_state.trans_editor_version = editor_version + 1
+                    st.session_state.trans_flash = "; ".join(messages)
+                    st.rerun()
+                else:
+                    st.error(f"❌ {message}")
+        else:
+            # Mostrar todas las transacciones con capacidad de edición
+            st.write("### Transacciones del Período")
 
-                    with col2:
-                        new_description = st.text_input(
-                            "Descripción",
-                            value=row['descripcion'],
-                            key=f"desc_{idx}"
-                        )
-                        new_category = st.selectbox(
-                            "Categoría",
-                            options=st.session_state.categories,
-                            index=st.session_state.categories.index(row['categoria']) if row['categoria'] in st.session_state.categories else 0,
-                            key=f"cat_{idx}"
-                        )
+            for _, row in filtered_df.iterrows():
+                transaction_id = int(row['id'])
+                with st.expander(f"{row['fecha'].strftime('%Y-%m-%d')} - {row['descripcion']} - S/. {row['monto']:.2f}", expanded=False):
+                    with st.form(f"edit_transaction_{transaction_id}"):
+                        col1, col2 = st.columns(2)
+
+                        with col1:
+                            new_date = st.date_input(
+                                "Fecha",
+                                value=row['fecha'].date(),
+                                key=f"date_{transaction_id}"
+                            )
+                            new_amount = st.number_input(
+                                "Monto",
+                                value=round(float(row['monto']), 2),
+                                step=0.1,
+                                key=f"amount_{transaction_id}"
+                            )
+
+                        with col2:
+                            new_description = st.text_input(
+                                "Descripción",
+                                value=row['descripcion'],
+                                key=f"desc_{transaction_id}"
+                            )
+                            new_category = st.selectbox(
+                                "Categoría",
+                                options=st.session_state.categories,
+                                index=st.session_state.categories.index(row['categoria']) if row['categoria'] in st.session_state.categories else 0,
+                                key=f"cat_{transaction_id}"
+                            )
 
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        if st.form_submit_button("💾 Guardar Cambios"):
-                            # Actualizar la transacción en la base de datos
-                            with SessionLocal() as db:
-                                transaction = db.query(Transaction).filter(
-                                    Transaction.fecha == row['fecha'],
-                                    Transaction.monto == row['monto'],
-                                    Transaction.descripcion == row['descripcion'],
-                                    Transaction.user_id == st.session_state.user_id
-                                ).first()
-
-                                if transaction:
-                                    transaction.fecha = datetime.combine(new_date, datetime.min.time())
-                                    transaction.monto = new_amount
-                                    transaction.descripcion = new_description
-                                    transaction.categoria = new_category
-                                    db.commit()
-                                    st.success("✅ Transacción actualizada")
-                                    # Recargar transacciones
-                                    update_transactions()
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            if st.form_submit_button("💾 Guardar Cambios"):
+                                # Actualizar la transacción por su clave primaria
+                                success, message = update_transaction(
+                                    transaction_id,
+                                    st.session_state.user_id,
+                                    fecha=datetime.combine(new_date, datetime.min.time()),
+                                    monto=new_amount,
+                                    descripcion=new_description,
+                                    categoria=new_category,
+                                    db=db_session
+                                )
+                                if success:
+                                    st.success(f"✅ {message}")
+                                    # La escritura cambia la versión de datos: la página se vuelve a consultar
                                     st.rerun()
                                 else:
-                                    st.error("❌ No se encontró la transacción")
+                                    st.error(f"❌ {message}")
 
-                    with col2:
-                        if st.form_submit_button("🗑️ Eliminar"):
-                            with SessionLocal() as db:
-                                transaction = db.query(Transaction).filter(
-                                    Transaction.fecha == row['fecha'],
-                                    Transaction.monto == row['monto'],
-                                    Transaction.descripcion == row['descripcion'],
-                                    Transaction.user_id == st.session_state.user_id
-                                ).first()
-
-                                if transaction:
-                                    db.delete(transaction)
-                                    db.commit()
+                        with col2:
+                            if st.form_submit_button("🗑️ Eliminar"):
+                                if delete_transactions([transaction_id], st.session_state.user_id, db=db_session):
                                     st.success("✅ Transacción eliminada")
-                                    # Recargar transacciones
-                                    update_transactions()
+                                    # La escritura cambia la versión de datos: la página se vuelve a consultar
                                     st.rerun()
                                 else:
                                     st.error("❌ No se encontró la transacción")
 
+            # Eliminación en lote
+            with st.expander("🗑️ Eliminar varias transacciones", expanded=False):
+                etiquetas = {
+                    int(row['id']): f"{row['fecha'].strftime('%Y-%m-%d')} - {row['descripcion']} - S/. {row['monto']:.2f}"
+                    for _, row in filtered_df.iterrows()
+                }
+                seleccionadas = st.multiselect(
+                    "Transacciones a eliminar",
+                    options=list(etiquetas),
+                    format_func=lambda transaction_id: etiquetas[transaction_id],
+                    key="bulk_delete_ids"
+                )
+                if st.button("Eliminar seleccionadas", key="bulk_delete") and seleccionadas:
+                    eliminadas = delete_transactions(seleccionadas, st.session_state.user_id, db=db_session)
+                    st.success(f"✅ Se eliminaron {eliminadas} transacciones")
+                    st.rerun()
+
 
 elif page == "Gestionar Presupuestos":
     st.title("Gestionar Presupuestos Mensuales")
@@ -616,7 +839,7 @@ elif page == "Gestionar Presupuestos":
     with col1:
         year = st.selectbox(
             "Año",
-            options=list(range(2024, 2026)),
+            options=list(range(2024, datetime.now().year + 2)),
             index=datetime.now().year - 2024
         )
     with col2:
@@ -634,7 +857,7 @@ elif page == "Gestionar Presupuestos":
     fecha_seleccionada = datetime(year, month, 1)
 
     # Cargar categorías con sus presupuestos para el mes seleccionado
-    categories_with_budget = load_categories_with_budget(fecha_seleccionada, user_id=st.session_state.user_id)
+    categories_with_budget = cached_categories_with_budget(fecha_seleccionada, st.session_state.user_id)
 
     # Calcular presupuesto total
     total_budget = sum(float(presupuesto if presupuesto is not None else 0.0) 
@@ -648,17 +871,27 @@ elif page == "Gestionar Presupuestos":
                            for _, presup, _ in categories_with_budget]
         })
 
+        # Gasto del mes desde los totales mensuales (una fila por categoría),
+        # en la moneda de los presupuestos
+        gastado = get_category_totals(
+            st.session_state.user_id, *month_range(year, month), moneda=BASE_CURRENCY, db=db_session
+        )
+        df_budget = df_budget.merge(
+            gastado[['categoria', 'monto']].rename(columns={'monto': 'gastado'}),
+            on='categoria', how='left'
+        ).fillna({'gastado': 0.0})
+
         # Gráfico de barras
         fig = px.bar(
             df_budget,
             x='categoria',
-            y='presupuesto',
-            title='Presupuesto por Categoría',
-            labels={'categoria': 'Categoría', 'presupuesto': 'Monto (S/.)'}
+            y=['presupuesto', 'gastado'],
+            barmode='group',
+            title='Presupuesto vs Gasto por Categoría',
+            labels={'categoria': 'Categoría', 'value': 'Monto (S/.)', 'variable': ''}
         )
         fig.update_layout(
             xaxis_tickangle=-45,
-            showlegend=False,
             height=400
         )
         st.plotly_chart(fig)
@@ -675,6 +908,17 @@ elif page == "Gestionar Presupuestos":
     with col3:
         st.metric("Número de Categorías", len(categories_with_budget))
 
+    # Evolución del año: presupuesto vigente vs gasto real por mes
+    st.subheader(f"Presupuesto vs Gasto {year}")
+    year_start, year_end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+    budget_matrix = load_budget_matrix(year_start, year_end, user_id=st.session_state.user_id, db=db_session)
+    monthly_spend = get_monthly_category_totals(
+        st.session_state.user_id, year_start, year_end, moneda=BASE_CURRENCY, db=db_session
+    )
+    df_year = pd.DataFrame({'presupuesto': budget_matrix.sum(axis=0)})
+    df_year['gastado'] = monthly_spend.groupby('mes')['monto'].sum().reindex(df_year.index, fill_value=0.0)
+    st.line_chart(df_year)
+
     st.divider()
 
     # Mostrar formulario para cada categoría
@@ -707,9 +951,10 @@ elif page == "Gestionar Presupuestos":
                     categoria=categoria,
                     presupuesto=nuevo_presupuesto,
                     user_id=st.session_state.user_id,
-                    fecha=fecha_seleccionada
+                    fecha=fecha_seleccionada,
+                    db=db_session
                 )
-                updated_notes = update_category_notes(categoria, new_notes, user_id=st.session_state.user_id)
+                updated_notes = update_category_notes(categoria, new_notes, user_id=st.session_state.user_id, db=db_session)
 
                 if updated_budget and updated_notes:
                     st.success("✅ Presupuesto y notas actualizados")
@@ -726,13 +971,13 @@ elif page == "Sincronizar Correos":
     """)
 
     # Mostrar cuentas configuradas
-    accounts = get_email_accounts(user_id=st.session_state.user_id)
+    accounts = cached_email_accounts(st.session_state.user_id)
     if accounts:
         st.subheader("Cuentas Configuradas")
         for account in accounts:
-            with st.expander(f"{account.bank_name} - {account.email}", expanded=False):
-                st.write(f"Última sincronización: {account.last_sync or 'Nunca'}")
-                st.write(f"Estado: {'Activa' if account.is_active else 'Inactiva'}")
+            with st.expander(f"{account['bank_name']} - {account['email']}", expanded=False):
+                st.write(f"Última sincronización: {account['last_sync'] or 'Nunca'}")
+                st.write(f"Estado: {'Activa' if account['is_active'] else 'Inactiva'}")
 
                 col1, col2, col3 = st.columns(3)
 
@@ -743,29 +988,44 @@ elif page == "Sincronizar Correos":
                         min_value=1,
                         max_value=90,
                         value=30,
-                        key=f"days_{account.id}"
+                        key=f"days_{account['id']}"
                     )
-                    if st.button("🔄 Sincronizar", key=f"sync_{account.id}"):
+                    # Con una marca previa solo se descargan los correos nuevos; la
+                    # de una sincronización con pendientes sin guardar tiene prioridad
+                    uid_validity, last_uid = st.session_state.pending_sync_marks.get(
+                        account['id'], (account['uid_validity'], account['last_uid'])
+                    )
+                    full_rescan = last_uid is None or st.checkbox(
+                        "Revisar todo el período",
+                        key=f"rescan_{account['id']}",
+                        help="Vuelve a buscar los correos de los días seleccionados, no solo los nuevos"
+                    )
+                    if st.button("🔄 Sincronizar", key=f"sync_{account['id']}"):
                         try:
                             with st.spinner('Conectando con el servidor de correo...'):
-                                password = decrypt_password(account.encrypted_password)
-                                reader = EmailReader(account.email, password)
+                                password = get_account_password(account['id'], st.session_state.user_id, db=db_session)
+                                reader = EmailReader(account['email'], password)
                                 transactions = reader.fetch_notifications(
                                     days_back=days_to_sync,
-                                    bank=account.bank_name
+                                    bank=account['bank_name'],
+                                    uid_validity=None if full_rescan else uid_validity,
+                                    last_uid=None if full_rescan else last_uid
+                                )
+                                # La marca se guarda cuando las pendientes se guarden o descarten
+                                st.session_state.pending_sync_marks[account['id']] = (
+                                    reader.uid_validity, reader.last_uid
                                 )
 
                                 if transactions:
-                                    # Filtrar transacciones duplicadas
-                                    new_transactions = []
-                                    duplicates = 0
-
-                                    for t in transactions:
-                                        t['banco'] = account.bank_name
-                                        if not is_duplicate_transaction(t, st.session_state.user_id):
-                                            new_transactions.append(t)
-                                        else:
-                                            duplicates += 1
+                                    # Filtrar transacciones duplicadas en una sola consulta; también
+                                    # completa transaction['banco'], que usan las pendientes al guardarse
+                                    new_transactions, duplicate_transactions = partition_duplicate_transactions(
+                                        transactions,
+                                        st.session_state.user_id,
+                                        banco=account['bank_name'],
+                                        db=db_session
+                                    )
+                                    duplicates = len(duplicate_transactions)
 
                                     if new_transactions:
                                         st.success(f"Se encontraron {len(new_transactions)} notificaciones nuevas")
@@ -776,7 +1036,6 @@ elif page == "Sincronizar Correos":
                                         if 'synced_transactions' not in st.session_state:
                                             st.session_state.synced_transactions = []
                                         st.session_state.synced_transactions.extend(new_transactions)
-                                        update_last_sync(account.id)
                                     else:
                                         if duplicates > 0:
                                             st.info(f"Todas las {duplicates} transacciones encontradas ya estaban sincronizadas")
@@ -790,38 +1049,40 @@ elif page == "Sincronizar Correos":
 
                 # Botón para editar
                 with col2:
-                    if st.button("✏️ Editar", key=f"edit_{account.id}"):
-                        st.session_state[f"editing_{account.id}"] = True
+                    if st.button("✏️ Editar", key=f"edit_{account['id']}"):
+                        st.session_state[f"editing_{account['id']}"] = True
 
                 # Botón para eliminar
                 with col3:
-                    if st.button("🗑️ Eliminar", key=f"delete_{account.id}"):
-                        if delete_email_account(account.id)[0]:
+                    if st.button("🗑️ Eliminar", key=f"delete_{account['id']}"):
+                        if delete_email_account(account['id'], db=db_session)[0]:
+                            st.session_state.pending_sync_marks.pop(account['id'], None)
                             st.success("Cuenta eliminada exitosamente")
                             st.rerun()
                         else:
                             st.error("Error al eliminar la cuenta")
 
                 # Formulario de edición si está en modo edición
-                if f"editing_{account.id}" in st.session_state:
-                    with st.form(key=f"edit_form_{account.id}"):
+                if f"editing_{account['id']}" in st.session_state:
+                    with st.form(key=f"edit_form_{account['id']}"):
                         st.write("### Editar Cuenta")
                         new_password = st.text_input(
                             "Nueva Contraseña de Aplicación (dejar en blanco para mantener la actual)",
                             type="password"
                         )
-                        new_status = st.checkbox("Cuenta Activa", value=account.is_active)
+                        new_status = st.checkbox("Cuenta Activa", value=account['is_active'])
 
                         col1, col2 = st.columns(2)
                         with col1:
                             if st.form_submit_button("Guardar Cambios"):
                                 success, message = update_email_account(
-                                    account_id=account.id,
+                                    account_id=account['id'],
                                     password=new_password if new_password else None,
-                                    is_active=new_status
+                                    is_active=new_status,
+                                    db=db_session
                                 )
                                 if success:
-                                    del st.session_state[f"editing_{account.id}"]
+                                    del st.session_state[f"editing_{account['id']}"]
                                     st.success(message)
                                     st.rerun()
                                 else:
@@ -829,7 +1090,7 @@ elif page == "Sincronizar Correos":
 
                         with col2:
                             if st.form_submit_button("Cancelar"):
-                                del st.session_state[f"editing_{account.id}"]
+                                del st.session_state[f"editing_{account['id']}"]
                                 st.rerun()
 
     # Formulario para agregar nueva cuenta
@@ -867,7 +1128,8 @@ elif page == "Sincronizar Correos":
                 email=email,
                 password=password,
                 bank_name=bank,
-                user_id=st.session_state.user_id
+                user_id=st.session_state.user_id,
+                db=db_session
             )
             if success:
                 st.success(message)
@@ -912,9 +1174,8 @@ elif page == "Sincronizar Correos":
                                 'moneda': transaction.get('moneda', 'PEN')
                             }
 
-                            if save_transaction(save_data, user_id=st.session_state.user_id):
+                            if save_transaction(save_data, user_id=st.session_state.user_id, db=db_session):
                                 st.session_state.synced_transactions.pop(idx)
-                                update_transactions()
                                 st.success("¡Transacción guardada exitosamente!")
                                 st.rerun()
                             else:
@@ -928,6 +1189,25 @@ elif page == "Sincronizar Correos":
                         st.success("Transacción descartada")
                         st.rerun()
 
+        # Guardar todas las pendientes en un solo lote
+        if st.button("💾 Guardar todas las pendientes", key="save_all_synced"):
+            pending = st.session_state.synced_transactions
+            inserted, rejects = save_transactions_bulk(pending, user_id=st.session_state.user_id, db=db_session)
+            reasons = dict(rejects)
+            # Se conservan como pendientes solo las rechazadas que no son duplicadas
+            st.session_state.synced_transactions = [
+                t for idx, t in enumerate(pending)
+                if idx in reasons and reasons[idx] not in ('Transacción duplicada', 'Duplicada dentro del lote')
+            ]
+            if inserted:
+                st.success(f"Se guardaron {inserted} transacciones")
+            for idx, motivo in rejects:
+                st.warning(f"{pending[idx]['descripcion']}: {motivo}")
+            if not rejects:
+                st.rerun()
+
+    save_pending_sync_marks()
+
 # Add reset password page logic
 if 'reset_token' in st.query_params:
     token = st.query_params['reset_token'][0]
@@ -949,7 +1229,7 @@ if 'reset_token' in st.query_params:
             if new_password != confirm_password:
                 st.error("Las contraseñas no coinciden")
             else:
-                success, message = reset_password(token, new_password)
+                success, message = reset_password(token, new_password, db=db_session)
                 if success:
                     st.success(message)
                     st.info("Por favor, inicia sesión con tu nueva contraseña")
@@ -958,4 +1238,11 @@ if 'reset_token' in st.query_params:
                 else:
                     st.error(message)
 
-    st.markdown('</div>', unsafe_allow_html=True)
\ No newline at end of file
+    st.markdown('</div>', unsafe_allow_html=True)
+
+# Fin de la ejecución: publicar la memoria de la sesión (solo con diagnóstico,
+# porque recorre todo el estado) y devolver la conexión al pool
+ctx = get_script_run_ctx() if DIAGNOSTICS else None
+if ctx is not None:
+    record_session_memory(ctx.session_id, st.session_state)
+db_session.close()
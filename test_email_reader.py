@@ -0,0 +1,113 @@
+import base64
+
+from utils.email_reader import EmailReader, body_parts, choose_text_part, decode_part, parse_imap_list, split_fetch_items
+
+# Respuesta de Gmail a UID FETCH (BODYSTRUCTURE) tal como la entrega imaplib:
+# multipart/mixed con una alternativa texto/HTML y un logo adjunto, y un
+# segundo correo con un adjunto cuyo nombre llega como literal {n}
+GMAIL_BODYSTRUCTURE = [
+    b'1 (UID 4821 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 312 8 NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 1544 31 NIL NIL NIL) "ALTERNATIVE" '
+    b'("BOUNDARY" "000000000000a1b2c3") NIL NIL)("IMAGE" "PNG" ("NAME" "logo.png") "<logo@bcp>" NIL "BASE64" '
+    b'20460 NIL ("ATTACHMENT" ("FILENAME" "logo.png")) NIL) "MIXED" ("BOUNDARY" "000000000000d4e5f6") NIL NIL))',
+    (
+        b'2 (UID 4822 BODYSTRUCTURE (("TEXT" "HTML" ("CHARSET" "ISO-8859-1") NIL NIL "BASE64" 2048 27 NIL NIL NIL)'
+        b'("APPLICATION" "PDF" ("NAME" {17}',
+        b'Estado "2025".pdf'
+    ),
+    b') NIL NIL "BASE64" 51200 NIL ("ATTACHMENT" NIL) NIL) "MIXED" ("BOUNDARY" "000000000000f7a8b9") NIL NIL))',
+]
+
+
+def test_parse_imap_list_reads_atoms_strings_nil_and_literals():
+    assert parse_imap_list(b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL 120)') == \
+        [['TEXT', 'PLAIN', ['CHARSET', 'utf-8'], None, '120']]
+    assert parse_imap_list(b'("NAME" "Compra \\"BCP\\"")') == [['NAME', 'Compra "BCP"']]
+    assert parse_imap_list(b'("NAME" {9}\r\nlogo).png NIL)') == [['NAME', 'logo).png', None]]
+
+
+def test_split_fetch_items_handles_nested_multipart_and_literals():
+    first, second = split_fetch_items(GMAIL_BODYSTRUCTURE)
+    assert first['UID'] == '4821' and second['UID'] == '4822'
+
+    assert list(body_parts(first['BODYSTRUCTURE'])) == [
+        ('1.1', 'text/plain', {'charset': 'UTF-8'}, 'quoted-printable'),
+        ('1.2', 'text/html', {'charset': 'UTF-8'}, 'quoted-printable'),
+        ('2', 'image/png', {'name': 'logo.png'}, 'base64'),
+    ]
+    assert choose_text_part(first['BODYSTRUCTURE'])[0] == '1.1'
+
+    assert list(body_parts(second['BODYSTRUCTURE']))[1] == \
+        ('2', 'application/pdf', {'name': 'Estado "2025".pdf'}, 'base64')
+    # Sin text/plain se usa la parte HTML
+    assert choose_text_part(second['BODYSTRUCTURE']) == ('1', 'text/html', {'charset': 'ISO-8859-1'}, 'base64')
+
+
+def test_single_part_message_is_section_one():
+    structure = parse_imap_list(b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 120 3 NIL NIL NIL)')[0]
+    assert choose_text_part(structure) == ('1', 'text/plain', {'charset': 'us-ascii'}, '7bit')
+    assert choose_text_part(parse_imap_list(b'("IMAGE" "JPEG" NIL NIL NIL "BASE64" 900)')[0]) is None
+
+
+def test_split_fetch_items_reads_bodies_as_literals_quoted_strings_or_nil():
+    msg_data = [
+        (b'1 (UID 4821 BODY[1.1] {11}', b'Monto: S/ 9'),
+        b')',
+        # Gmail a veces envía el UID después del literal
+        (b'3 (BODY[1.1] {5}', b'caf\xe9!'),
+        b' UID 4823)',
+        # Partes cortas o vacías pueden llegar como cadena o NIL
+        b'4 (UID 4824 BODY[1.1] "Monto: S/ 5")',
+        b'5 (UID 4825 BODY[1.1] NIL)',
+    ]
+    items = split_fetch_items(msg_data, literal_bytes=True)
+    assert {item['UID']: item['BODY[1.1]'] for item in items} == {
+        '4821': b'Monto: S/ 9', '4823': b'caf\xe9!', '4824': 'Monto: S/ 5', '4825': None
+    }
+    assert split_fetch_items(msg_data[:2])[0]['BODY[1.1]'] == 'Monto: S/ 9'
+
+
+class FakeImap:
+    """Responde UID FETCH con respuestas fijas, en el formato de imaplib"""
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def uid(self, command, message_set, items):
+        return 'OK', self.responses['BODYSTRUCTURE' if 'BODYSTRUCTURE' in items else 'BODY']
+
+
+def test_fetch_messages_accepts_quoted_and_empty_bodies():
+    reader = EmailReader("cliente@gmail.com", "secreto", batch_size=10)
+    reader.failed_uids = []
+    reader.imap = FakeImap({
+        'BODYSTRUCTURE': [
+            b'1 (UID 10 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 11 1 NIL NIL NIL))',
+            b'2 (UID 11 BODYSTRUCTURE ("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "7BIT" 0 0 NIL NIL NIL))',
+        ],
+        'BODY': [b'1 (UID 10 BODY[1] "Monto: S/ 5")', b'2 (UID 11 BODY[1] NIL)'],
+    })
+    assert list(reader.fetch_messages([10, 11])) == [(10, 'Monto: S/ 5')]
+    # Un cuerpo vacío cuenta como procesado: no detiene la marca de sincronización
+    assert reader.failed_uids == []
+
+
+def test_decode_part_applies_transfer_encoding_and_charset():
+    texto = "Se realizó una compra en CAFÉ ÑAÑA"
+    assert decode_part(base64.b64encode(texto.encode('iso-8859-1')), 'base64', 'ISO-8859-1') == texto
+    quoted = b'Se realiz=C3=B3 una compra en CAF=C3=89 =\r\n=C3=91A=C3=91A'
+    assert decode_part(quoted, 'quoted-printable', 'UTF-8') == texto
+    assert decode_part(texto.encode('utf-8'), '8bit') == texto
+    # Charset desconocido o contenido inválido: se lee como latin-1
+    assert decode_part(texto.encode('iso-8859-1'), '8bit', 'x-desconocido') == texto
+    assert decode_part(texto.encode('iso-8859-1'), '8bit', 'utf-8') == texto
+
+
+if __name__ == "__main__":
+    test_parse_imap_list_reads_atoms_strings_nil_and_literals()
+    test_split_fetch_items_handles_nested_multipart_and_literals()
+    test_single_part_message_is_section_one()
+    test_split_fetch_items_reads_bodies_as_literals_quoted_strings_or_nil()
+    test_fetch_messages_accepts_quoted_and_empty_bodies()
+    test_decode_part_applies_transfer_encoding_and_charset()
+    print("OK")
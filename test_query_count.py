@@ -0,0 +1,271 @@
+import os
+import tempfile
+import time
+
+# Base de datos SQLite temporal para no tocar la base real
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test_query_count.db"
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+from sqlalchemy import event
+from utils.database import engine, init_db
+from utils.auth import register_user, validate_login
+from utils.data_manager import (
+    TransactionCache, load_categories, load_categories_with_budget, load_transactions, save_transaction,
+    update_category_budget, partition_duplicate_transactions, save_transactions_bulk, update_transaction,
+    delete_transactions, apply_transaction_changes, rename_category, save_categories
+)
+from utils.email_manager import save_email_account, update_email_account
+from utils.cache import cached_categories_with_budget, cached_email_accounts
+from utils.fx import import_fx_rates
+from utils.aggregations import (
+    get_spending_summary, get_category_totals, get_monthly_category_totals, rebuild_monthly_category_totals
+)
+
+engine.echo = False
+
+CATALOG_MARKERS = ("sqlite_master", "pragma", "information_schema", "pg_catalog", "create table", "create index")
+
+
+class StatementCounter:
+    """Registra las sentencias SQL ejecutadas por el motor"""
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(engine, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    @property
+    def catalog_statements(self):
+        return [s for s in self.statements if any(m in s.lower() for m in CATALOG_MARKERS)]
+
+
+def page_load(user_id):
+    """Consultas que hace una carga típica de página (categorías, presupuestos y transacciones)"""
+    load_categories(user_id=user_id)
+    load_categories_with_budget(user_id=user_id)
+    load_transactions(user_id=user_id)
+
+
+def create_user(name):
+    register_user(f"{name}@example.com", name, "secreto")
+    return validate_login(f"{name}@example.com", "secreto")[2].id
+
+
+def test_schema_bootstrap_runs_once_per_process():
+    init_db()
+    with StatementCounter() as counter:
+        init_db()
+        init_db()
+    assert counter.statements == []
+
+
+def test_page_load_does_not_reflect_schema_or_reseed():
+    user_id = create_user("conteo")
+    page_load(user_id)  # primera carga: crea categorías por defecto
+
+    with StatementCounter() as counter:
+        page_load(user_id)
+
+    assert counter.catalog_statements == []
+    assert not any(s.lower().startswith("insert") for s in counter.statements)
+    # categorías + categorías con presupuesto; las transacciones salen de la caché
+    assert len(counter.statements) == 2
+
+
+def test_transaction_cache_is_invalidated_by_writes():
+    user_id = create_user("cache")
+    first = load_transactions(user_id=user_id)
+
+    with StatementCounter() as counter:
+        assert load_transactions(user_id=user_id) is first
+    assert counter.statements == []
+
+    assert save_transaction({
+        "fecha": datetime(2025, 1, 15), "monto": 12.5,
+        "descripcion": "PANADERIA", "categoria": "Alimentación"
+    }, user_id=user_id)
+
+    with StatementCounter() as counter:
+        reloaded = load_transactions(user_id=user_id)
+    assert len(counter.statements) > 0
+    assert reloaded["descripcion"].tolist() == ["PANADERIA"]
+
+
+def test_transaction_cache_evicts_least_recently_used():
+    cache = TransactionCache(max_bytes=10_000)
+    frame = pd.DataFrame({"monto": np.zeros(500)})  # ~4 KB
+    for user_id in (1, 2):
+        cache.put(user_id, (), cache.version(user_id), frame)
+    cache.get(1, ())
+    cache.put(3, (), cache.version(3), frame)
+
+    assert cache.get(2, ()) is None
+    assert cache.get(1, ()) is frame and cache.get(3, ()) is frame
+    assert cache.stats()["desalojos"] == 1
+
+
+def test_transaction_cache_entries_expire():
+    cache = TransactionCache(max_bytes=10_000, max_age_seconds=0.05)
+    frame = pd.DataFrame({"monto": np.zeros(10)})
+    cache.put(1, (), cache.version(1), frame)
+    assert cache.get(1, ()) is frame
+    time.sleep(0.1)
+    assert cache.get(1, ()) is None
+    assert cache.stats()["entradas"] == 0
+
+
+def test_category_and_account_caches_are_invalidated_by_writes():
+    user_id = create_user("hooks")
+    fecha = datetime(2025, 3, 1)
+    cached_categories_with_budget(fecha, user_id)
+    assert save_email_account("hooks@gmail.com", "clave", "BCP", user_id)
+    account = cached_email_accounts(user_id)[0]
+    assert "encrypted_password" not in account
+
+    with StatementCounter() as counter:
+        cached_categories_with_budget(fecha, user_id)
+        cached_email_accounts(user_id)
+    assert counter.statements == []
+
+    assert update_category_budget("Casa", 999.0, user_id, fecha=fecha)
+    assert update_email_account(account["id"], is_active=False)[0]
+
+    budgets = {categoria: monto for categoria, monto, _ in cached_categories_with_budget(fecha, user_id)}
+    assert budgets["Casa"] == 999.0
+    assert cached_email_accounts(user_id)[0]["is_active"] is False
+
+
+def test_dashboard_totals_are_converted_with_the_rate_in_force():
+    user_id = create_user("fx")
+    rates = os.path.join(tempfile.mkdtemp(), "tasas.csv")
+    with open(rates, "w") as f:
+        f.write("fecha,moneda,tasa\n2024-01-01,USD,3.5\n2025-02-01,USD,4.0\n")
+    import_fx_rates(rates)
+    assert save_transaction({
+        "fecha": datetime(2025, 1, 20), "monto": 10.0, "descripcion": "AMAZON",
+        "categoria": "Casa", "moneda": "USD"
+    }, user_id=user_id)
+    assert save_transaction({
+        "fecha": datetime(2025, 2, 3), "monto": 10.0, "descripcion": "AMAZON",
+        "categoria": "Casa", "moneda": "USD"
+    }, user_id=user_id)
+    assert save_transaction({
+        "fecha": datetime(2025, 2, 5), "monto": 20.0, "descripcion": "WONG",
+        "categoria": "Casa", "moneda": "PEN"
+    }, user_id=user_id)
+
+    start, end = datetime(2025, 1, 1), datetime(2025, 3, 1)
+    assert get_spending_summary(user_id, start, end, moneda="PEN")["total"] == 35.0 + 40.0 + 20.0
+    assert get_spending_summary(user_id, start, end, moneda="USD")["total"] == 20.0 + 5.0
+    totals = get_category_totals(user_id, start, end, moneda="PEN")
+    assert totals.set_index("categoria")["monto"].to_dict() == {"Casa": 95.0}
+    # Meses completos: los montos en USD salen del rollup, solo PEN se convierte por día
+    totals = get_category_totals(user_id, start, end, moneda="USD")
+    assert totals.set_index("categoria")["monto"].to_dict() == {"Casa": 25.0}
+
+
+def test_synced_emails_match_legacy_rows_without_bank():
+    user_id = create_user("legado")
+    # Fila guardada antes de registrar el banco: su huella no lo incluye
+    legacy = {"fecha": datetime(2025, 4, 2), "monto": 45.0, "descripcion": "TAMBO", "categoria": "Alimentación"}
+    assert save_transaction(dict(legacy), user_id=user_id)
+
+    synced = dict(legacy, moneda="PEN")
+    new, duplicates = partition_duplicate_transactions([synced], user_id, banco="BCP")
+    assert new == [] and duplicates == [synced]
+    assert save_transactions_bulk([synced], user_id=user_id) == (0, [(0, "Transacción duplicada")])
+
+
+def assert_rollup_matches_rebuild(user_id):
+    """Los totales mantenidos por las escrituras coinciden con los reconstruidos desde transacciones"""
+    def totals():
+        return get_monthly_category_totals(user_id, datetime(2025, 1, 1), datetime(2026, 1, 1)) \
+            .sort_values(["mes", "categoria"], ignore_index=True)
+    maintained = totals()
+    assert rebuild_monthly_category_totals(user_id)
+    pd.testing.assert_frame_equal(maintained, totals(), check_dtype=False)
+
+
+def test_rollup_write_paths_match_rebuild():
+    user_id = create_user("rollup")
+    assert save_transaction({
+        "fecha": datetime(2025, 5, 3), "monto": 30.0, "descripcion": "PLAZA VEA",
+        "categoria": "Alimentación", "moneda": "PEN"
+    }, user_id=user_id)
+    assert_rollup_matches_rebuild(user_id)
+
+    inserted, _ = save_transactions_bulk([
+        {"fecha": datetime(2025, 5, 10), "monto": 12.0, "descripcion": "UBER", "categoria": "Transporte"},
+        {"fecha": datetime(2025, 6, 2), "monto": 8.5, "descripcion": "NETFLIX", "categoria": "Entretenimiento",
+         "moneda": "USD"},
+        {"fecha": datetime(2025, 6, 20), "monto": 40.0, "descripcion": "FARMACIA", "categoria": "Salud"},
+        {"fecha": datetime(2025, 7, 1), "monto": 22.0, "descripcion": "CINE", "categoria": "Entretenimiento"},
+    ], user_id=user_id)
+    assert inserted == 4
+    assert_rollup_matches_rebuild(user_id)
+
+    ids = load_transactions(user_id=user_id).set_index("descripcion")["id"]
+    # Cambia de mes, de categoría y de monto
+    assert update_transaction(int(ids["UBER"]), user_id, fecha=datetime(2025, 6, 11), monto=15.0,
+                              categoria="Casa")[0]
+    assert_rollup_matches_rebuild(user_id)
+
+    assert delete_transactions([int(ids["FARMACIA"])], user_id) == 1
+    assert_rollup_matches_rebuild(user_id)
+
+    assert apply_transaction_changes(
+        [{"id": int(ids["PLAZA VEA"]), "monto": 35.0, "categoria": "Casa"},
+         {"id": int(ids["NETFLIX"]), "fecha": datetime(2025, 7, 2)}],
+        [int(ids["CINE"])], user_id
+    )[0]
+    assert_rollup_matches_rebuild(user_id)
+
+    assert rename_category("Casa", "Hogar", user_id)[0]
+    assert_rollup_matches_rebuild(user_id)
+
+    # Eliminar una categoría en uso: sus transacciones conservan el nombre
+    assert save_categories([c for c in load_categories(user_id=user_id) if c != "Entretenimiento"], user_id=user_id)
+    assert_rollup_matches_rebuild(user_id)
+
+
+def test_empty_month_totals_are_numeric():
+    user_id = create_user("vacio")
+    start, end = datetime(2026, 10, 1), datetime(2026, 11, 1)
+    for moneda in (None, "PEN"):
+        totals = get_category_totals(user_id, start, end, moneda=moneda)
+        monthly = get_monthly_category_totals(user_id, start, end, moneda=moneda)
+        assert totals.empty and monthly.empty
+        assert totals["monto"].dtype == "float64" and totals["transacciones"].dtype == "int64"
+        assert monthly["monto"].dtype == "float64"
+
+    # Presupuesto vs gasto de un mes sin gastos (Gestionar Presupuestos)
+    budget = pd.DataFrame({"categoria": ["Casa"], "presupuesto": [200.0]}).merge(
+        totals[["categoria", "monto"]].rename(columns={"monto": "gastado"}), on="categoria", how="left"
+    ).fillna({"gastado": 0.0})
+    px.bar(budget, x="categoria", y=["presupuesto", "gastado"], barmode="group")
+
+
+if __name__ == "__main__":
+    test_schema_bootstrap_runs_once_per_process()
+    test_page_load_does_not_reflect_schema_or_reseed()
+    test_transaction_cache_is_invalidated_by_writes()
+    test_transaction_cache_evicts_least_recently_used()
+    test_transaction_cache_entries_expire()
+    test_category_and_account_caches_are_invalidated_by_writes()
+    test_dashboard_totals_are_converted_with_the_rate_in_force()
+    test_synced_emails_match_legacy_rows_without_bank()
+    test_rollup_write_paths_match_rebuild()
+    test_empty_month_totals_are_numeric()
+    print("OK")
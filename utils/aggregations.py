@@ -0,0 +1,536 @@
+from datetime import datetime
+import argparse
+import traceback
+import pandas as pd
+from sqlalchemy import select, func, distinct, delete, update, insert, case, or_, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from .database import SessionLocal, Transaction, Category, Merchant, MonthlyCategoryTotal, engine, open_session
+from .fx import BASE_CURRENCY, convert_amounts
+
+def _day_expr():
+    """Expresión SQL que trunca la fecha de la transacción al día"""
+    return func.date(Transaction.fecha)
+
+def _month_expr():
+    """Expresión SQL que trunca la fecha de la transacción al primer día del mes"""
+    if engine.dialect.name == 'postgresql':
+        return func.date_trunc('month', Transaction.fecha)
+    return func.strftime('%Y-%m-01', Transaction.fecha)
+
+def _is_month_start(value) -> bool:
+    """Indica si la fecha es el inicio exacto de un mes (o no hay límite)"""
+    if value is None:
+        return True
+    return value.day == 1 and value.hour == 0 and value.minute == 0 and value.second == 0 and value.microsecond == 0
+
+def _category_columns():
+    """
+    Columnas para agrupar por categoría: el id entero y, solo en las
+    transacciones sin categoría enlazada, el nombre registrado.
+    """
+    return (
+        Transaction.category_id,
+        case((Transaction.category_id.is_(None), Transaction.categoria)).label('categoria_libre')
+    )
+
+def category_filter(categorias: list, user_id: int = None):
+    """Condición SQL que selecciona las transacciones de las categorías indicadas por nombre"""
+    ids = select(Category.id).where(Category.categoria.in_(categorias))
+    if user_id is not None:
+        ids = ids.where(Category.user_id == user_id)
+    return or_(
+        Transaction.category_id.in_(ids),
+        and_(Transaction.category_id.is_(None), Transaction.categoria.in_(categorias))
+    )
+
+def category_names(user_id: int = None, db: Session = None) -> dict:
+    """Mapa id -> nombre vigente de las categorías de un usuario (o de todos)"""
+    db, owns_session = open_session(db)
+    try:
+        stmt = select(Category.id, Category.categoria)
+        if user_id is not None:
+            stmt = stmt.where(Category.user_id == user_id)
+        return dict(db.execute(stmt).all())
+    finally:
+        if owns_session:
+            db.close()
+
+def name_categories(df: pd.DataFrame, names: dict) -> pd.Series:
+    """Nombre de categoría para cada fila a partir de category_id, o del nombre registrado si no está enlazada"""
+    fallback = df['categoria_libre'] if 'categoria_libre' in df else df['categoria']
+    return df['category_id'].map(names).fillna(fallback).astype(object)
+
+# Tipos de las columnas de totales, también cuando el resultado no tiene filas
+# (un DataFrame vacío con columnas object no se puede graficar junto a floats)
+TOTAL_DTYPES = {'monto': 'float64', 'transacciones': 'int64'}
+
+def _typed_totals(df: pd.DataFrame) -> pd.DataFrame:
+    """Convierte monto y transacciones a sus tipos numéricos"""
+    return df.astype({column: dtype for column, dtype in TOTAL_DTYPES.items() if column in df.columns})
+
+def _totals_by_category_name(rows, columns: list, keys: list, values: list, names: dict) -> pd.DataFrame:
+    """
+    Convierte filas agrupadas por (category_id, categoria_libre) en filas
+    agrupadas por nombre de categoría, sumando si dos grupos comparten nombre.
+    """
+    df = pd.DataFrame(rows, columns=keys + ['category_id', 'categoria_libre'] + values)
+    df['categoria'] = name_categories(df, names)
+    return _typed_totals(df.groupby(keys + ['categoria'], as_index=False, sort=True)[values].sum()[columns])
+
+def _apply_filters(stmt, user_id: int = None, start: datetime = None, end: datetime = None, categoria: str = None):
+    """Aplica los filtros de usuario, rango de fechas [start, end) y categoría"""
+    if user_id is not None:
+        stmt = stmt.where(Transaction.user_id == user_id)
+    if start is not None:
+        stmt = stmt.where(Transaction.fecha >= start)
+    if end is not None:
+        stmt = stmt.where(Transaction.fecha < end)
+    if categoria is not None:
+        stmt = stmt.where(category_filter([categoria], user_id))
+    return stmt
+
+def _daily_totals_in_currency(db: Session, group_columns: list, keys: list, moneda: str,
+                              user_id: int = None, start: datetime = None, end: datetime = None,
+                              categoria: str = None, only_foreign: bool = False) -> pd.DataFrame:
+    """
+    Agrupa en SQL por día, moneda y las columnas indicadas, y convierte cada
+    grupo a la moneda de reporte con el tipo de cambio de su día. Retorna las
+    columnas dia + keys + monto + transacciones; los grupos sin tipo de
+    cambio quedan con monto NaN. Con only_foreign se omiten las
+    transacciones que ya están en la moneda de reporte.
+    """
+    day = _day_expr()
+    stmt = _apply_filters(
+        select(day, Transaction.moneda, *group_columns, func.sum(Transaction.monto), func.count(Transaction.id)),
+        user_id, start, end, categoria
+    )
+    if only_foreign:
+        stmt = stmt.where(func.coalesce(Transaction.moneda, BASE_CURRENCY) != moneda)
+    stmt = stmt.group_by(day, Transaction.moneda, *group_columns)
+    df = pd.DataFrame(db.execute(stmt).all(), columns=['dia', 'moneda'] + keys + ['monto', 'transacciones'])
+    df['dia'] = pd.to_datetime(df['dia'])
+    df['monto'] = convert_amounts(df, moneda, fecha_column='dia', db=db)
+    return df.drop(columns='moneda')
+
+def _monthly_totals_in_currency(db: Session, user_id: int, start: datetime, end: datetime,
+                                moneda: str) -> pd.DataFrame:
+    """
+    Totales por mes y categoría en la moneda de reporte para meses completos.
+    Los montos que ya están en esa moneda se leen de monthly_category_totals;
+    solo las transacciones en otras monedas se agrupan por día para
+    convertirlas con el tipo de cambio de su día.
+    """
+    columns = ['mes', 'categoria', 'monto', 'transacciones']
+    stmt = select(
+        MonthlyCategoryTotal.mes,
+        MonthlyCategoryTotal.categoria,
+        func.sum(MonthlyCategoryTotal.total),
+        func.sum(MonthlyCategoryTotal.transacciones)
+    ).where(MonthlyCategoryTotal.user_id == user_id, MonthlyCategoryTotal.moneda == moneda)
+    if start is not None:
+        stmt = stmt.where(MonthlyCategoryTotal.mes >= start)
+    if end is not None:
+        stmt = stmt.where(MonthlyCategoryTotal.mes < end)
+    stmt = stmt.group_by(MonthlyCategoryTotal.mes, MonthlyCategoryTotal.categoria)
+    same = pd.DataFrame(db.execute(stmt).all(), columns=columns)
+    same['mes'] = pd.to_datetime(same['mes'])
+
+    category = _category_columns()
+    foreign = _daily_totals_in_currency(db, list(category), ['category_id', 'categoria_libre'], moneda,
+                                        user_id, start, end, only_foreign=True).dropna(subset=['monto'])
+    if foreign.empty:
+        return same.sort_values(['mes', 'categoria'], ignore_index=True)
+    foreign['categoria'] = name_categories(foreign, category_names(user_id, db=db))
+    foreign['mes'] = foreign['dia'].dt.to_period('M').dt.to_timestamp()
+    return pd.concat([same, foreign[columns]], ignore_index=True)\
+        .groupby(['mes', 'categoria'], as_index=False, sort=True)[['monto', 'transacciones']].sum()[columns]
+
+def get_spending_summary(user_id: int, start: datetime = None, end: datetime = None,
+                         categoria: str = None, moneda: str = None, db: Session = None) -> dict:
+    """
+    Calcula en la base de datos el total gastado, la cantidad de
+    transacciones, los días con gastos y el promedio diario del período.
+    Con moneda, los montos se convierten a esa moneda y 'sin_tipo_cambio'
+    indica cuántas transacciones quedaron fuera por no tener tasa.
+    """
+    summary = {'total': 0.0, 'transacciones': 0, 'dias': 0, 'promedio_diario': 0.0, 'sin_tipo_cambio': 0}
+    db, owns_session = open_session(db)
+    try:
+        if moneda is not None:
+            df = _daily_totals_in_currency(db, [], [], moneda, user_id, start, end, categoria)
+            missing = df['monto'].isna()
+            total, days = float(df['monto'].sum()), int(df['dia'].nunique())
+            summary.update({
+                'total': total,
+                'transacciones': int(df['transacciones'].sum()),
+                'dias': days,
+                'promedio_diario': total / days if days else 0.0,
+                'sin_tipo_cambio': int(df.loc[missing, 'transacciones'].sum())
+            })
+            return summary
+
+        stmt = _apply_filters(
+            select(
+                func.coalesce(func.sum(Transaction.monto), 0.0),
+                func.count(Transaction.id),
+                func.count(distinct(_day_expr()))
+            ),
+            user_id, start, end, categoria
+        )
+        total, count, days = db.execute(stmt).one()
+        summary.update({
+            'total': float(total),
+            'transacciones': int(count),
+            'dias': int(days),
+            'promedio_diario': float(total) / days if days else 0.0
+        })
+        return summary
+    except Exception as e:
+        print(f"Error calculando resumen de gastos: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return summary
+    finally:
+        if owns_session:
+            db.close()
+
+def get_category_totals(user_id: int, start: datetime = None, end: datetime = None,
+                        moneda: str = None, db: Session = None) -> pd.DataFrame:
+    """
+    Suma de montos y cantidad de transacciones por categoría.
+    Si el período abarca meses completos se lee de monthly_category_totals
+    (costo proporcional a la cantidad de categorías); si no, se agrupa la
+    tabla de transacciones en SQL. Con moneda se agrupa además por día y
+    moneda para convertir cada grupo con el tipo de cambio de su día.
+    """
+    columns = ['categoria', 'monto', 'transacciones']
+    full_months = user_id is not None and _is_month_start(start) and _is_month_start(end)
+    if moneda is None and full_months:
+        return get_rollup_category_totals(user_id, start, end, db=db)
+
+    db, owns_session = open_session(db)
+    try:
+        category = _category_columns()
+        if moneda is not None and full_months:
+            df = _monthly_totals_in_currency(db, user_id, start, end, moneda)
+            return _typed_totals(df.groupby('categoria', as_index=False, sort=True)[['monto', 'transacciones']].sum()[columns])
+        if moneda is not None:
+            df = _daily_totals_in_currency(db, list(category), ['category_id', 'categoria_libre'],
+                                           moneda, user_id, start, end).dropna(subset=['monto'])
+            df['categoria'] = name_categories(df, category_names(user_id, db=db) if not df.empty else {})
+            return _typed_totals(df.groupby('categoria', as_index=False, sort=True)[['monto', 'transacciones']].sum()[columns])
+        stmt = _apply_filters(
+            select(*category, func.sum(Transaction.monto), func.count(Transaction.id)),
+            user_id, start, end
+        ).group_by(*category)
+        rows = db.execute(stmt).all()
+        names = category_names(user_id, db=db) if rows else {}
+        return _totals_by_category_name(rows, columns, [], ['monto', 'transacciones'], names)
+    except Exception as e:
+        print(f"Error calculando totales por categoría: {str(e)}")
+        db.rollback()
+        return _typed_totals(pd.DataFrame(columns=columns))
+    finally:
+        if owns_session:
+            db.close()
+
+def get_rollup_category_totals(user_id: int, start: datetime = None, end: datetime = None, db: Session = None) -> pd.DataFrame:
+    """Totales por categoría leídos de monthly_category_totals para los meses [start, end)"""
+    columns = ['categoria', 'monto', 'transacciones']
+    db, owns_session = open_session(db)
+    try:
+        stmt = select(
+            MonthlyCategoryTotal.categoria,
+            func.sum(MonthlyCategoryTotal.total),
+            func.sum(MonthlyCategoryTotal.transacciones)
+        ).where(MonthlyCategoryTotal.user_id == user_id)
+        if start is not None:
+            stmt = stmt.where(MonthlyCategoryTotal.mes >= start)
+        if end is not None:
+            stmt = stmt.where(MonthlyCategoryTotal.mes < end)
+        stmt = stmt.group_by(MonthlyCategoryTotal.categoria).order_by(MonthlyCategoryTotal.categoria)
+        return _typed_totals(pd.DataFrame(db.execute(stmt).all(), columns=columns))
+    except Exception as e:
+        print(f"Error leyendo totales mensuales: {str(e)}")
+        db.rollback()
+        return _typed_totals(pd.DataFrame(columns=columns))
+    finally:
+        if owns_session:
+            db.close()
+
+def get_daily_totals(user_id: int, start: datetime = None, end: datetime = None, db: Session = None) -> pd.DataFrame:
+    """Suma de montos y cantidad de transacciones por día (GROUP BY en SQL)"""
+    columns = ['dia', 'monto', 'transacciones']
+    db, owns_session = open_session(db)
+    try:
+        day = _day_expr()
+        stmt = _apply_filters(
+            select(day, func.sum(Transaction.monto), func.count(Transaction.id)),
+            user_id, start, end
+        ).group_by(day).order_by(day)
+        df = pd.DataFrame(db.execute(stmt).all(), columns=columns)
+        df['dia'] = pd.to_datetime(df['dia'])
+        return _typed_totals(df)
+    except Exception as e:
+        print(f"Error calculando totales diarios: {str(e)}")
+        db.rollback()
+        return _typed_totals(pd.DataFrame(columns=columns))
+    finally:
+        if owns_session:
+            db.close()
+
+def get_merchant_totals(user_id: int, start: datetime = None, end: datetime = None,
+                        limit: int = 10, moneda: str = None, db: Session = None) -> pd.DataFrame:
+    """
+    Comercios con mayor gasto en el período. Agrupa por merchant_id (entero)
+    y solo después une los nombres de los comercios del resultado. Con
+    moneda, los montos se convierten antes de elegir los mayores.
+    """
+    columns = ['comercio', 'monto', 'transacciones']
+    db, owns_session = open_session(db)
+    try:
+        if moneda is not None:
+            df = _daily_totals_in_currency(db, [Transaction.merchant_id], ['merchant_id'],
+                                           moneda, user_id, start, end).dropna(subset=['monto'])
+            top = df.groupby('merchant_id', dropna=False)[['monto', 'transacciones']].sum().nlargest(limit, 'monto')
+            ids = [int(merchant_id) for merchant_id in top.index.dropna()]
+            names = dict(db.execute(select(Merchant.id, Merchant.nombre).where(Merchant.id.in_(ids))).all()) if ids else {}
+            top.insert(0, 'comercio', top.index.map(lambda merchant_id: names.get(merchant_id, 'SIN COMERCIO')))
+            return _typed_totals(top.reset_index(drop=True)[columns])
+
+        total = func.sum(Transaction.monto).label('monto')
+        grouped = _apply_filters(
+            select(Transaction.merchant_id, total, func.count(Transaction.id).label('transacciones')),
+            user_id, start, end
+        ).group_by(Transaction.merchant_id).order_by(total.desc()).limit(limit).subquery()
+        stmt = select(
+            func.coalesce(Merchant.nombre, 'SIN COMERCIO'), grouped.c.monto, grouped.c.transacciones
+        ).outerjoin(Merchant, Merchant.id == grouped.c.merchant_id).order_by(grouped.c.monto.desc())
+        return _typed_totals(pd.DataFrame(db.execute(stmt).all(), columns=columns))
+    except Exception as e:
+        print(f"Error calculando totales por comercio: {str(e)}")
+        db.rollback()
+        return _typed_totals(pd.DataFrame(columns=columns))
+    finally:
+        if owns_session:
+            db.close()
+
+def get_monthly_category_totals(user_id: int, start: datetime = None, end: datetime = None,
+                                moneda: str = None, db: Session = None) -> pd.DataFrame:
+    """
+    Suma de montos y cantidad de transacciones por mes y categoría.
+    Con un período de meses completos se lee de monthly_category_totals;
+    si no, se agrupa la tabla de transacciones en SQL. Con moneda se
+    convierte por día antes de sumar cada mes.
+    """
+    columns = ['mes', 'categoria', 'monto', 'transacciones']
+    full_months = user_id is not None and _is_month_start(start) and _is_month_start(end)
+    db, owns_session = open_session(db)
+    try:
+        if moneda is not None and full_months:
+            df = _monthly_totals_in_currency(db, user_id, start, end, moneda)
+        elif moneda is not None:
+            category = _category_columns()
+            df = _daily_totals_in_currency(db, list(category), ['category_id', 'categoria_libre'],
+                                           moneda, user_id, start, end).dropna(subset=['monto'])
+            df['categoria'] = name_categories(df, category_names(user_id, db=db) if not df.empty else {})
+            df['mes'] = df['dia'].dt.to_period('M').dt.to_timestamp()
+            df = df.groupby(['mes', 'categoria'], as_index=False, sort=True)[['monto', 'transacciones']].sum()[columns]
+        elif full_months:
+            stmt = select(
+                MonthlyCategoryTotal.mes,
+                MonthlyCategoryTotal.categoria,
+                func.sum(MonthlyCategoryTotal.total),
+                func.sum(MonthlyCategoryTotal.transacciones)
+            ).where(MonthlyCategoryTotal.user_id == user_id)
+            if start is not None:
+                stmt = stmt.where(MonthlyCategoryTotal.mes >= start)
+            if end is not None:
+                stmt = stmt.where(MonthlyCategoryTotal.mes < end)
+            stmt = stmt.group_by(MonthlyCategoryTotal.mes, MonthlyCategoryTotal.categoria)\
+                .order_by(MonthlyCategoryTotal.mes, MonthlyCategoryTotal.categoria)
+            df = pd.DataFrame(db.execute(stmt).all(), columns=columns)
+        else:
+            month = _month_expr()
+            category = _category_columns()
+            stmt = _apply_filters(
+                select(month, *category, func.sum(Transaction.monto), func.count(Transaction.id)),
+                user_id, start, end
+            ).group_by(month, *category)
+            rows = db.execute(stmt).all()
+            names = category_names(user_id, db=db) if rows else {}
+            df = _totals_by_category_name(rows, columns, ['mes'], ['monto', 'transacciones'], names)
+        df['mes'] = pd.to_datetime(df['mes'])
+        return _typed_totals(df)
+    except Exception as e:
+        print(f"Error calculando totales mensuales por categoría: {str(e)}")
+        db.rollback()
+        return _typed_totals(pd.DataFrame(columns=columns))
+    finally:
+        if owns_session:
+            db.close()
+
+def month_start(fecha) -> datetime:
+    """Primer día del mes de la fecha dada"""
+    if isinstance(fecha, str):
+        fecha = pd.to_datetime(fecha)
+    if hasattr(fecha, 'to_pydatetime'):
+        fecha = fecha.to_pydatetime()
+    return datetime(fecha.year, fecha.month, 1)
+
+def rollup_delta(user_id: int, fecha, categoria: str, moneda: str, monto: float, sign: int = 1) -> dict:
+    """Construye el cambio a aplicar en monthly_category_totals por una transacción"""
+    return {
+        'user_id': user_id,
+        'mes': month_start(fecha),
+        'categoria': str(categoria),
+        'moneda': str(moneda or 'PEN'),
+        'total': sign * float(monto),
+        'transacciones': sign
+    }
+
+def _upsert_statement():
+    """INSERT ... ON CONFLICT DO UPDATE que suma los cambios al total existente"""
+    table = MonthlyCategoryTotal.__table__
+    dialect_insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.mes, table.c.categoria, table.c.moneda],
+        set_={
+            'total': table.c.total + stmt.excluded.total,
+            'transacciones': table.c.transacciones + stmt.excluded.transacciones
+        }
+    )
+
+def apply_monthly_deltas(conn, deltas: list) -> None:
+    """
+    Aplica cambios incrementales a monthly_category_totals usando la conexión
+    recibida, para que queden en la misma transacción que la escritura
+    que los origina.
+    """
+    merged = {}
+    for delta in deltas:
+        if delta['user_id'] is None:
+            continue
+        key = (delta['user_id'], delta['mes'], delta['categoria'], delta['moneda'])
+        if key in merged:
+            merged[key]['total'] += delta['total']
+            merged[key]['transacciones'] += delta['transacciones']
+        else:
+            merged[key] = dict(delta)
+    rows = [row for row in merged.values() if row['transacciones'] or row['total']]
+    if not rows:
+        return
+
+    table = MonthlyCategoryTotal.__table__
+    if engine.dialect.name in ('postgresql', 'sqlite'):
+        conn.execute(_upsert_statement(), rows)
+    else:
+        for row in rows:
+            key_filter = [
+                table.c.user_id == row['user_id'], table.c.mes == row['mes'],
+                table.c.categoria == row['categoria'], table.c.moneda == row['moneda']
+            ]
+            result = conn.execute(
+                update(table).where(*key_filter).values(
+                    total=table.c.total + row['total'],
+                    transacciones=table.c.transacciones + row['transacciones']
+                )
+            )
+            if result.rowcount == 0:
+                conn.execute(insert(table), row)
+
+    # Eliminar grupos que quedaron sin transacciones
+    conn.execute(
+        delete(table).where(
+            table.c.user_id.in_({row['user_id'] for row in rows}),
+            table.c.transacciones <= 0
+        )
+    )
+
+def monthly_deltas_from_frame(df: pd.DataFrame, sign: int = 1) -> list:
+    """Agrupa un DataFrame de transacciones en cambios para monthly_category_totals"""
+    if df.empty:
+        return []
+    grouped = df.assign(
+        mes=df['fecha'].dt.to_period('M').dt.to_timestamp(),
+        moneda=df['moneda'].fillna('PEN')
+    ).groupby(['user_id', 'mes', 'categoria', 'moneda'], observed=True)['monto'].agg(['sum', 'count'])
+    return [
+        {
+            'user_id': int(user_id),
+            'mes': mes.to_pydatetime(),
+            'categoria': str(categoria),
+            'moneda': str(moneda),
+            'total': sign * float(total),
+            'transacciones': sign * int(count)
+        }
+        for (user_id, mes, categoria, moneda), (total, count) in grouped.iterrows()
+    ]
+
+def rebuild_monthly_category_totals(user_id: int = None) -> bool:
+    """
+    Reconstruye monthly_category_totals a partir de la tabla de transacciones,
+    para todos los usuarios o solo para uno. Útil para reparar los totales.
+    """
+    print(f"\n=== Reconstruyendo totales mensuales (usuario: {user_id or 'todos'}) ===")
+    db = SessionLocal()
+    try:
+        month = _month_expr()
+        category = _category_columns()
+        stmt = select(
+            Transaction.user_id, month, Transaction.moneda, *category,
+            func.sum(Transaction.monto), func.count(Transaction.id)
+        ).where(Transaction.user_id.is_not(None))
+        if user_id is not None:
+            stmt = stmt.where(Transaction.user_id == user_id)
+        stmt = stmt.group_by(Transaction.user_id, month, Transaction.moneda, *category)
+
+        totals = _totals_by_category_name(
+            db.execute(stmt).all(),
+            ['user_id', 'mes', 'categoria', 'moneda', 'total', 'transacciones'],
+            ['user_id', 'mes', 'moneda'], ['total', 'transacciones'],
+            category_names(user_id, db=db)
+        )
+        rows = [
+            {
+                'user_id': int(uid),
+                'mes': month_start(mes),
+                'categoria': categoria,
+                'moneda': moneda,
+                'total': float(total),
+                'transacciones': int(count)
+            }
+            for uid, mes, categoria, moneda, total, count in totals.itertuples(index=False)
+        ]
+
+        table = MonthlyCategoryTotal.__table__
+        clear = delete(table)
+        if user_id is not None:
+            clear = clear.where(table.c.user_id == user_id)
+        db.execute(clear)
+        if rows:
+            db.execute(insert(table), rows)
+        db.commit()
+        print(f"Totales mensuales reconstruidos: {len(rows)} filas")
+        return True
+    except Exception as e:
+        print(f"Error reconstruyendo totales mensuales: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mantenimiento de totales mensuales por categoría")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: recalcula monthly_category_totals")
+    parser.add_argument("--user-id", type=int, default=None, help="Reconstruir solo para este usuario")
+    args = parser.parse_args()
+    if args.command == "rebuild":
+        # Crear o actualizar el esquema si la aplicación aún no se inició tras una actualización
+        from .database import init_db
+        init_db()
+        rebuild_monthly_category_totals(args.user_id)
@@ -1,8 +1,9 @@
 from datetime import datetime
-from .database import User, SessionLocal
+from sqlalchemy.orm import Session
+from .database import User, open_session
 from werkzeug.security import generate_password_hash, check_password_hash
 
-def register_user(email: str, username: str, password: str) -> tuple[bool, str]:
+def register_user(email: str, username: str, password: str, db: Session = None) -> tuple[bool, str]:
     """
     Registra un nuevo usuario en el sistema.
     Retorna (éxito, mensaje)
@@ -11,7 +12,7 @@ def register_user(email: str, username: str, password: str) -> tuple[bool, str]:
     print(f"Email: {email}")
     print(f"Username: {username}")
 
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         # Verificar si el email ya existe
         if db.query(User).filter(User.email == email).first():
@@ -50,9 +51,10 @@ def register_user(email: str, username: str, password: str) -> tuple[bool, str]:
         db.rollback()
         return False, f"Error en el registro: {str(e)}"
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def validate_login(email: str, password: str) -> tuple[bool, str, User | None]:
+def validate_login(email: str, password: str, db: Session = None) -> tuple[bool, str, User | None]:
     """
     Valida las credenciales de un usuario.
     Retorna (éxito, mensaje, usuario)
@@ -60,7 +62,7 @@ def validate_login(email: str, password: str) -> tuple[bool, str, User | None]:
     print(f"\n=== Validando login ===")
     print(f"Email: {email}")
 
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         print("Buscando usuario...")
         user = db.query(User).filter(User.email == email).first()
@@ -78,6 +80,8 @@ def validate_login(email: str, password: str) -> tuple[bool, str, User | None]:
 
     except Exception as e:
         print(f"Error en el login: {str(e)}")
+        db.rollback()
         return False, f"Error en el login: {str(e)}", None
     finally:
-        db.close()
\ No newline at end of file
+        if owns_session:
+            db.close()
\ No newline at end of file
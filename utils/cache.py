@@ -0,0 +1,76 @@
+"""
+Caché de Streamlit para lecturas frecuentes que cambian poco: categorías,
+presupuestos y datos de las cuentas de correo de cada usuario.
+
+Cada entrada se guarda bajo la versión actual del usuario; las funciones de
+escritura de data_manager y email_manager notifican los cambios y la versión
+sube, de modo que la siguiente lectura vuelve a consultar la base de datos.
+Las funciones cacheadas propagan los errores de base de datos para no
+guardar como válido un resultado vacío.
+Las contraseñas nunca pasan por la caché.
+"""
+import os
+import threading
+from datetime import datetime
+import streamlit as st
+from .data_manager import ensure_data_exists, fetch_categories, fetch_categories_with_budget, on_categories_changed
+from .email_manager import get_email_account_summaries, on_accounts_changed
+
+# Tiempo máximo en caché, por si otro proceso escribe en la misma base de datos
+CACHE_TTL = int(os.getenv("CACHE_TTL_SECONDS", "600"))
+CACHE_MAX_ENTRIES = 1000
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+def _version(kind: str, user_id: int) -> int:
+    return _versions.get((kind, user_id), 0)
+
+def _bump(kind: str, user_id: int):
+    with _versions_lock:
+        _versions[(kind, user_id)] = _versions.get((kind, user_id), 0) + 1
+
+@on_categories_changed
+def _invalidate_categories(user_id: int):
+    _bump('categorias', user_id)
+
+@on_accounts_changed
+def _invalidate_accounts(user_id: int):
+    _bump('cuentas', user_id)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _categories(user_id: int, version: int) -> list[str]:
+    return fetch_categories(user_id=user_id)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _categories_with_budget(fecha: datetime, user_id: int, version: int) -> list[tuple]:
+    return fetch_categories_with_budget(fecha, user_id=user_id)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, show_spinner=False)
+def _email_accounts(user_id: int, version: int) -> list[dict]:
+    return get_email_account_summaries(user_id)
+
+def cached_categories(user_id: int) -> list[str]:
+    """Nombres de las categorías del usuario (copia propia en cada llamada)"""
+    # Crear las categorías por defecto antes de leer la versión: si no, la
+    # primera entrada quedaría guardada con una versión ya superada
+    ensure_data_exists(user_id)
+    try:
+        return _categories(user_id, _version('categorias', user_id))
+    except Exception as e:
+        # El valor por defecto no se guarda en caché: se reintenta en la siguiente lectura
+        print(f"Error cargando categorías: {str(e)}")
+        return ["Sin Categorizar"]
+
+def cached_categories_with_budget(fecha: datetime, user_id: int) -> list[tuple]:
+    """Categorías con el presupuesto vigente en la fecha y sus notas"""
+    ensure_data_exists(user_id)
+    try:
+        return _categories_with_budget(fecha, user_id, _version('categorias', user_id))
+    except Exception as e:
+        print(f"Error cargando categorías: {str(e)}")
+        return []
+
+def cached_email_accounts(user_id: int) -> list[dict]:
+    """Cuentas de correo del usuario: id, email, bank_name, is_active, last_sync y marca de UIDs"""
+    return _email_accounts(user_id, _version('cuentas', user_id))
@@ -1,16 +1,55 @@
+from collections import OrderedDict
 from datetime import datetime
+import io
+import os
+import threading
+import time
 import traceback
-from .database import SessionLocal, Transaction, Category, BudgetHistory, init_db
+from sqlalchemy import select, update, delete, func, tuple_, bindparam, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from .database import (
+    Transaction, Category, BudgetHistory, MonthlyCategoryTotal, engine, init_db, open_session,
+    transaction_dedup_key, transaction_dedup_keys, merchant_ids
+)
+from .email_parser import normalize_merchant
+from .aggregations import (
+    apply_monthly_deltas, monthly_deltas_from_frame, rollup_delta,
+    category_filter, category_names, name_categories
+)
+import numpy as np
 import pandas as pd
 
-def ensure_data_exists(user_id: int = None):
+# Usuarios cuyas categorías por defecto ya fueron verificadas en este proceso
+_seeded_users = set()
+
+# Funciones que se llaman con el user_id cada vez que cambian las categorías
+# o presupuestos de un usuario (p. ej. para invalidar cachés de lectura)
+_category_listeners = []
+
+def on_categories_changed(callback):
+    """Registra una función a llamar con el user_id tras cada escritura de categorías o presupuestos"""
+    if callback not in _category_listeners:
+        _category_listeners.append(callback)
+    return callback
+
+def _categories_changed(user_id: int):
+    """Notifica a los suscriptores que las categorías del usuario cambiaron"""
+    for callback in _category_listeners:
+        callback(user_id)
+
+def ensure_data_exists(user_id: int = None, db: Session = None):
     """Asegura que la base de datos está inicializada con las categorías por defecto para un usuario"""
+    # Inicializar la base de datos si no existe (una vez por proceso)
+    init_db()
+    if user_id is None or user_id in _seeded_users:
+        return
+
     print("\n--- Verificando base de datos ---")
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
-        # Inicializar la base de datos si no existe
-        init_db()
-
         if user_id is not None:
             # Verificar si hay categorías para el usuario
             if db.query(Category).filter(Category.user_id == user_id).count() == 0:
@@ -43,103 +82,286 @@ def ensure_data_exists(user_id: int = None):
                     )
                     db.add(hist)
                 db.commit()
+                _categories_changed(user_id)
                 print("Categorías por defecto creadas")
+            _seeded_users.add(user_id)
     except Exception as e:
         print(f"Error verificando datos: {str(e)}")
         db.rollback()
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def load_categories_with_budget(fecha: datetime = None, user_id: int = None):
-    """Carga todas las categorías con sus presupuestos y notas para una fecha específica y usuario"""
-    ensure_data_exists(user_id)
+def _latest_budgets_subquery(fecha: datetime, user_id: int = None):
+    """
+    Subconsulta con el último registro de presupuesto de cada categoría a la
+    fecha dada. Usa DISTINCT ON en PostgreSQL y ROW_NUMBER() en otros motores.
+    """
+    filters = [BudgetHistory.fecha <= fecha]
+    if user_id is not None:
+        filters.append(BudgetHistory.category_id.in_(
+            select(Category.id).where(Category.user_id == user_id)
+        ))
+
+    if engine.dialect.name == 'postgresql':
+        return select(BudgetHistory.category_id, BudgetHistory.monto)\
+            .where(*filters)\
+            .distinct(BudgetHistory.category_id)\
+            .order_by(BudgetHistory.category_id, BudgetHistory.fecha.desc(), BudgetHistory.id.desc())\
+            .subquery()
+
+    ranked = select(
+        BudgetHistory.category_id,
+        BudgetHistory.monto,
+        func.row_number().over(
+            partition_by=BudgetHistory.category_id,
+            order_by=(BudgetHistory.fecha.desc(), BudgetHistory.id.desc())
+        ).label('rn')
+    ).where(*filters).subquery()
+    return select(ranked.c.category_id, ranked.c.monto).where(ranked.c.rn == 1).subquery()
+
+def fetch_categories_with_budget(fecha: datetime = None, user_id: int = None, db: Session = None) -> list[tuple]:
+    """
+    Categorías con el presupuesto vigente en la fecha y sus notas, en una
+    sola consulta. Propaga los errores de base de datos (para la caché).
+    """
     if fecha is None:
         fecha = datetime.now()
 
     print(f"\n=== Cargando categorías con presupuestos para {fecha} ===")
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
-        categories_with_budget = []
-        query = db.query(Category)
+        latest = _latest_budgets_subquery(fecha, user_id)
+        stmt = select(
+            Category.categoria,
+            func.coalesce(latest.c.monto, Category.presupuesto),
+            Category.notas
+        ).outerjoin(latest, latest.c.category_id == Category.id)
         if user_id is not None:
-            query = query.filter(Category.user_id == user_id)
-        categories = query.all()
-        print(f"Encontradas {len(categories)} categorías")
-
-        for cat in categories:
-            # Obtener el presupuesto más reciente antes o igual a la fecha dada
-            hist = db.query(BudgetHistory)\
-                    .filter(
-                        BudgetHistory.category_id == cat.id,
-                        BudgetHistory.fecha <= fecha
-                    )\
-                    .order_by(BudgetHistory.fecha.desc(), BudgetHistory.id.desc())\
-                    .first()
-
-            budget = hist.monto if hist else cat.presupuesto
-            categories_with_budget.append((cat.categoria, budget, cat.notas))
+            stmt = stmt.where(Category.user_id == user_id)
+        stmt = stmt.order_by(Category.id)
 
+        categories_with_budget = [tuple(row) for row in db.execute(stmt).all()]
+        print(f"Encontradas {len(categories_with_budget)} categorías")
         return categories_with_budget
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+def load_categories_with_budget(fecha: datetime = None, user_id: int = None, db: Session = None):
+    """
+    Carga todas las categorías con sus presupuestos y notas para una fecha
+    específica y usuario. Retorna una lista vacía si falla la consulta.
+    """
+    ensure_data_exists(user_id, db=db)
+    try:
+        return fetch_categories_with_budget(fecha, user_id=user_id, db=db)
     except Exception as e:
         print(f"Error cargando categorías: {str(e)}")
         print(traceback.format_exc())
         return []
+
+def load_budget_matrix(start: datetime, end: datetime, user_id: int = None, db: Session = None) -> pd.DataFrame:
+    """
+    Retorna una matriz categoría x mes con el presupuesto vigente al inicio
+    de cada mes en [start, end). Lee categorías e histórico en una sola
+    consulta y resuelve todos los meses con un merge_asof vectorizado.
+    """
+    ensure_data_exists(user_id, db=db)
+    months = pd.date_range(pd.Timestamp(start).to_period('M').to_timestamp(), end, freq='MS', inclusive='left')
+    print(f"\n=== Cargando matriz de presupuestos ({len(months)} meses) ===")
+
+    db, owns_session = open_session(db)
+    try:
+        stmt = select(
+            Category.id.label('category_id'),
+            Category.categoria,
+            Category.presupuesto,
+            BudgetHistory.id.label('hist_id'),
+            BudgetHistory.fecha,
+            BudgetHistory.monto
+        ).outerjoin(
+            BudgetHistory,
+            (BudgetHistory.category_id == Category.id) & (BudgetHistory.fecha < end)
+        )
+        if user_id is not None:
+            stmt = stmt.where(Category.user_id == user_id)
+        rows = pd.DataFrame(db.execute(stmt).all(),
+                            columns=['category_id', 'categoria', 'presupuesto', 'hist_id', 'fecha', 'monto'])
+    except Exception as e:
+        print(f"Error cargando matriz de presupuestos: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return pd.DataFrame(columns=months)
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def load_categories(user_id: int = None):
-    """Carga todas las categorías de un usuario específico"""
-    ensure_data_exists(user_id)
-    db = SessionLocal()
+    categories = rows.drop_duplicates('category_id')[['category_id', 'categoria', 'presupuesto']]
+    history = rows.dropna(subset=['fecha']).astype({'fecha': 'datetime64[ns]'})\
+        .sort_values(['fecha', 'hist_id'])[['category_id', 'fecha', 'monto']]
+
+    grid = categories.merge(pd.DataFrame({'mes': months.astype('datetime64[ns]')}), how='cross')\
+        .sort_values('mes')
+    grid = pd.merge_asof(grid, history, left_on='mes', right_on='fecha', by='category_id')
+    grid['monto'] = grid['monto'].fillna(grid['presupuesto']).fillna(0.0).astype('float64')
+
+    matrix = grid.pivot(index='categoria', columns='mes', values='monto')
+    # Conservar el orden de las categorías
+    matrix = matrix.reindex(categories.sort_values('category_id')['categoria'])
+    matrix.columns.name = None
+    return matrix
+
+def fetch_categories(user_id: int = None, db: Session = None) -> list[str]:
+    """Nombres de las categorías de un usuario. Propaga los errores de base de datos (para la caché)"""
+    db, owns_session = open_session(db)
     try:
         query = db.query(Category)
         if user_id is not None:
             query = query.filter(Category.user_id == user_id)
-        categories = query.all()
+        categories = query.order_by(Category.id).all()
         return [cat.categoria for cat in categories]
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+def load_categories(user_id: int = None, db: Session = None):
+    """Carga todas las categorías de un usuario específico"""
+    ensure_data_exists(user_id, db=db)
+    try:
+        return fetch_categories(user_id=user_id, db=db)
     except Exception as e:
         print(f"Error cargando categorías: {str(e)}")
         return ["Sin Categorizar"]
-    finally:
-        db.close()
 
-def save_categories(categories, user_id: int = None):
-    """Guarda las categorías para un usuario específico"""
-    db = SessionLocal()
+def _category_ids(user_id: int, db: Session) -> dict:
+    """Mapa nombre -> id de las categorías del usuario"""
+    if user_id is None:
+        return {}
+    return {name: category_id for category_id, name in category_names(user_id, db=db).items()}
+
+def save_categories(categories, user_id: int = None, db: Session = None):
+    """
+    Sincroniza las categorías de un usuario con la lista recibida.
+    Solo inserta las categorías nuevas y elimina las que ya no están (junto
+    con su historial de presupuestos); las demás conservan su id,
+    presupuesto, notas e historial.
+    """
+    db, owns_session = open_session(db)
     try:
-        # Obtener las categorías existentes con sus presupuestos y notas
-        query = db.query(Category)
+        query = select(Category.categoria, Category.id)
         if user_id is not None:
-            query = query.filter(Category.user_id == user_id)
-        existing_categories = {cat.categoria: (cat.presupuesto, cat.notas) 
-                             for cat in query.all()}
+            query = query.where(Category.user_id == user_id)
+        existing = dict(db.execute(query).all())
 
-        # Eliminar categorías existentes del usuario
-        if user_id is not None:
-            db.query(Category).filter(Category.user_id == user_id).delete()
-        else:
-            db.query(Category).delete()
-
-        # Agregar nuevas categorías manteniendo los presupuestos y notas existentes
-        for cat in categories:
-            presupuesto, notas = existing_categories.get(cat, (0.0, ""))
-            db.add(Category(
-                categoria=cat,
-                presupuesto=presupuesto,
-                notas=notas,
-                user_id=user_id
-            ))
+        wanted = list(dict.fromkeys(categories))
+        new_categories = [cat for cat in wanted if cat not in existing]
+        removed_ids = [category_id for cat, category_id in existing.items() if cat not in set(wanted)]
+
+        if removed_ids:
+            # Las transacciones conservan el nombre de la categoría eliminada
+            removed_names = {category_id: cat for cat, category_id in existing.items() if category_id in removed_ids}
+            db.execute(
+                update(Transaction)
+                .where(Transaction.category_id.in_(removed_ids))
+                .values(
+                    categoria=case(removed_names, value=Transaction.category_id),
+                    category_id=None
+                )
+            )
+            db.execute(delete(BudgetHistory).where(BudgetHistory.category_id.in_(removed_ids)))
+            db.execute(delete(Category).where(Category.id.in_(removed_ids)))
+
+        if new_categories:
+            table = Category.__table__
+            dialect_insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+            db.execute(
+                dialect_insert(table).on_conflict_do_nothing(
+                    index_elements=[table.c.user_id, table.c.categoria]
+                ),
+                [{'categoria': cat, 'presupuesto': 0.0, 'notas': "", 'user_id': user_id} for cat in new_categories]
+            )
+            if user_id is not None:
+                # Enlazar las transacciones que ya usaban esos nombres
+                ids = _category_ids(user_id, db)
+                db.execute(
+                    update(Transaction)
+                    .where(
+                        Transaction.user_id == user_id,
+                        Transaction.category_id.is_(None),
+                        Transaction.categoria.in_(new_categories)
+                    )
+                    .values(category_id=case({cat: ids[cat] for cat in new_categories}, value=Transaction.categoria))
+                )
 
         db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+        _categories_changed(user_id)
+        print(f"Categorías: {len(new_categories)} agregadas, {len(removed_ids)} eliminadas")
         return True
     except Exception as e:
         print(f"Error guardando categorías: {str(e)}")
         db.rollback()
         return False
     finally:
-        db.close()
+        if owns_session:
+            db.close()
+
+def rename_category(categoria: str, nuevo_nombre: str, user_id: int, db: Session = None) -> tuple[bool, str]:
+    """
+    Renombra una categoría del usuario. Las transacciones la referencian por
+    category_id, así que basta con actualizar su fila y mover los totales
+    mensuales al nuevo nombre. Retorna (éxito, mensaje)
+    """
+    nuevo_nombre = str(nuevo_nombre).strip()
+    if not nuevo_nombre:
+        return False, "El nombre no puede estar vacío"
 
-def save_transaction(transaction_data, user_id: int = None):
+    db, owns_session = open_session(db)
+    try:
+        ids = _category_ids(user_id, db)
+        if categoria not in ids:
+            return False, "No se encontró la categoría"
+        if nuevo_nombre in ids:
+            return False, "Ya existe una categoría con ese nombre"
+
+        db.execute(update(Category).where(Category.id == ids[categoria]).values(categoria=nuevo_nombre))
+
+        totals = db.execute(
+            select(MonthlyCategoryTotal.mes, MonthlyCategoryTotal.moneda,
+                   MonthlyCategoryTotal.total, MonthlyCategoryTotal.transacciones)
+            .where(MonthlyCategoryTotal.user_id == user_id, MonthlyCategoryTotal.categoria == categoria)
+        ).all()
+        deltas = []
+        for mes, moneda, total, transacciones in totals:
+            for nombre, sign in [(categoria, -1), (nuevo_nombre, 1)]:
+                deltas.append({
+                    'user_id': user_id, 'mes': mes, 'categoria': nombre, 'moneda': moneda,
+                    'total': sign * total, 'transacciones': sign * transacciones
+                })
+        apply_monthly_deltas(db.connection(), deltas)
+
+        db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+        _categories_changed(user_id)
+        print(f"Categoría renombrada: {categoria} -> {nuevo_nombre}")
+        return True, f"Categoría '{categoria}' renombrada a '{nuevo_nombre}'"
+    except Exception as e:
+        print(f"Error renombrando categoría: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return False, f"Error renombrando la categoría: {str(e)}"
+    finally:
+        if owns_session:
+            db.close()
+
+def save_transaction(transaction_data, user_id: int = None, db: Session = None):
     """Guarda una nueva transacción para un usuario específico"""
     print("\n=== INICIANDO GUARDADO DE TRANSACCIÓN ===")
     print(f"Datos recibidos: {transaction_data}")
@@ -150,73 +372,769 @@ def save_transaction(transaction_data, user_id: int = None):
             print(f"Error: Campo requerido faltante: {field}")
             return False
 
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         if isinstance(transaction_data['fecha'], str):
             transaction_data['fecha'] = pd.to_datetime(transaction_data['fecha'])
 
-        if is_duplicate_transaction(transaction_data, user_id):
+        if is_duplicate_transaction(transaction_data, user_id, db=db):
             print("Transacción duplicada. No se guardará.")
             return False
 
+        comercio = transaction_data.get('comercio') or normalize_merchant(transaction_data['descripcion'])
+
         new_transaction = Transaction(
             fecha=transaction_data['fecha'],
             monto=float(transaction_data['monto']),
             descripcion=str(transaction_data['descripcion']),
             categoria=str(transaction_data['categoria']),
+            category_id=_category_ids(user_id, db).get(str(transaction_data['categoria'])),
+            merchant_id=merchant_ids([comercio])[comercio],
             tipo=str(transaction_data.get('tipo', 'real')),
             moneda=str(transaction_data.get('moneda', 'PEN')),
-            user_id=user_id
+            banco=transaction_data.get('banco'),
+            user_id=user_id,
+            dedup_key=transaction_dedup_key(
+                user_id,
+                transaction_data['fecha'],
+                transaction_data['monto'],
+                transaction_data['descripcion'],
+                transaction_data.get('banco')
+            )
         )
 
         db.add(new_transaction)
+        db.flush()
+        apply_monthly_deltas(db.connection(), [rollup_delta(
+            user_id, new_transaction.fecha, new_transaction.categoria,
+            new_transaction.moneda, new_transaction.monto
+        )])
         db.commit()
+        TRANSACTION_CACHE.bump(user_id)
         print("Transacción guardada exitosamente")
         return True
 
+    except IntegrityError:
+        # Otra sincronización insertó la misma transacción primero
+        print("Transacción duplicada (índice único). No se guardará.")
+        db.rollback()
+        return False
     except Exception as e:
         print(f"Error guardando transacción: {str(e)}")
         print(traceback.format_exc())
         db.rollback()
         return False
     finally:
-        db.close()
+        if owns_session:
+            db.close()
+
+BULK_COLUMNS = ['fecha', 'monto', 'descripcion', 'categoria', 'category_id', 'merchant_id', 'tipo', 'moneda', 'banco', 'user_id', 'dedup_key']
+
+def save_transactions_bulk(transactions, user_id: int = None, db: Session = None) -> tuple[int, list]:
+    """
+    Guarda un lote de transacciones (lista de dicts o DataFrame) en una sola
+    transacción de base de datos. Valida y convierte los campos de forma
+    vectorizada y omite duplicados con una sola consulta.
+    Retorna (cantidad insertada, rechazos) donde cada rechazo es (índice, motivo)
+    """
+    if isinstance(transactions, pd.DataFrame):
+        df = transactions.reset_index(drop=True).copy()
+    else:
+        df = pd.DataFrame(list(transactions))
+    print(f"\n=== Guardado masivo de {len(df)} transacciones ===")
+    if df.empty:
+        return 0, []
+
+    required_fields = ['fecha', 'monto', 'descripcion', 'categoria']
+    missing = [field for field in required_fields if field not in df.columns]
+    if missing:
+        motivo = f"Campos requeridos faltantes: {', '.join(missing)}"
+        print(f"Error: {motivo}")
+        return 0, [(idx, motivo) for idx in range(len(df))]
+
+    # Conversión vectorizada de tipos
+    df['fecha'] = pd.to_datetime(df['fecha'], errors='coerce', format='mixed')
+    df['monto'] = pd.to_numeric(df['monto'], errors='coerce')
+    df['descripcion'] = df['descripcion'].where(df['descripcion'].notna(), '').astype(str).str.strip()
+    df['categoria'] = df['categoria'].where(df['categoria'].notna(), '').astype(str).str.strip()
+    df['tipo'] = df['tipo'].fillna('real').astype(str) if 'tipo' in df.columns else 'real'
+    df['moneda'] = df['moneda'].fillna('PEN').astype(str) if 'moneda' in df.columns else 'PEN'
+    if 'banco' not in df.columns:
+        df['banco'] = None
+    df['banco'] = df['banco'].astype(object).where(df['banco'].notna(), None)
+    df['user_id'] = user_id
+
+    motivos = pd.Series('', index=df.index)
+    motivos = motivos.mask(motivos.eq('') & df['fecha'].isna(), 'Fecha inválida')
+    motivos = motivos.mask(motivos.eq('') & (df['monto'].isna() | df['monto'].abs().eq(float('inf'))), 'Monto inválido')
+    motivos = motivos.mask(motivos.eq('') & df['descripcion'].eq(''), 'Descripción vacía')
+    motivos = motivos.mask(motivos.eq('') & df['categoria'].eq(''), 'Categoría vacía')
+
+    valid = motivos.eq('')
+    df['dedup_key'] = None
+    df.loc[valid, 'dedup_key'] = [
+        transaction_dedup_key(user_id, fecha, monto, descripcion, banco)
+        for fecha, monto, descripcion, banco in df.loc[valid, ['fecha', 'monto', 'descripcion', 'banco']].itertuples(index=False)
+    ]
+    motivos = motivos.mask(valid & df['dedup_key'].duplicated(), 'Duplicada dentro del lote')
+
+    db, owns_session = open_session(db)
+    try:
+        candidates = motivos.eq('')
+        if candidates.any():
+            # Las filas con banco se buscan también por su huella sin banco (filas antiguas)
+            with_bank = candidates & df['banco'].fillna('').astype(str).str.strip().ne('')
+            legacy_keys = pd.Series([
+                transaction_dedup_key(user_id, fecha, monto, descripcion)
+                for fecha, monto, descripcion in df.loc[with_bank, ['fecha', 'monto', 'descripcion']].itertuples(index=False)
+            ], index=df.index[with_bank], dtype=object)
+            existing_keys = set(db.execute(
+                select(Transaction.dedup_key).where(
+                    Transaction.dedup_key.in_(set(df.loc[candidates, 'dedup_key']) | set(legacy_keys))
+                )
+            ).scalars())
+            found = df['dedup_key'].isin(existing_keys) | legacy_keys.reindex(df.index).isin(existing_keys)
+            motivos = motivos.mask(candidates & found, 'Transacción duplicada')
+
+        df['category_id'] = df['categoria'].map(_category_ids(user_id, db)).astype('Int64')
+        # Comercios normalizados, resueltos a ids con la caché en proceso
+        if 'comercio' not in df.columns:
+            df['comercio'] = None
+        comercios = df['comercio'].where(
+            df['comercio'].notna() & df['comercio'].ne(''), df['descripcion'].map(normalize_merchant)
+        )
+        pendientes = comercios[motivos.eq('')].unique()
+        df['merchant_id'] = comercios.map(merchant_ids(pendientes) if len(pendientes) else {}).astype('Int64')
+        to_insert = df.loc[motivos.eq(''), BULK_COLUMNS]
+        if to_insert.empty:
+            rejects = [(idx, motivo) for idx, motivo in motivos.items() if motivo]
+            print(f"No hay transacciones nuevas para guardar. Rechazos: {len(rejects)}")
+            return 0, rejects
+
+        # En ambas rutas se ignoran las huellas que otra sincronización insertó
+        # mientras tanto: solo esas filas se rechazan, no el lote completo
+        conn = db.connection()
+        if conn.dialect.driver == 'psycopg2':
+            inserted_keys = _copy_transactions(conn, to_insert)
+        else:
+            records = to_insert.astype(object).where(to_insert.notna(), None).to_dict('records')
+            for record in records:
+                record['fecha'] = record['fecha'].to_pydatetime()
+            table = Transaction.__table__
+            dialect_insert = pg_insert if conn.dialect.name == 'postgresql' else sqlite_insert
+            stmt = dialect_insert(table).on_conflict_do_nothing(
+                index_elements=[table.c.dedup_key]
+            ).returning(table.c.dedup_key)
+            inserted_keys = set(conn.execute(stmt, records).scalars())
+        motivos = motivos.mask(
+            motivos.eq('') & ~df['dedup_key'].isin(inserted_keys),
+            'Transacción duplicada'
+        )
+
+        # Totales mensuales solo de las filas efectivamente insertadas
+        apply_monthly_deltas(conn, monthly_deltas_from_frame(df.loc[motivos.eq('')]))
+        db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+
+        rejects = [(idx, motivo) for idx, motivo in motivos.items() if motivo]
+        inserted = int(motivos.eq('').sum())
+        print(f"Transacciones insertadas: {inserted}, rechazadas: {len(rejects)}")
+        return inserted, rejects
+
+    except IntegrityError:
+        # Otra sincronización insertó alguna de las filas mientras tanto
+        print("Conflicto de duplicados durante el guardado masivo. No se guardó el lote.")
+        db.rollback()
+        return 0, [(idx, motivo or 'Conflicto de duplicados, reintente') for idx, motivo in motivos.items()]
+    except Exception as e:
+        print(f"Error en guardado masivo: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return 0, [(idx, motivo or f"Error guardando: {str(e)}") for idx, motivo in motivos.items()]
+    finally:
+        if owns_session:
+            db.close()
+
+def _copy_transactions(conn, df: pd.DataFrame) -> set:
+    """
+    Ruta rápida para PostgreSQL: carga el lote con COPY en una tabla temporal
+    y lo inserta ignorando conflictos de huella. Retorna las huellas insertadas.
+    """
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, date_format='%Y-%m-%d %H:%M:%S.%f')
+    buffer.seek(0)
+
+    columns = ', '.join(BULK_COLUMNS)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(
+            "CREATE TEMP TABLE tmp_transactions ("
+            "fecha timestamp, monto double precision, descripcion varchar, "
+            "categoria varchar, category_id integer, merchant_id integer, tipo varchar, moneda varchar, banco varchar, "
+            "user_id integer, dedup_key varchar(64)) ON COMMIT DROP"
+        )
+        cursor.copy_expert(f"COPY tmp_transactions ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.execute(
+            f"INSERT INTO transactions ({columns}) SELECT {columns} FROM tmp_transactions "
+            "ON CONFLICT (dedup_key) DO NOTHING RETURNING dedup_key"
+        )
+        return {row[0] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+TRANSACTION_COLUMNS = ['id', 'fecha', 'monto', 'descripcion', 'category_id', 'categoria', 'tipo', 'moneda']
+
+def _transactions_frame(rows=(), columns=TRANSACTION_COLUMNS, names: dict = None) -> pd.DataFrame:
+    """
+    Construye el DataFrame de transacciones con tipos columnares.
+    El nombre de la categoría se obtiene de category_id con el mapa names
+    (id -> nombre); sin mapa o sin enlace se usa el nombre registrado.
+    """
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    df['id'] = df['id'].astype('int64')
+    df['category_id'] = df['category_id'].astype('Int64')
+    if names:
+        df['categoria'] = name_categories(df, names)
+    df['fecha'] = pd.to_datetime(df['fecha']).astype('datetime64[ns]')
+    df['monto'] = df['monto'].astype('float64')
+    for column in ['categoria', 'tipo', 'moneda']:
+        df[column] = df[column].astype('category')
+    return compact_transactions_frame(df)
+
+def compact_transactions_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce la memoria del DataFrame de transacciones que cada sesión guarda:
+    ids en int32 si caben, montos en float32 solo si
+    todos vuelven exactos al redondear a céntimos, y descripciones como
+    categóricas cuando se repiten (mismo comercio). Los totales se calculan
+    en SQL, no sumando esta columna.
+    """
+    if len(df) and df['id'].max() < 2**31:
+        df['id'] = df['id'].astype('int32')
+    df['category_id'] = df['category_id'].astype('Int32')
+
+    monto = df['monto'].to_numpy()
+    monto32 = monto.astype('float32')
+    if np.array_equal(np.round(monto32.astype('float64'), 2), np.round(monto, 2)):
+        df['monto'] = monto32
 
-def load_transactions(user_id: int = None):
-    """Carga todas las transacciones de un usuario específico"""
-    ensure_data_exists(user_id)
-    db = SessionLocal()
+    if len(df) and df['descripcion'].nunique() <= len(df) // 2:
+        df['descripcion'] = df['descripcion'].astype('category')
+    return df
+
+def frame_memory_bytes(value) -> int:
+    """Memoria (profunda) de un DataFrame, o de los DataFrames de una lista/dict"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sum(frame_memory_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(frame_memory_bytes(item) for item in value)
+    return 0
+
+# Memoria de los DataFrames que guarda cada sesión de Streamlit: {session_id: (bytes, instante)}
+_session_memory = {}
+_session_memory_lock = threading.Lock()
+
+# Segundos sin actividad tras los que una sesión se considera cerrada
+SESSION_MEMORY_MAX_AGE = 3600
+
+def _prune_session_memory(now: float, max_age: int) -> None:
+    """Descarta las sesiones sin actividad en max_age segundos (llamar con el lock tomado)"""
+    for session_id in [sid for sid, (_, seen) in _session_memory.items() if now - seen > max_age]:
+        del _session_memory[session_id]
+
+def record_session_memory(session_id: str, state) -> int:
+    """Registra la memoria de los DataFrames del estado de una sesión y la retorna"""
+    size = frame_memory_bytes({key: state[key] for key in list(state.keys())})
+    now = time.time()
+    with _session_memory_lock:
+        _session_memory[session_id] = (size, now)
+        _prune_session_memory(now, SESSION_MEMORY_MAX_AGE)
+    return size
+
+def get_session_memory_metrics(max_age: int = SESSION_MEMORY_MAX_AGE) -> dict:
+    """
+    Resumen de la memoria por sesión en este proceso. Las sesiones sin
+    actividad en max_age segundos se consideran cerradas y se descartan.
+    """
+    with _session_memory_lock:
+        _prune_session_memory(time.time(), max_age)
+        sizes = [size for size, _ in _session_memory.values()]
+    return {
+        'sesiones': len(sizes),
+        'total_MB': round(sum(sizes) / 1e6, 3),
+        'promedio_MB': round(sum(sizes) / len(sizes) / 1e6, 3) if sizes else 0.0,
+        'max_MB': round(max(sizes) / 1e6, 3) if sizes else 0.0,
+    }
+
+def _filter_values(value):
+    """Normaliza un filtro que puede ser un valor o una lista de valores"""
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+def _transactions_query(user_id: int = None, start: datetime = None, end: datetime = None,
+                        categoria=None, moneda=None, banco=None):
+    """Consulta Core de las columnas de TRANSACTION_COLUMNS con los filtros aplicados"""
+    stmt = select(*[getattr(Transaction, column) for column in TRANSACTION_COLUMNS])
+    if user_id is not None:
+        stmt = stmt.where(Transaction.user_id == user_id)
+    if start is not None:
+        stmt = stmt.where(Transaction.fecha >= start)
+    if end is not None:
+        stmt = stmt.where(Transaction.fecha < end)
+    categorias = _filter_values(categoria)
+    if categorias is not None:
+        stmt = stmt.where(category_filter(categorias, user_id))
+    for column, value in [(Transaction.moneda, moneda),
+                          (Transaction.banco, banco)]:
+        values = _filter_values(value)
+        if values is not None:
+            stmt = stmt.where(column.in_(values))
+    return stmt
+
+def _linked_category_names(rows, user_id: int, db: Session) -> dict:
+    """Nombres vigentes de las categorías, solo si alguna fila está enlazada a una"""
+    if any(row.category_id is not None for row in rows):
+        return category_names(user_id, db=db)
+    return {}
+
+class TransactionCache:
+    """
+    Caché en proceso de los DataFrames de transacciones, por usuario y
+    filtros. Cada usuario tiene un contador de versión que las escrituras
+    de este módulo incrementan; un DataFrame guardado con una versión
+    anterior ya no se entrega. La memoria total se acota con desalojo LRU
+    entre todos los usuarios, y cada DataFrame caduca a los max_age_seconds
+    por si otro proceso escribe en la misma base de datos. Los DataFrames se
+    comparten entre sesiones: no deben modificarse.
+    """
+
+    def __init__(self, max_bytes: int, max_age_seconds: float = None):
+        self._lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self._versions = {}
+        self._frames = OrderedDict()  # (user_id, filtros) -> (versión, df, bytes, guardado_en)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, user_id: int) -> int:
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def bump(self, user_id: int) -> int:
+        """Marca como obsoletos los DataFrames del usuario (llamar tras confirmar una escritura)"""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            for key in [key for key in self._frames if key[0] == user_id]:
+                self._bytes -= self._frames.pop(key)[2]
+            return self._versions[user_id]
+
+    def get(self, user_id: int, filters: tuple):
+        with self._lock:
+            entry = self._frames.get((user_id, filters))
+            if entry is not None and self.max_age_seconds is not None and \
+                    time.monotonic() - entry[3] > self.max_age_seconds:
+                self._bytes -= self._frames.pop((user_id, filters))[2]
+                entry = None
+            if entry is None or entry[0] != self._versions.get(user_id, 0):
+                self.misses += 1
+                return None
+            self._frames.move_to_end((user_id, filters))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id: int, filters: tuple, version: int, df: pd.DataFrame) -> None:
+        """Guarda df si version (leída antes de consultar) sigue vigente"""
+        size = frame_memory_bytes(df)
+        with self._lock:
+            if version != self._versions.get(user_id, 0) or size > self.max_bytes:
+                return
+            old = self._frames.pop((user_id, filters), None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._frames[(user_id, filters)] = (version, df, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted, _) = self._frames.popitem(last=False)
+                self._bytes -= evicted
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entradas': len(self._frames),
+                'usuarios': len({key[0] for key in self._frames}),
+                'MB': round(self._bytes / 1e6, 3),
+                'max_MB': round(self.max_bytes / 1e6, 3),
+                'aciertos': self.hits,
+                'fallos': self.misses,
+                'desalojos': self.evictions,
+            }
+
+TRANSACTION_CACHE = TransactionCache(
+    max_bytes=int(float(os.getenv("TRANSACTION_CACHE_MB", "256")) * 1e6),
+    max_age_seconds=int(os.getenv("CACHE_TTL_SECONDS", "600"))
+)
+
+def _cache_filters(*values) -> tuple:
+    """Clave hashable para los filtros de load_transactions"""
+    return tuple(tuple(value) if isinstance(value, (list, tuple, set)) else value for value in values)
+
+def load_transactions(user_id: int = None, start: datetime = None, end: datetime = None,
+                      categoria=None, moneda=None, banco=None, db: Session = None):
+    """
+    Carga las transacciones de un usuario específico.
+    Los filtros opcionales se aplican en SQL: start (inclusive) y end
+    (exclusivo) acotan la fecha; categoria, moneda y banco aceptan un valor
+    o una lista de valores. Lee solo las columnas necesarias con una
+    consulta Core, sin construir objetos ORM intermedios.
+    Los resultados de un usuario se sirven desde TRANSACTION_CACHE mientras
+    no haya escrituras nuevas; el DataFrame devuelto no debe modificarse.
+    """
+    ensure_data_exists(user_id, db=db)
+    filters = _cache_filters(start, end, categoria, moneda, banco)
+    if user_id is not None:
+        cached = TRANSACTION_CACHE.get(user_id, filters)
+        if cached is not None:
+            return cached
+        version = TRANSACTION_CACHE.version(user_id)
+
+    db, owns_session = open_session(db)
     try:
         print("\n--- Cargando transacciones ---")
-        query = db.query(Transaction)
+        stmt = _transactions_query(user_id, start, end, categoria, moneda, banco)
+        rows = db.execute(stmt).all()
+        df = _transactions_frame(rows, names=_linked_category_names(rows, user_id, db))
+        print(f"Transacciones cargadas: {len(df)} registros")
         if user_id is not None:
-            query = query.filter(Transaction.user_id == user_id)
-        transactions = query.all()
-
-        if transactions:
-            data = [{
-                'fecha': t.fecha,
-                'monto': t.monto,
-                'descripcion': t.descripcion,
-                'categoria': t.categoria,
-                'tipo': t.tipo,
-                'moneda': t.moneda
-            } for t in transactions]
-            df = pd.DataFrame(data)
-            print(f"Transacciones cargadas: {len(df)} registros")
-            return df
-        return pd.DataFrame(columns=['fecha', 'monto', 'descripcion', 'categoria', 'tipo', 'moneda'])
+            TRANSACTION_CACHE.put(user_id, filters, version, df)
+        return df
 
     except Exception as e:
         print(f"Error cargando transacciones: {str(e)}")
         print(traceback.format_exc())
-        return pd.DataFrame(columns=['fecha', 'monto', 'descripcion', 'categoria', 'tipo', 'moneda'])
+        db.rollback()
+        return _transactions_frame()
+    finally:
+        if owns_session:
+            db.close()
+
+def load_transactions_page(user_id: int = None, start: datetime = None, end: datetime = None,
+                           categoria=None, page_size: int = 50, after: tuple = None,
+                           before: tuple = None, db: Session = None) -> tuple[pd.DataFrame, tuple, tuple]:
+    """
+    Carga una página de transacciones ordenadas de la más reciente a la más
+    antigua, usando paginación por clave (keyset) sobre (fecha, id).
+    after devuelve la página siguiente a ese cursor y before la anterior.
+    Retorna (df, cursor_anterior, cursor_siguiente); un cursor es None si
+    no hay más páginas en esa dirección.
+    """
+    db, owns_session = open_session(db)
+    try:
+        stmt = _transactions_query(user_id, start, end, categoria)
+        key = tuple_(Transaction.fecha, Transaction.id)
+        if before is not None:
+            # Página anterior: se recorre en orden ascendente y luego se invierte
+            stmt = stmt.where(key > tuple_(*before)).order_by(Transaction.fecha.asc(), Transaction.id.asc())
+        else:
+            if after is not None:
+                stmt = stmt.where(key < tuple_(*after))
+            stmt = stmt.order_by(Transaction.fecha.desc(), Transaction.id.desc())
+
+        # Se pide una fila extra para saber si existe otra página
+        rows = db.execute(stmt.limit(page_size + 1)).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if before is not None:
+            rows.reverse()
+
+        df = _transactions_frame(rows, names=_linked_category_names(rows, user_id, db))
+        if df.empty:
+            return df, None, None
+
+        first = (rows[0].fecha, rows[0].id)
+        last = (rows[-1].fecha, rows[-1].id)
+        if before is not None:
+            return df, first if has_more else None, last
+        return df, first if after is not None else None, last if has_more else None
+
+    except Exception as e:
+        print(f"Error cargando página de transacciones: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return _transactions_frame(), None, None
+    finally:
+        if owns_session:
+            db.close()
+
+def get_transaction_years(user_id: int = None, db: Session = None) -> list[int]:
+    """Obtiene los años con transacciones usando el rango de fechas del índice"""
+    db, owns_session = open_session(db)
+    try:
+        stmt = select(func.min(Transaction.fecha), func.max(Transaction.fecha))
+        if user_id is not None:
+            stmt = stmt.where(Transaction.user_id == user_id)
+        first, last = db.execute(stmt).one()
+        if first is None:
+            return []
+        return list(range(first.year, last.year + 1))
+    except Exception as e:
+        print(f"Error obteniendo años de transacciones: {str(e)}")
+        db.rollback()
+        return []
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def update_category_notes(categoria: str, notas: str, user_id: int = None):
+def update_transaction(transaction_id: int, user_id: int, fecha=None, monto: float = None,
+                       descripcion: str = None, categoria: str = None, db: Session = None) -> tuple[bool, str]:
+    """
+    Actualiza una transacción buscándola por su clave primaria.
+    Solo se modifican los campos recibidos. Retorna (éxito, mensaje)
+    """
+    db, owns_session = open_session(db)
+    try:
+        transaction = db.get(Transaction, transaction_id)
+        if transaction is None or transaction.user_id != user_id:
+            return False, "No se encontró la transacción"
+
+        names = category_names(user_id, db=db)
+        old_delta = rollup_delta(
+            transaction.user_id, transaction.fecha,
+            names.get(transaction.category_id, transaction.categoria),
+            transaction.moneda, transaction.monto, sign=-1
+        )
+        if fecha is not None:
+            transaction.fecha = pd.Timestamp(fecha).to_pydatetime()
+        if monto is not None:
+            transaction.monto = float(monto)
+        if descripcion is not None:
+            transaction.descripcion = str(descripcion)
+            comercio = normalize_merchant(transaction.descripcion)
+            transaction.merchant_id = merchant_ids([comercio])[comercio]
+        if categoria is not None:
+            transaction.categoria = str(categoria)
+            transaction.category_id = {name: category_id for category_id, name in names.items()}.get(transaction.categoria)
+        transaction.dedup_key = transaction_dedup_key(
+            transaction.user_id, transaction.fecha, transaction.monto,
+            transaction.descripcion, transaction.banco
+        )
+        db.flush()
+        apply_monthly_deltas(db.connection(), [old_delta, rollup_delta(
+            transaction.user_id, transaction.fecha,
+            names.get(transaction.category_id, transaction.categoria),
+            transaction.moneda, transaction.monto
+        )])
+        db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+        return True, "Transacción actualizada"
+    except IntegrityError:
+        db.rollback()
+        return False, "Ya existe una transacción con esos datos"
+    except Exception as e:
+        print(f"Error actualizando transacción: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return False, f"Error actualizando la transacción: {str(e)}"
+    finally:
+        if owns_session:
+            db.close()
+
+def delete_transactions(transaction_ids, user_id: int, db: Session = None) -> int:
+    """
+    Elimina en lote las transacciones indicadas por clave primaria.
+    Retorna la cantidad de transacciones eliminadas.
+    """
+    ids = [int(transaction_id) for transaction_id in transaction_ids]
+    if not ids:
+        return 0
+
+    db, owns_session = open_session(db)
+    try:
+        deleted = db.execute(
+            delete(Transaction)
+            .where(Transaction.id.in_(ids), Transaction.user_id == user_id)
+            .returning(Transaction.fecha, Transaction.category_id, Transaction.categoria,
+                       Transaction.moneda, Transaction.monto)
+        ).all()
+        names = _linked_category_names(deleted, user_id, db)
+        apply_monthly_deltas(db.connection(), [
+            rollup_delta(user_id, fecha, names.get(category_id, categoria), moneda, monto, sign=-1)
+            for fecha, category_id, categoria, moneda, monto in deleted
+        ])
+        db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+        print(f"Transacciones eliminadas: {len(deleted)}")
+        return len(deleted)
+    except Exception as e:
+        print(f"Error eliminando transacciones: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return 0
+    finally:
+        if owns_session:
+            db.close()
+
+# Columnas que se pueden modificar desde la edición en lote
+EDITABLE_COLUMNS = ['fecha', 'monto', 'descripcion', 'categoria']
+
+def diff_transactions(original: pd.DataFrame, edited: pd.DataFrame) -> tuple[list, list]:
+    """
+    Compara la tabla editada con la instantánea cargada, alineando por id.
+    Retorna (cambios, ids_eliminados); cada cambio es un dict con el id y
+    solo las columnas de EDITABLE_COLUMNS que cambiaron. Las filas nuevas
+    (sin id) no se incluyen: se obtienen con new_transaction_rows.
+    """
+    original = original.set_index('id')
+    edited = edited.dropna(subset=['id']).astype({'id': 'int64'}).set_index('id')
+
+    deleted_ids = [int(i) for i in original.index.difference(edited.index)]
+    common = original.index.intersection(edited.index)
+    # Montos comparados en céntimos (la instantánea puede estar en float32)
+    before = original.loc[common, EDITABLE_COLUMNS].astype({'monto': 'float64'}).round({'monto': 2}).astype(object)
+    after = edited.loc[common, EDITABLE_COLUMNS].astype({'monto': 'float64'}).round({'monto': 2}).astype(object)
+    changed = (before != after) & ~(before.isna() & after.isna())
+
+    changes = []
+    for transaction_id, row in changed[changed.any(axis=1)].iterrows():
+        change = {'id': int(transaction_id)}
+        change.update({column: after.at[transaction_id, column] for column in EDITABLE_COLUMNS if row[column]})
+        changes.append(change)
+    return changes, deleted_ids
+
+def new_transaction_rows(edited: pd.DataFrame) -> pd.DataFrame:
+    """Filas agregadas en la tabla editada (sin id), listas para save_transactions_bulk"""
+    columns = [column for column in EDITABLE_COLUMNS + ['moneda'] if column in edited.columns]
+    return edited.loc[edited['id'].isna(), columns].reset_index(drop=True)
+
+def apply_transaction_changes(changes: list, deleted_ids, user_id: int, db: Session = None) -> tuple[bool, str]:
+    """
+    Aplica en una sola transacción de base de datos los cambios de
+    diff_transactions: un UPDATE por lotes (executemany) para las filas
+    modificadas y un DELETE para las eliminadas, junto con el ajuste del
+    resumen mensual. Si algo falla no se aplica nada. Retorna (éxito, mensaje)
+    """
+    deleted_ids = {int(transaction_id) for transaction_id in deleted_ids}
+    changes = [change for change in changes if change['id'] not in deleted_ids]
+    if not changes and not deleted_ids:
+        return True, "No hay cambios para guardar"
+
+    db, owns_session = open_session(db)
+    try:
+        current = {
+            row.id: row for row in db.execute(
+                select(
+                    Transaction.id, Transaction.fecha, Transaction.monto, Transaction.descripcion,
+                    Transaction.category_id, Transaction.categoria, Transaction.merchant_id,
+                    Transaction.moneda, Transaction.banco
+                ).where(Transaction.id.in_([change['id'] for change in changes]), Transaction.user_id == user_id)
+            )
+        } if changes else {}
+
+        names = category_names(user_id, db=db)
+        ids = {name: category_id for category_id, name in names.items()}
+        comercios = merchant_ids({
+            normalize_merchant(change['descripcion']) for change in changes if 'descripcion' in change
+        })
+        deltas = []
+        params = []
+        for change in changes:
+            row = current.get(change['id'])
+            if row is None:
+                continue
+            old_categoria = names.get(row.category_id, row.categoria)
+            fecha = pd.Timestamp(change.get('fecha', row.fecha)).to_pydatetime()
+            monto = float(change.get('monto', row.monto))
+            descripcion = str(change.get('descripcion', row.descripcion))
+            categoria = str(change.get('categoria', old_categoria))
+            deltas.append(rollup_delta(user_id, row.fecha, old_categoria, row.moneda, row.monto, sign=-1))
+            deltas.append(rollup_delta(user_id, fecha, categoria, row.moneda, monto))
+            params.append({
+                'row_id': row.id,
+                'new_fecha': fecha,
+                'new_monto': monto,
+                'new_descripcion': descripcion,
+                'new_categoria': categoria,
+                'new_category_id': ids.get(categoria),
+                'new_merchant_id': comercios[normalize_merchant(descripcion)] if 'descripcion' in change else row.merchant_id,
+                'new_dedup_key': transaction_dedup_key(user_id, fecha, monto, descripcion, row.banco)
+            })
+
+        if params:
+            table = Transaction.__table__
+            db.execute(
+                update(table)
+                .where(table.c.id == bindparam('row_id'))
+                .values(
+                    fecha=bindparam('new_fecha'),
+                    monto=bindparam('new_monto'),
+                    descripcion=bindparam('new_descripcion'),
+                    categoria=bindparam('new_categoria'),
+                    category_id=bindparam('new_category_id'),
+                    merchant_id=bindparam('new_merchant_id'),
+                    dedup_key=bindparam('new_dedup_key')
+                ),
+                params
+            )
+
+        deleted = []
+        if deleted_ids:
+            deleted = db.execute(
+                delete(Transaction)
+                .where(Transaction.id.in_(list(deleted_ids)), Transaction.user_id == user_id)
+                .returning(Transaction.fecha, Transaction.category_id, Transaction.categoria,
+                           Transaction.moneda, Transaction.monto)
+            ).all()
+            deltas.extend(
+                rollup_delta(user_id, fecha, names.get(category_id, categoria), moneda, monto, sign=-1)
+                for fecha, category_id, categoria, moneda, monto in deleted
+            )
+
+        apply_monthly_deltas(db.connection(), deltas)
+        db.commit()
+        TRANSACTION_CACHE.bump(user_id)
+        print(f"Edición en lote: {len(params)} actualizadas, {len(deleted)} eliminadas")
+        return True, f"{len(params)} transacciones actualizadas, {len(deleted)} eliminadas"
+    except IntegrityError:
+        db.rollback()
+        return False, "Los cambios generan transacciones duplicadas; no se guardó nada"
+    except Exception as e:
+        print(f"Error aplicando cambios en lote: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        return False, f"Error guardando los cambios: {str(e)}"
+    finally:
+        if owns_session:
+            db.close()
+
+def apply_changes_to_frame(df: pd.DataFrame, changes: list, deleted_ids) -> None:
+    """
+    Refleja en el DataFrame en memoria (in place) los cambios ya guardados,
+    evitando volver a cargar las transacciones desde la base de datos.
+    """
+    positions = pd.Series(df.index, index=df['id'])
+    for change in changes:
+        if change['id'] not in positions.index:
+            continue
+        index = positions[change['id']]
+        for column, value in change.items():
+            if column == 'id':
+                continue
+            if isinstance(df[column].dtype, pd.CategoricalDtype) and value not in df[column].cat.categories:
+                df[column] = df[column].cat.add_categories([value])
+            df.at[index, column] = pd.Timestamp(value) if column == 'fecha' else value
+    df.drop(index=df.index[df['id'].isin(list(deleted_ids))], inplace=True)
+
+def update_category_notes(categoria: str, notas: str, user_id: int = None, db: Session = None):
     """Actualiza las notas de una categoría"""
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         # Construir la consulta base
         query = db.query(Category).filter(Category.categoria == categoria)
@@ -229,7 +1147,9 @@ def update_category_notes(categoria: str, notas: str, user_id: int = None):
 
         if category:
             category.notas = notas
+            owner_id = category.user_id
             db.commit()
+            _categories_changed(owner_id)
             return True
         return False
     except Exception as e:
@@ -237,9 +1157,10 @@ def update_category_notes(categoria: str, notas: str, user_id: int = None):
         db.rollback()
         return False
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def update_category_budget(categoria: str, presupuesto: float, user_id: int, fecha: datetime = None) -> bool:
+def update_category_budget(categoria: str, presupuesto: float, user_id: int, fecha: datetime = None, db: Session = None) -> bool:
     """Actualiza el presupuesto de una categoría y guarda el histórico"""
     if fecha is None:
         fecha = datetime.now()
@@ -249,7 +1170,7 @@ def update_category_budget(categoria: str, presupuesto: float, user_id: int, fec
     print(f"Fecha: {fecha}")
     print(f"User ID: {user_id}")
 
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         # Construir la consulta base
         query = db.query(Category).filter(Category.categoria == categoria)
@@ -273,6 +1194,7 @@ def update_category_budget(categoria: str, presupuesto: float, user_id: int, fec
             )
             db.add(hist)
             db.commit()
+            _categories_changed(user_id)
 
             print("Presupuesto actualizado exitosamente")
             print(f"Presupuesto en categoría: {category.presupuesto}")
@@ -287,11 +1209,12 @@ def update_category_budget(categoria: str, presupuesto: float, user_id: int, fec
         db.rollback()
         return False
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def get_budget_history(categoria: str = None):
+def get_budget_history(categoria: str = None, db: Session = None):
     """Obtiene el histórico de presupuestos para una o todas las categorías"""
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         query = db.query(
             Category.categoria,
@@ -308,28 +1231,86 @@ def get_budget_history(categoria: str = None):
         return [(r.categoria, r.fecha, r.monto) for r in results]
     except Exception as e:
         print(f"Error obteniendo histórico: {str(e)}")
+        db.rollback()
         return []
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def is_duplicate_transaction(transaction: dict, user_id: int) -> bool:
+def is_duplicate_transaction(transaction: dict, user_id: int, db: Session = None) -> bool:
     """Verifica si una transacción ya existe en la base de datos"""
     print("\n=== Verificando duplicados ===")
     print(f"Verificando transacción: {transaction}")
 
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
-        # Buscar transacciones con los mismos detalles
-        existing = db.query(Transaction).filter(
-            Transaction.user_id == user_id,
-            Transaction.fecha == transaction['fecha'],
-            Transaction.monto == transaction['monto'],
-            Transaction.descripcion == transaction['descripcion']
+        # Buscar por huella usando el índice único
+        keys = transaction_dedup_keys(
+            user_id,
+            transaction['fecha'],
+            transaction['monto'],
+            transaction['descripcion'],
+            transaction.get('banco')
+        )
+        existing = db.query(Transaction.id).filter(
+            Transaction.dedup_key.in_(keys)
         ).first()
 
         return existing is not None
     except Exception as e:
         print(f"Error verificando duplicados: {str(e)}")
+        db.rollback()
         return False
     finally:
-        db.close()
\ No newline at end of file
+        if owns_session:
+            db.close()
+
+def partition_duplicate_transactions(transactions: list, user_id: int, banco: str = None, db: Session = None) -> tuple[list, list]:
+    """
+    Separa las transacciones de una sincronización en nuevas y duplicadas.
+    Usa una sola consulta contra el índice único de huellas, sin importar
+    cuántas transacciones se reciban. Con banco, modifica los dicts
+    recibidos: completa t['banco'] en los que no lo traen, para que la
+    huella y el guardado posterior usen el mismo banco.
+    Retorna (nuevas, duplicadas)
+    """
+    print(f"\n=== Verificando duplicados en lote ({len(transactions)} transacciones) ===")
+    if not transactions:
+        return [], []
+
+    lookups = []
+    for t in transactions:
+        if banco is not None and not t.get('banco'):
+            t['banco'] = banco
+        lookups.append(transaction_dedup_keys(
+            user_id, t['fecha'], t['monto'], t['descripcion'], t.get('banco')
+        ))
+
+    db, owns_session = open_session(db)
+    try:
+        existing_keys = set(db.execute(
+            select(Transaction.dedup_key).where(
+                Transaction.dedup_key.in_({key for keys in lookups for key in keys})
+            )
+        ).scalars())
+    except Exception as e:
+        print(f"Error verificando duplicados: {str(e)}")
+        db.rollback()
+        existing_keys = set()
+    finally:
+        if owns_session:
+            db.close()
+
+    new_transactions, duplicates = [], []
+    seen = set()
+    for t, keys in zip(transactions, lookups):
+        key = keys[0]
+        # También se descartan correos repetidos dentro del mismo lote
+        if any(k in existing_keys for k in keys) or key in seen:
+            duplicates.append(t)
+        else:
+            seen.add(key)
+            new_transactions.append(t)
+
+    print(f"Nuevas: {len(new_transactions)}, duplicadas: {len(duplicates)}")
+    return new_transactions, duplicates
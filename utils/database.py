@@ -1,16 +1,137 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, MetaData, ForeignKey, Text, Boolean
+import hashlib
+import threading
+import time
+from sqlalchemy import event, exc, make_url, create_engine, Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Text, Boolean, Index, inspect, select, update, delete, func, bindparam
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
+from datetime import datetime, date
 from werkzeug.security import generate_password_hash, check_password_hash
+from .email_parser import normalize_merchant
 
 # Obtener la URL de la base de datos del entorno
 DATABASE_URL = os.getenv("DATABASE_URL")
-print(f"Inicializando base de datos con URL: {DATABASE_URL}")
 
-# Crear el motor de la base de datos con echo=True para ver las consultas SQL
-engine = create_engine(DATABASE_URL, echo=True)
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "si", "sí", "on")
+
+class PoolMetrics:
+    """Contadores del pool de conexiones (esperas, desbordes y timeouts)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.overflow_events = 0
+        self.timeouts = 0
+
+    def record_checkout(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def record_overflow(self):
+        with self._lock:
+            self.overflow_events += 1
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+POOL_METRICS = PoolMetrics()
+
+# Marca, por hilo, si el checkout en curso tuvo que abrir una conexión nueva
+_pool_checkout = threading.local()
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool que registra cuánto espera cada checkout en la cola del pool.
+    _do_get es el punto de extensión que implementan las subclases de Pool;
+    no incluye el pre-ping ni la reconexión de conexiones recicladas. Las
+    conexiones nuevas se detectan con el evento 'connect' (ver
+    create_db_engine): abrirlas no cuenta como espera, y si superan
+    pool_size cuentan como desborde.
+    """
+
+    def _do_get(self):
+        _pool_checkout.created = False
+        start = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            POOL_METRICS.record_timeout()
+            raise
+        if _pool_checkout.created:
+            # Con cupo para abrir una conexión la cola no bloquea: no hubo espera
+            POOL_METRICS.record_checkout(0.0)
+            if self.overflow() > 0:
+                POOL_METRICS.record_overflow()
+        else:
+            POOL_METRICS.record_checkout(time.perf_counter() - start)
+        return record
+
+def create_db_engine(url: str = None):
+    """
+    Crea el motor de la base de datos a partir de variables de entorno:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT_MS y DB_ECHO.
+    """
+    url = make_url(url or DATABASE_URL)
+    options = {'echo': _env_bool("DB_ECHO", False)}
+
+    if url.get_backend_name() != 'sqlite':
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': _env_int("DB_POOL_SIZE", 5),
+            'max_overflow': _env_int("DB_MAX_OVERFLOW", 10),
+            'pool_timeout': _env_int("DB_POOL_TIMEOUT", 30),
+            'pool_recycle': _env_int("DB_POOL_RECYCLE", 1800),
+            'pool_pre_ping': _env_bool("DB_POOL_PRE_PING", True),
+        })
+        statement_timeout = _env_int("DB_STATEMENT_TIMEOUT_MS", 0)
+        if statement_timeout and url.get_backend_name() == 'postgresql':
+            options['connect_args'] = {'options': f"-c statement_timeout={statement_timeout}"}
+
+    print(f"Inicializando base de datos con URL: {url.render_as_string(hide_password=True)}")
+    db_engine = create_engine(url, **options)
+
+    if isinstance(db_engine.pool, InstrumentedQueuePool):
+        @event.listens_for(db_engine.pool, 'connect')
+        def _mark_new_connection(dbapi_connection, connection_record):
+            # Se dispara en el mismo hilo del checkout; también al reconectar, fuera de _do_get
+            _pool_checkout.created = True
+
+    return db_engine
+
+def get_pool_metrics() -> dict:
+    """Estado actual del pool y métricas acumuladas, para dimensionarlo"""
+    pool = engine.pool
+    metrics = {
+        'pool_size': pool.size() if hasattr(pool, 'size') else None,
+        'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+        'overflow': max(pool.overflow(), 0) if hasattr(pool, 'overflow') else None,
+        'checkouts': POOL_METRICS.checkouts,
+        'avg_wait_ms': 1000 * POOL_METRICS.total_wait / POOL_METRICS.checkouts if POOL_METRICS.checkouts else 0.0,
+        'max_wait_ms': 1000 * POOL_METRICS.max_wait,
+        'overflow_events': POOL_METRICS.overflow_events,
+        'timeouts': POOL_METRICS.timeouts,
+    }
+    return metrics
+
+# Crear el motor de la base de datos (echo desactivado por defecto, ver DB_ECHO)
+engine = create_db_engine()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # Crear la base para los modelos
@@ -42,6 +163,9 @@ class EmailAccount(Base):
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_sync = Column(DateTime, nullable=True)
+    # Marca de sincronización incremental: UIDVALIDITY de INBOX y último UID procesado
+    uid_validity = Column(BigInteger, nullable=True)
+    last_uid = Column(BigInteger, nullable=True)
     user_id = Column(Integer, ForeignKey('users.id'))
 
     user = relationship("User", back_populates="email_accounts")
@@ -53,14 +177,103 @@ class Transaction(Base):
     fecha = Column(DateTime, nullable=False)
     monto = Column(Float, nullable=False)
     descripcion = Column(String, nullable=False)
+    # Nombre de la categoría al registrar la transacción; la categoría vigente
+    # es category_id (este nombre solo se usa si la referencia es nula)
     categoria = Column(String, nullable=False)
+    category_id = Column(Integer, ForeignKey('categories.id'), nullable=True)
+    # Comercio normalizado (ver normalize_merchant); descripcion conserva el texto original
+    merchant_id = Column(Integer, ForeignKey('merchants.id'), nullable=True)
     tipo = Column(String, nullable=False)
     moneda = Column(String, nullable=False, default='PEN')
     banco = Column(String, nullable=True)
     user_id = Column(Integer, ForeignKey('users.id'))
+    # Huella para detectar duplicados (ver transaction_dedup_key)
+    dedup_key = Column(String(64), nullable=True)
 
     user = relationship("User", back_populates="transactions")
 
+    __table_args__ = (
+        Index('ix_transactions_user_fecha_id', 'user_id', 'fecha', 'id'),
+        Index('ux_transactions_dedup_key', 'dedup_key', unique=True),
+        Index('ix_transactions_user_category', 'user_id', 'category_id'),
+        Index('ix_transactions_user_merchant', 'user_id', 'merchant_id'),
+    )
+
+def transaction_dedup_key(user_id, fecha, monto, descripcion, banco=None) -> str:
+    """
+    Calcula la huella de una transacción a partir de usuario, fecha, monto,
+    comercio y banco de origen. Dos transacciones con la misma huella se
+    consideran duplicadas.
+    """
+    if isinstance(fecha, str):
+        fecha = datetime.fromisoformat(fecha)
+    elif isinstance(fecha, date) and not isinstance(fecha, datetime):
+        fecha = datetime.combine(fecha, datetime.min.time())
+    if hasattr(fecha, 'to_pydatetime'):
+        fecha = fecha.to_pydatetime()
+
+    partes = [
+        str(user_id if user_id is not None else ''),
+        fecha.replace(tzinfo=None).isoformat(timespec='seconds'),
+        f"{round(float(monto), 2):.2f}",
+        ' '.join(str(descripcion).split()).upper(),
+        str(banco or '').strip().upper()
+    ]
+    return hashlib.sha256('|'.join(partes).encode('utf-8')).hexdigest()
+
+def transaction_dedup_keys(user_id, fecha, monto, descripcion, banco=None) -> list[str]:
+    """
+    Huellas con las que se busca si una transacción ya existe: la propia y,
+    si trae banco, también la calculada sin banco. Las filas guardadas antes
+    de registrar el banco tienen la huella sin él y deben seguir detectándose.
+    """
+    keys = [transaction_dedup_key(user_id, fecha, monto, descripcion, banco)]
+    if str(banco or '').strip():
+        keys.append(transaction_dedup_key(user_id, fecha, monto, descripcion))
+    return keys
+
+class Merchant(Base):
+    __tablename__ = "merchants"
+
+    id = Column(Integer, primary_key=True)
+    nombre = Column(String, nullable=False, unique=True)
+
+# Caché en proceso nombre normalizado -> id de merchants (los ids no cambian)
+_merchant_cache = {}
+_merchant_cache_lock = threading.Lock()
+MERCHANT_CACHE_SIZE = _env_int("MERCHANT_CACHE_SIZE", 50000)
+
+def merchant_ids(nombres) -> dict:
+    """
+    Resuelve nombres normalizados de comercio a ids de merchants, creando los
+    que no existen. Consulta primero la caché en proceso; los nombres que
+    faltan se insertan y buscan por lote en una transacción propia, ya
+    confirmada, para que la caché nunca guarde ids de un rollback.
+    Llamar antes de iniciar escrituras en la sesión (SQLite bloquea la base).
+    """
+    nombres = set(nombres)
+    with _merchant_cache_lock:
+        ids = {nombre: _merchant_cache[nombre] for nombre in nombres if nombre in _merchant_cache}
+    missing = nombres - set(ids)
+    if not missing:
+        return ids
+
+    table = Merchant.__table__
+    dialect_insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+    with engine.begin() as conn:
+        conn.execute(
+            dialect_insert(table).on_conflict_do_nothing(index_elements=[table.c.nombre]),
+            [{'nombre': nombre} for nombre in sorted(missing)]
+        )
+        found = dict(conn.execute(select(table.c.nombre, table.c.id).where(table.c.nombre.in_(missing))).all())
+    ids.update(found)
+
+    with _merchant_cache_lock:
+        if len(_merchant_cache) + len(found) > MERCHANT_CACHE_SIZE:
+            _merchant_cache.clear()
+        _merchant_cache.update(found)
+    return ids
+
 class Category(Base):
     __tablename__ = "categories"
 
@@ -73,6 +286,10 @@ class Category(Base):
 
     user = relationship("User", back_populates="categories")
 
+    __table_args__ = (
+        Index('ux_categories_user_categoria', 'user_id', 'categoria', unique=True),
+    )
+
 class BudgetHistory(Base):
     __tablename__ = "budget_history"
 
@@ -82,26 +299,239 @@ class BudgetHistory(Base):
     monto = Column(Float, nullable=False)
     category = relationship("Category", back_populates="presupuestos")
 
-def init_db():
-    """Initialize the database by creating all tables"""
-    try:
-        print("\n=== Inicializando Base de Datos ===")
-
-        # Intentar crear las tablas sin eliminar las existentes primero
-        print("Creando tablas si no existen...")
-        Base.metadata.create_all(bind=engine)
+# Índice para resolver el presupuesto vigente de cada categoría a una fecha
+Index(
+    'ix_budget_history_category_fecha',
+    BudgetHistory.category_id,
+    BudgetHistory.fecha.desc(),
+    BudgetHistory.id.desc()
+)
+
+class MonthlyCategoryTotal(Base):
+    """Totales mensuales por categoría y moneda, mantenidos de forma incremental"""
+    __tablename__ = "monthly_category_totals"
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    mes = Column(DateTime, primary_key=True)
+    categoria = Column(String, primary_key=True)
+    moneda = Column(String, primary_key=True)
+    total = Column(Float, nullable=False, default=0.0)
+    transacciones = Column(Integer, nullable=False, default=0)
+
+class FxRate(Base):
+    """Tipo de cambio: valor en la moneda base (PEN) de una unidad de la moneda, desde la fecha"""
+    __tablename__ = "fx_rates"
+
+    moneda = Column(String, primary_key=True)
+    fecha = Column(DateTime, primary_key=True)
+    tasa = Column(Float, nullable=False)
+
+# Estado del arranque del esquema (una vez por proceso)
+_db_initialized = False
+_init_lock = threading.Lock()
+
+def init_db(force: bool = False):
+    """
+    Initialize the database by creating all tables.
+    Se ejecuta una sola vez por proceso; las llamadas siguientes retornan
+    de inmediato salvo que se use force=True.
+    """
+    global _db_initialized
+    if _db_initialized and not force:
+        return True
 
-        # Verificar las tablas creadas
-        inspector = MetaData()
-        inspector.reflect(bind=engine)
-        print("\nTablas en la base de datos:")
-        for table in inspector.tables:
-            print(f"- {table}")
+    with _init_lock:
+        if _db_initialized and not force:
+            return True
+        try:
+            print("\n=== Inicializando Base de Datos ===")
+
+            # Intentar crear las tablas sin eliminar las existentes primero
+            print("Creando tablas si no existen...")
+            rollup_exists = inspect(engine).has_table(MonthlyCategoryTotal.__tablename__)
+            Base.metadata.create_all(bind=engine)
+
+            # Actualizar tablas que ya existían (columnas e índices nuevos)
+            upgrade_schema()
+
+            # Tipos de cambio desde el CSV configurado, si hay uno
+            if os.getenv("FX_RATES_CSV"):
+                from .fx import import_fx_rates
+                import_fx_rates(os.getenv("FX_RATES_CSV"))
+
+            # Poblar los totales mensuales la primera vez que se crea la tabla
+            if not rollup_exists:
+                from .aggregations import rebuild_monthly_category_totals
+                rebuild_monthly_category_totals()
+
+            # Verificar las tablas creadas
+            print("\nTablas en la base de datos:")
+            for table in inspect(engine).get_table_names():
+                print(f"- {table}")
+
+            _db_initialized = True
+            return True
+        except Exception as e:
+            print(f"\nError crítico al inicializar la base de datos: {str(e)}")
+            return False
+
+def upgrade_schema():
+    """
+    Agrega a las tablas existentes las columnas e índices definidos en los
+    modelos que aún no existen. create_all solo crea tablas nuevas.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+        with engine.begin() as conn:
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    print(f"Agregando columna {table.name}.{column.name}")
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    references = ''.join(
+                        f" REFERENCES {fk.column.table.name}({fk.column.name})"
+                        for fk in column.foreign_keys
+                    )
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{references}"
+                    )
+
+        if table.name == Transaction.__tablename__:
+            backfill_dedup_keys()
+            backfill_category_ids()
+            backfill_merchant_ids()
+
+        existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        if table.name == Category.__tablename__ and 'ux_categories_user_categoria' not in existing_indexes:
+            merge_duplicate_categories()
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                print(f"Creando índice {index.name}")
+                index.create(bind=engine)
+
+def merge_duplicate_categories():
+    """
+    Fusiona las categorías repetidas de un usuario (mismo nombre) antes de
+    crear el índice único: conserva la de menor id y le reasigna el
+    historial de presupuestos de las demás.
+    """
+    with engine.begin() as conn:
+        duplicated = conn.execute(
+            select(Category.user_id, Category.categoria, func.min(Category.id))
+            .group_by(Category.user_id, Category.categoria)
+            .having(func.count(Category.id) > 1)
+        ).all()
+        for user_id, categoria, keep_id in duplicated:
+            duplicate_ids = conn.execute(
+                select(Category.id).where(
+                    Category.user_id == user_id,
+                    Category.categoria == categoria,
+                    Category.id != keep_id
+                )
+            ).scalars().all()
+            conn.execute(
+                update(BudgetHistory)
+                .where(BudgetHistory.category_id.in_(duplicate_ids))
+                .values(category_id=keep_id)
+            )
+            conn.execute(delete(Category).where(Category.id.in_(duplicate_ids)))
+        if duplicated:
+            print(f"Categorías duplicadas fusionadas: {len(duplicated)}")
+
+def backfill_category_ids():
+    """
+    Enlaza las transacciones sin category_id con la categoría del mismo
+    usuario cuyo nombre coincide. Las que no tienen categoría equivalente
+    quedan sin referencia y se muestran con su nombre original.
+    """
+    transactions = Transaction.__table__
+    categories = Category.__table__
+    match = select(categories.c.id).where(
+        categories.c.user_id == transactions.c.user_id,
+        categories.c.categoria == transactions.c.categoria
+    ).scalar_subquery()
+    with engine.begin() as conn:
+        result = conn.execute(
+            update(transactions)
+            .where(transactions.c.category_id.is_(None), match.is_not(None))
+            .values(category_id=match)
+        )
+        if result.rowcount:
+            print(f"Categorías enlazadas para {result.rowcount} transacciones")
+
+def backfill_merchant_ids():
+    """Crea los comercios de las transacciones que aún no tienen merchant_id y las enlaza"""
+    with engine.connect() as conn:
+        descripciones = conn.execute(
+            select(Transaction.descripcion).where(Transaction.merchant_id.is_(None)).distinct()
+        ).scalars().all()
+    if not descripciones:
+        return
+
+    nombres = {descripcion: normalize_merchant(descripcion) for descripcion in descripciones}
+    ids = merchant_ids(nombres.values())
+    with engine.begin() as conn:
+        table = Transaction.__table__
+        conn.execute(
+            update(table)
+            .where(table.c.merchant_id.is_(None), table.c.descripcion == bindparam('b_descripcion'))
+            .values(merchant_id=bindparam('b_merchant_id')),
+            [{'b_descripcion': descripcion, 'b_merchant_id': ids[nombre]} for descripcion, nombre in nombres.items()]
+        )
+        print(f"Comercios enlazados: {len(set(nombres.values()))} para {len(descripciones)} descripciones")
+
+def backfill_dedup_keys():
+    """Calcula la huella de las transacciones que aún no la tienen"""
+    with engine.begin() as conn:
+        pending = conn.execute(
+            select(
+                Transaction.id, Transaction.user_id, Transaction.fecha,
+                Transaction.monto, Transaction.descripcion, Transaction.banco
+            ).where(Transaction.dedup_key.is_(None))
+        ).all()
+        if not pending:
+            return
+
+        used_keys = set(conn.execute(
+            select(Transaction.dedup_key).where(Transaction.dedup_key.is_not(None))
+        ).scalars())
+
+        updates = []
+        for row in pending:
+            key = transaction_dedup_key(row.user_id, row.fecha, row.monto, row.descripcion, row.banco)
+            # Los duplicados históricos se conservan sin huella
+            if key in used_keys:
+                continue
+            used_keys.add(key)
+            updates.append({'row_id': row.id, 'key': key})
+
+        if updates:
+            conn.execute(
+                update(Transaction.__table__)
+                .where(Transaction.__table__.c.id == bindparam('row_id'))
+                .values(dedup_key=bindparam('key')),
+                updates
+            )
+        print(f"Huellas calculadas para {len(updates)} de {len(pending)} transacciones")
+
+def open_session(db=None):
+    """
+    Retorna la sesión de la unidad de trabajo recibida o, si no hay, una
+    sesión nueva. El segundo valor indica si quien llama debe cerrarla.
+    """
+    if db is not None:
+        return db, False
+    return SessionLocal(), True
 
-        return True
-    except Exception as e:
-        print(f"\nError crítico al inicializar la base de datos: {str(e)}")
-        return False
+def open_request_session():
+    """
+    Abre la sesión de la unidad de trabajo de una ejecución del script.
+    No expira los objetos al hacer commit para reutilizar el identity map.
+    """
+    return SessionLocal(expire_on_commit=False)
 
 # Obtener una sesión de la base de datos
 def get_db():
@@ -132,22 +562,15 @@ def migrate_csv_to_sql():
                 category = Category(categoria=row['categoria'])
                 db.merge(category)
 
-        # Migrar transacciones
+        # Migrar transacciones en un solo lote
         csv_path = Path("data/transactions.csv")
         if csv_path.exists():
+            from .data_manager import save_transactions_bulk
             transactions_df = pd.read_csv(csv_path)
-            for _, row in transactions_df.iterrows():
-                transaction = Transaction(
-                    fecha=pd.to_datetime(row['fecha']),
-                    monto=float(row['monto']),
-                    descripcion=str(row['descripcion']),
-                    categoria=str(row['categoria']),
-                    tipo=str(row['tipo']),
-                    moneda = str(row.get('moneda', 'PEN')), # Handle missing moneda column
-                    banco = str(row.get('banco', None)) # Handle missing banco column
-
-                )
-                db.add(transaction)
+            inserted, rejects = save_transactions_bulk(transactions_df)
+            print(f"Transacciones migradas: {inserted}, rechazadas: {len(rejects)}")
+            for idx, motivo in rejects:
+                print(f"Fila {idx} de transactions.csv rechazada: {motivo}")
 
         # Add Budget History Migration (requires a budget_history.csv file)
         csv_path = Path("data/budget_history.csv")
@@ -1,12 +1,28 @@
 from datetime import datetime
-from .database import EmailAccount, SessionLocal
+from sqlalchemy.orm import Session
+from .database import EmailAccount, open_session
 from .encryption import encrypt_password, decrypt_password
 
-def save_email_account(email: str, password: str, bank_name: str, user_id: int) -> tuple[bool, str]:
+# Funciones que se llaman con el user_id cada vez que cambian las cuentas de
+# correo de un usuario (p. ej. para invalidar cachés de lectura)
+_account_listeners = []
+
+def on_accounts_changed(callback):
+    """Registra una función a llamar con el user_id tras cada escritura de cuentas de correo"""
+    if callback not in _account_listeners:
+        _account_listeners.append(callback)
+    return callback
+
+def _accounts_changed(user_id: int):
+    """Notifica a los suscriptores que las cuentas del usuario cambiaron"""
+    for callback in _account_listeners:
+        callback(user_id)
+
+def save_email_account(email: str, password: str, bank_name: str, user_id: int, db: Session = None) -> tuple[bool, str]:
     """
     Guarda una nueva cuenta de correo con sus credenciales cifradas.
     """
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         # Verificar si ya existe esta combinación de correo y banco para el usuario
         existing = db.query(EmailAccount).filter(
@@ -31,19 +47,21 @@ def save_email_account(email: str, password: str, bank_name: str, user_id: int)
 
         db.add(account)
         db.commit()
+        _accounts_changed(user_id)
         return True, "Cuenta guardada exitosamente"
 
     except Exception as e:
         db.rollback()
         return False, f"Error guardando la cuenta: {str(e)}"
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def update_email_account(account_id: int, password: str = None, is_active: bool = None) -> tuple[bool, str]:
+def update_email_account(account_id: int, password: str = None, is_active: bool = None, db: Session = None) -> tuple[bool, str]:
     """
     Actualiza una cuenta de correo existente.
     """
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         account = db.query(EmailAccount).filter(EmailAccount.id == account_id).first()
         if not account:
@@ -54,55 +72,113 @@ def update_email_account(account_id: int, password: str = None, is_active: bool
         if is_active is not None:
             account.is_active = is_active
 
+        user_id = account.user_id
         db.commit()
+        _accounts_changed(user_id)
         return True, "Cuenta actualizada exitosamente"
     except Exception as e:
         db.rollback()
         return False, f"Error actualizando la cuenta: {str(e)}"
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def delete_email_account(account_id: int) -> tuple[bool, str]:
+def delete_email_account(account_id: int, db: Session = None) -> tuple[bool, str]:
     """
     Elimina una cuenta de correo.
     """
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         account = db.query(EmailAccount).filter(EmailAccount.id == account_id).first()
         if not account:
             return False, "Cuenta no encontrada"
 
+        user_id = account.user_id
         db.delete(account)
         db.commit()
+        _accounts_changed(user_id)
         return True, "Cuenta eliminada exitosamente"
     except Exception as e:
         db.rollback()
         return False, f"Error eliminando la cuenta: {str(e)}"
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def get_email_accounts(user_id: int):
+def get_email_accounts(user_id: int, db: Session = None):
     """
     Obtiene todas las cuentas de correo configuradas para un usuario.
     """
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         accounts = db.query(EmailAccount).filter(
             EmailAccount.user_id == user_id
         ).all()
         return accounts
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def update_last_sync(account_id: int):
+def get_email_account_summaries(user_id: int, db: Session = None) -> list[dict]:
     """
-    Actualiza la fecha de última sincronización de una cuenta.
+    Obtiene los datos visibles de las cuentas de correo de un usuario, sin la
+    contraseña cifrada, para poder guardarlos en caché.
     """
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
-        account = db.query(EmailAccount).filter(EmailAccount.id == account_id).first()
-        if account:
-            account.last_sync = datetime.now()
-            db.commit()
+        rows = db.query(
+            EmailAccount.id, EmailAccount.email, EmailAccount.bank_name,
+            EmailAccount.is_active, EmailAccount.last_sync,
+            EmailAccount.uid_validity, EmailAccount.last_uid
+        ).filter(
+            EmailAccount.user_id == user_id
+        ).order_by(EmailAccount.id).all()
+        return [dict(row._mapping) for row in rows]
+    finally:
+        if owns_session:
+            db.close()
+
+def get_account_password(account_id: int, user_id: int, db: Session = None) -> str | None:
+    """
+    Descifra la contraseña de una cuenta del usuario en el momento de usarla.
+    Retorna None si la cuenta no existe o no pertenece al usuario.
+    """
+    db, owns_session = open_session(db)
+    try:
+        encrypted_password = db.query(EmailAccount.encrypted_password).filter(
+            EmailAccount.id == account_id,
+            EmailAccount.user_id == user_id
+        ).scalar()
+        return decrypt_password(encrypted_password) if encrypted_password else None
+    finally:
+        if owns_session:
+            db.close()
+
+def update_last_sync(account_id: int, user_id: int, uid_validity: int = None, last_uid: int = None,
+                     db: Session = None) -> bool:
+    """
+    Actualiza la fecha de última sincronización de una cuenta del usuario y
+    su marca de sincronización incremental (UIDVALIDITY y último UID
+    procesado). Retorna False si la cuenta no existe, no pertenece al
+    usuario o no se pudo guardar.
+    """
+    db, owns_session = open_session(db)
+    try:
+        account = db.query(EmailAccount).filter(
+            EmailAccount.id == account_id,
+            EmailAccount.user_id == user_id
+        ).first()
+        if not account:
+            return False
+        account.last_sync = datetime.now()
+        account.uid_validity = uid_validity
+        account.last_uid = last_uid
+        db.commit()
+        _accounts_changed(user_id)
+        return True
+    except Exception:
+        db.rollback()
+        return False
     finally:
-        db.close()
\ No newline at end of file
+        if owns_session:
+            db.close()
\ No newline at end of file
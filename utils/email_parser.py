@@ -3,6 +3,20 @@ from email import policy
 from datetime import datetime
 import re
 
+# Prefijos de pasarelas de pago que anteceden al nombre del comercio (p. ej. OPENPAY*SUSHI POP)
+PAYMENT_PREFIX = re.compile(
+    r'^(?:OPENPAY|IZIPAY|IZI|PAYU|CULQI|NIUBIZ|VISANET|MERPAGO|MERCADOPAGO|PAYPAL|DLC|SQ)\s*\*\s*'
+)
+
+def normalize_merchant(description) -> str:
+    """
+    Normaliza el nombre de un comercio: mayúsculas, sin prefijo de pasarela
+    de pago y con espacios simples. 'OPENPAY*SUSHI POP MIRALIM' -> 'SUSHI POP MIRALIM'
+    """
+    name = ' '.join(str(description or '').upper().split())
+    name = PAYMENT_PREFIX.sub('', name).strip(' *-.')
+    return name or 'SIN COMERCIO'
+
 def parse_email_content(email_content, bank='BCP'):
     """
     Parse email content to extract transaction details.
@@ -77,6 +91,7 @@ def parse_email_content(email_content, bank='BCP'):
                 'fecha': date,
                 'monto': float(amount),  # Asegurar que es float
                 'descripcion': description,  # Limpiar espacios y tags HTML
+                'comercio': normalize_merchant(description),
                 'categoria': 'Sin Categorizar',
                 'moneda': currency,
                 'tipo': 'real'
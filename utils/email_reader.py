@@ -1,15 +1,157 @@
+import base64
 import imaplib
-import email
+import itertools
 import os
+import quopri
+import re
 from datetime import datetime, timedelta
-from email import policy
 from .email_parser import parse_email_content
 
+# Correos por comando FETCH (un viaje de ida y vuelta por lote)
+FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH_SIZE", "50"))
+
+# Inicio de cada mensaje en una respuesta FETCH: b'12 (UID 345 BODY[1] {3456}'
+FETCH_RESPONSE_NUMBER = re.compile(rb'^(\d+) \(')
+
+def message_set(nums) -> str:
+    """
+    Conjunto de mensajes IMAP para los números dados, agrupando los
+    consecutivos en rangos: [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'
+    """
+    values = sorted({int(num) for num in nums})
+    ranges = []
+    for value in values:
+        if ranges and value == ranges[-1][1] + 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return ','.join(str(a) if a == b else f'{a}:{b}' for a, b in ranges)
+
+def parse_imap_list(data: bytes, literal_bytes: bool = False) -> list:
+    """
+    Convierte los valores de una respuesta IMAP en listas de Python:
+    b'("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL 120)' ->
+    [['TEXT', 'PLAIN', ['CHARSET', 'utf-8'], None, '120']]
+    Los literales {n} se leen como cadenas, o como bytes con literal_bytes
+    (contenido de correos, que puede no estar en UTF-8).
+    """
+    stack = [[]]
+    i, n = 0, len(data)
+    while i < n:
+        char = data[i:i + 1]
+        if char == b'(':
+            stack.append([])
+            i += 1
+        elif char == b')':
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+            i += 1
+        elif char == b'"':
+            value = bytearray()
+            i += 1
+            while i < n and data[i:i + 1] != b'"':
+                if data[i:i + 1] == b'\\':
+                    i += 1
+                value += data[i:i + 1]
+                i += 1
+            stack[-1].append(value.decode('utf-8', 'replace'))
+            i += 1
+        elif char == b'{':
+            end = data.index(b'}', i)
+            size, start = int(data[i + 1:end]), end + 1
+            if data[start:start + 2] == b'\r\n':
+                start += 2
+            literal = data[start:start + size]
+            stack[-1].append(literal if literal_bytes else literal.decode('utf-8', 'replace'))
+            i = start + size
+        elif char in (b' ', b'\r', b'\n'):
+            i += 1
+        else:
+            start = i
+            while i < n and data[i:i + 1] not in (b' ', b'(', b')', b'\r', b'\n'):
+                i += 1
+            atom = data[start:i].decode('ascii', 'replace')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    return stack[0]
+
+def split_fetch_items(msg_data, literal_bytes: bool = False) -> list[dict]:
+    """
+    Separa la respuesta de un FETCH de varios mensajes en un diccionario
+    {ítem: valor} por mensaje, p. ej. {'UID': '345', 'BODYSTRUCTURE': [...]}.
+    imaplib entrega cada literal como una tupla (encabezado, bytes); el UID
+    puede llegar en el encabezado o después del literal (b' UID 345)').
+    """
+    chunks = []
+    for item in msg_data or []:
+        part = item[0] + b'\r\n' + item[1] if isinstance(item, tuple) else item
+        if FETCH_RESPONSE_NUMBER.match(part):
+            chunks.append(bytearray(part))
+        elif chunks:
+            chunks[-1] += part
+
+    messages = []
+    for chunk in chunks:
+        values = parse_imap_list(bytes(chunk), literal_bytes)
+        pairs = values[1] if len(values) > 1 and isinstance(values[1], list) else []
+        messages.append({str(pairs[k]).upper(): pairs[k + 1] for k in range(0, len(pairs) - 1, 2)})
+    return messages
+
+def body_parts(structure: list, section: str = ''):
+    """
+    Partes simples de un BODYSTRUCTURE con su número de sección:
+    (sección, tipo/subtipo, parámetros, codificación). En una parte
+    multipart, las subpartes son las listas que preceden al subtipo.
+    """
+    if not structure:
+        return
+    if isinstance(structure[0], list):
+        children = itertools.takewhile(lambda child: isinstance(child, list), structure)
+        for number, child in enumerate(children, 1):
+            yield from body_parts(child, f'{section}.{number}' if section else str(number))
+        return
+    params = structure[2] if len(structure) > 2 and isinstance(structure[2], list) else []
+    yield (
+        section or '1',
+        f'{structure[0]}/{structure[1]}'.lower(),
+        {str(params[k]).lower(): params[k + 1] for k in range(0, len(params) - 1, 2)},
+        str(structure[5] if len(structure) > 5 and structure[5] else '7bit').lower()
+    )
+
+def choose_text_part(structure: list):
+    """Parte text/plain del correo o, si no hay, la text/html"""
+    parts = list(body_parts(structure))
+    for content_type in ('text/plain', 'text/html'):
+        for part in parts:
+            if part[1] == content_type:
+                return part
+    return None
+
+def decode_part(data: bytes, encoding: str, charset: str = None) -> str:
+    """Decodifica el contenido de una parte según su Content-Transfer-Encoding y charset"""
+    if encoding == 'base64':
+        data = base64.b64decode(data)
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(charset or 'utf-8')
+    except (UnicodeDecodeError, LookupError):
+        return data.decode('latin-1')
+
 class EmailReader:
-    def __init__(self, email_user, email_password):
+    def __init__(self, email_user, email_password, batch_size: int = None):
         self.email_user = email_user
         self.email_password = email_password
         self.imap_server = "imap.gmail.com"  # Por defecto Gmail
+        self.batch_size = max(1, batch_size or FETCH_BATCH_SIZE)
+
+        # Marca de sincronización de la última llamada a fetch_notifications
+        self.uid_validity = None
+        self.last_uid = None
+        self.failed_uids = []
 
         # Configuración por banco
         self.bank_configs = {
@@ -49,9 +191,99 @@ class EmailReader:
             else:
                 raise Exception(f"Error al conectar con Gmail: {error_msg}")
 
-    def fetch_notifications(self, days_back=30, bank='BCP'):
+    def _uid_fetch(self, uids, items: str):
+        """UID FETCH de los ítems dados para un lote; si falla, los UID quedan en failed_uids"""
+        try:
+            result, msg_data = self.imap.uid('FETCH', message_set(uids), items)
+        except imaplib.IMAP4.abort:
+            # Conexión perdida: no tiene sentido seguir con los demás lotes
+            raise
+        except imaplib.IMAP4.error as e:
+            print(f"Error obteniendo el lote {message_set(uids)}: {str(e)}")
+            self.failed_uids.extend(int(uid) for uid in uids)
+            return None
+        if result != 'OK':
+            print(f"No se pudo obtener el lote {message_set(uids)}: {result}")
+            self.failed_uids.extend(int(uid) for uid in uids)
+            return None
+        return msg_data
+
+    def fetch_messages(self, uids):
         """
-        Busca y procesa correos de notificaciones del banco especificado
+        Descarga el texto de los correos indicados por UID en lotes de
+        batch_size. Por cada lote pide primero BODYSTRUCTURE y luego solo la
+        parte text/plain (o text/html si no hay) con BODY.PEEK, que no marca
+        los correos como leídos. Retorna (uid, texto) de cada correo; los UID
+        de los lotes cuyo FETCH falló quedan en failed_uids.
+        """
+        for i in range(0, len(uids), self.batch_size):
+            batch = [int(uid) for uid in uids[i:i + self.batch_size]]
+            msg_data = self._uid_fetch(batch, '(BODYSTRUCTURE)')
+            if msg_data is None:
+                continue
+
+            parts = {}
+            for item in split_fetch_items(msg_data):
+                if 'UID' in item and isinstance(item.get('BODYSTRUCTURE'), list):
+                    parts[int(item['UID'])] = choose_text_part(item['BODYSTRUCTURE'])
+
+            # Una consulta por sección: los correos de un mismo banco suelen compartir estructura.
+            # Solo los errores de FETCH quedan en failed_uids; un correo que el servidor
+            # no describe o no entrega (p. ej. eliminado) se da por procesado
+            by_section = {}
+            for uid in batch:
+                if uid not in parts:
+                    print(f"No se pudo obtener la estructura del correo {uid}")
+                elif parts[uid] is None:
+                    print(f"El correo {uid} no tiene partes de texto")
+                else:
+                    by_section.setdefault(parts[uid][0], []).append(uid)
+
+            for section, section_uids in by_section.items():
+                msg_data = self._uid_fetch(section_uids, f'(BODY.PEEK[{section}])')
+                if msg_data is None:
+                    continue
+                # El contenido llega como literal {n}, como cadena entre comillas o NIL
+                bodies = {
+                    int(item['UID']): item.get(f'BODY[{section}]')
+                    for item in split_fetch_items(msg_data, literal_bytes=True) if 'UID' in item
+                }
+                for uid in section_uids:
+                    body = bodies.get(uid)
+                    if isinstance(body, str):
+                        body = body.encode('utf-8')
+                    if not body:
+                        print(f"El correo {uid} no tiene contenido en la sección {section}")
+                        continue
+                    _, _, params, encoding = parts[uid]
+                    yield uid, decode_part(body, encoding, params.get('charset'))
+
+    def _response_code(self, name: str):
+        """Valor numérico de un código de respuesta de SELECT (UIDVALIDITY, UIDNEXT)"""
+        _, data = self.imap.response(name)
+        try:
+            return int(data[-1]) if data and data[-1] is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def _parse_content(self, content: str, bank: str):
+        """Extrae la transacción del texto de un correo"""
+        transaction = parse_email_content(content, bank=bank)
+        if transaction:
+            transaction['tipo'] = 'real'  # Marcar como transacción real
+            if all(key in transaction for key in ['fecha', 'monto', 'descripcion']):
+                print(f"Transacción encontrada y validada: {transaction}")
+                return transaction
+            print(f"Transacción incompleta, falta algún campo requerido: {transaction}")
+        return None
+
+    def fetch_notifications(self, days_back=30, bank='BCP', uid_validity: int = None, last_uid: int = None):
+        """
+        Busca y procesa correos de notificaciones del banco especificado.
+        Con la marca de una sincronización anterior (uid_validity, last_uid)
+        solo busca los correos con UID posterior; si UIDVALIDITY cambió o no
+        hay marca, revisa los últimos days_back días. Al terminar, la nueva
+        marca queda en self.uid_validity y self.last_uid.
         """
         if bank not in self.bank_configs:
             raise ValueError(f"Banco no soportado: {bank}")
@@ -66,71 +298,57 @@ class EmailReader:
 
             self.imap.select('INBOX')
             print("Bandeja INBOX seleccionada")
+            current_validity = self._response_code('UIDVALIDITY')
+            uid_next = self._response_code('UIDNEXT')
+            self.failed_uids = []
 
-            # Calcular la fecha límite
-            since_date = (datetime.now() - timedelta(days=days_back)).strftime("%d-%b-%Y")
-            print(f"Buscando correos desde: {since_date}")
+            incremental = (
+                last_uid is not None and current_validity is not None and current_validity == uid_validity
+            )
+            if incremental:
+                print(f"Sincronización incremental desde UID {last_uid + 1}")
+                search_query = f'UID {last_uid + 1}:* FROM "{bank_config["sender"]}"'
+            else:
+                if uid_validity is not None and current_validity != uid_validity:
+                    print(f"UIDVALIDITY cambió ({uid_validity} -> {current_validity}), se revisa todo el período")
+                # Calcular la fecha límite
+                since_date = (datetime.now() - timedelta(days=days_back)).strftime("%d-%b-%Y")
+                print(f"Buscando correos desde: {since_date}")
+                search_query = f'FROM "{bank_config["sender"]}" SINCE "{since_date}"'
 
-            # Construir query de búsqueda
-            search_query = f'FROM "{bank_config["sender"]}" SINCE "{since_date}"'
             if bank_config['subject_filter']:
                 search_query += f' SUBJECT "{bank_config["subject_filter"]}"'
 
             print(f"Ejecutando búsqueda con query: {search_query}")
-            result, messages = self.imap.search(None, search_query)
+            result, messages = self.imap.uid('SEARCH', None, search_query)
             print(f"Resultado de búsqueda: {result}")
 
-            if result == 'OK' and messages[0]:
-                message_nums = messages[0].split()
-                print(f"Se encontraron {len(message_nums)} correos para procesar")
+            uids = [int(uid) for uid in messages[0].split()] if result == 'OK' and messages[0] else []
+            if incremental:
+                # 'n:*' incluye siempre el último correo aunque su UID sea menor que n
+                uids = [uid for uid in uids if uid > last_uid]
 
-                for num in message_nums:
-                    try:
-                        # Obtener el correo
-                        _, msg_data = self.imap.fetch(num, '(RFC822)')
-                        if not msg_data or not msg_data[0]:
-                            print(f"No se pudo obtener datos del correo {num}")
-                            continue
-
-                        email_body = msg_data[0][1]
-                        email_message = email.message_from_bytes(email_body, policy=policy.default)
-
-                        # Imprimir el asunto para debugging
-                        print(f"Procesando correo con asunto: {email_message['subject']}")
-
-                        # Extraer el contenido del correo
-                        if email_message.is_multipart():
-                            for part in email_message.walk():
-                                if part.get_content_type() == "text/plain":
-                                    try:
-                                        content = part.get_payload(decode=True).decode('utf-8')
-                                    except UnicodeDecodeError:
-                                        content = part.get_payload(decode=True).decode('latin-1')
-
-                                    transaction = parse_email_content(content, bank=bank)
-                                    if transaction:
-                                        transactions.append(transaction)
-                                        print(f"Transacción encontrada: {transaction}")
-                                    break
-                        else:
-                            try:
-                                content = email_message.get_payload(decode=True).decode('utf-8')
-                            except UnicodeDecodeError:
-                                content = email_message.get_payload(decode=True).decode('latin-1')
-
-                            transaction = parse_email_content(content, bank=bank)
-                            if transaction:
-                                transaction['tipo'] = 'real'  # Marcar como transacción real
-                                if all(key in transaction for key in ['fecha', 'monto', 'descripcion']):
-                                    transactions.append(transaction)
-                                    print(f"Transacción encontrada y validada: {transaction}")
-                                else:
-                                    print(f"Transacción incompleta, falta algún campo requerido: {transaction}")
+            if uids:
+                print(f"Se encontraron {len(uids)} correos para procesar")
 
+                for _, content in self.fetch_messages(uids):
+                    try:
+                        transaction = self._parse_content(content, bank)
+                        if transaction:
+                            transactions.append(transaction)
                     except Exception as e:
                         print(f"Error procesando correo individual: {str(e)}")
                         continue
 
+            # Nueva marca: hasta el último UID del buzón, o justo antes del
+            # primer correo que no se pudo descargar
+            previous = last_uid if incremental else 0
+            mark = max([previous, *uids, (uid_next or 1) - 1])
+            if self.failed_uids:
+                mark = max(previous, min(self.failed_uids) - 1)
+            self.uid_validity = current_validity
+            self.last_uid = mark if current_validity is not None and mark else None
+
             return transactions
 
         except Exception as e:
@@ -0,0 +1,164 @@
+"""
+Tipos de cambio y conversión de montos a una moneda de reporte.
+
+Las tasas se guardan en fx_rates como el valor en la moneda base (PEN) de
+una unidad de cada moneda, vigente desde su fecha. Se cargan desde un CSV
+con columnas fecha, moneda, tasa:
+
+    python -m utils.fx import tasas.csv
+"""
+import argparse
+import os
+import threading
+import time
+import traceback
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+from .database import FxRate, engine, open_session
+
+BASE_CURRENCY = "PEN"
+REPORTING_CURRENCY = os.getenv("REPORTING_CURRENCY", BASE_CURRENCY).upper()
+CURRENCY_SYMBOLS = {"PEN": "S/.", "USD": "$"}
+
+# Segundos que se reutilizan las tasas leídas (la tabla es pequeña y cambia poco)
+FX_CACHE_SECONDS = int(os.getenv("FX_CACHE_SECONDS", "600"))
+
+RATE_COLUMNS = ['fecha', 'moneda', 'tasa']
+
+_rates_cache = None  # (leído_en, DataFrame)
+_rates_lock = threading.Lock()
+
+def currency_symbol(moneda: str) -> str:
+    """Símbolo para mostrar montos en la moneda indicada"""
+    return CURRENCY_SYMBOLS.get(moneda, moneda)
+
+def import_fx_rates(path, db: Session = None) -> int:
+    """
+    Carga tipos de cambio desde un CSV (fecha, moneda, tasa). Las filas que
+    ya existen para la misma moneda y fecha se actualizan. Retorna la
+    cantidad de filas leídas.
+    """
+    global _rates_cache
+    df = pd.read_csv(path)
+    missing = set(RATE_COLUMNS) - set(df.columns)
+    if missing:
+        raise ValueError(f"Faltan columnas en {path}: {', '.join(sorted(missing))}")
+
+    df = df[RATE_COLUMNS].dropna()
+    df['fecha'] = pd.to_datetime(df['fecha'])
+    df['moneda'] = df['moneda'].astype(str).str.strip().str.upper()
+    df['tasa'] = df['tasa'].astype(float)
+    if (df['tasa'] <= 0).any():
+        raise ValueError("Las tasas deben ser positivas")
+    df = df.drop_duplicates(['moneda', 'fecha'], keep='last')
+    rows = [
+        {'fecha': fecha.to_pydatetime(), 'moneda': moneda, 'tasa': tasa}
+        for fecha, moneda, tasa in df.itertuples(index=False)
+    ]
+    if not rows:
+        return 0
+
+    table = FxRate.__table__
+    dialect_insert = pg_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+    stmt = dialect_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.moneda, table.c.fecha],
+        set_={'tasa': stmt.excluded.tasa}
+    )
+
+    db, owns_session = open_session(db)
+    try:
+        db.execute(stmt, rows)
+        db.commit()
+        with _rates_lock:
+            _rates_cache = None
+        print(f"Tipos de cambio cargados: {len(rows)} filas")
+        return len(rows)
+    except Exception as e:
+        print(f"Error cargando tipos de cambio: {str(e)}")
+        print(traceback.format_exc())
+        db.rollback()
+        raise
+    finally:
+        if owns_session:
+            db.close()
+
+def load_fx_rates(db: Session = None) -> pd.DataFrame:
+    """Tasas ordenadas por fecha (columnas fecha, moneda, tasa)"""
+    global _rates_cache
+    cached = _rates_cache
+    if cached is not None and time.monotonic() - cached[0] < FX_CACHE_SECONDS:
+        return cached[1]
+
+    db, owns_session = open_session(db)
+    try:
+        stmt = select(FxRate.fecha, FxRate.moneda, FxRate.tasa).order_by(FxRate.fecha, FxRate.moneda)
+        rates = pd.DataFrame(db.execute(stmt).all(), columns=RATE_COLUMNS)
+        rates['fecha'] = pd.to_datetime(rates['fecha']).astype('datetime64[ns]')
+        rates['moneda'] = rates['moneda'].astype(str)
+        rates['tasa'] = rates['tasa'].astype(float)
+        with _rates_lock:
+            _rates_cache = (time.monotonic(), rates)
+        return rates
+    finally:
+        if owns_session:
+            db.close()
+
+def available_currencies(rates: pd.DataFrame = None, db: Session = None) -> list[str]:
+    """Monedas a las que se puede convertir: la base y las que tienen tasas"""
+    if rates is None:
+        rates = load_fx_rates(db=db)
+    return [BASE_CURRENCY] + sorted(set(rates['moneda']) - {BASE_CURRENCY})
+
+def _rates_at(fechas: pd.Series, monedas, rates: pd.DataFrame) -> np.ndarray:
+    """
+    Tasa vigente de cada (fecha, moneda) con un único merge_asof sobre todas
+    las filas. Antes de la primera tasa de una moneda se usa la más antigua;
+    las monedas sin tasas quedan en NaN.
+    """
+    left = pd.DataFrame({
+        'fecha': pd.to_datetime(fechas).to_numpy().astype('datetime64[ns]'),
+        'moneda': pd.Series(np.asarray(monedas, dtype=object)).astype(str),
+        'posicion': np.arange(len(fechas))
+    }).sort_values('fecha', kind='stable')
+    matched = pd.merge_asof(left, rates, on='fecha', by='moneda', direction='backward')
+    earliest = rates.groupby('moneda')['tasa'].first()
+    tasa = matched['tasa'].fillna(matched['moneda'].map(earliest))
+    tasa = tasa.mask(matched['moneda'] == BASE_CURRENCY, 1.0)
+
+    result = np.empty(len(left))
+    result[matched['posicion'].to_numpy()] = tasa.to_numpy(dtype=float)
+    return result
+
+def convert_amounts(df: pd.DataFrame, moneda: str = REPORTING_CURRENCY, rates: pd.DataFrame = None,
+                    fecha_column: str = 'fecha', db: Session = None) -> pd.Series:
+    """
+    Convierte la columna monto de cada fila desde su moneda a la moneda de
+    reporte, con el tipo de cambio vigente en su fecha. Las filas sin tipo de
+    cambio disponible quedan en NaN.
+    """
+    if df.empty:
+        return pd.Series(dtype=float, index=df.index)
+    if rates is None:
+        rates = load_fx_rates(db=db)
+
+    monedas = df['moneda'].astype(object).fillna(BASE_CURRENCY).to_numpy()
+    fechas = df[fecha_column]
+    # Tasa de la moneda de cada fila y de la moneda de reporte, a la misma fecha
+    source = _rates_at(fechas, monedas, rates)
+    target = _rates_at(fechas, np.full(len(df), moneda, dtype=object), rates)
+    return pd.Series(df['monto'].to_numpy(dtype=float) * source / target, index=df.index)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tipos de cambio para la moneda de reporte")
+    parser.add_argument("command", choices=["import"], help="import: carga tasas desde un CSV (fecha, moneda, tasa)")
+    parser.add_argument("path", help="Ruta del archivo CSV")
+    args = parser.parse_args()
+    if args.command == "import":
+        from .database import init_db
+        init_db()
+        import_fx_rates(args.path)
@@ -4,7 +4,8 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
-from .database import User, SessionLocal
+from sqlalchemy.orm import Session
+from .database import User, open_session
 from werkzeug.security import generate_password_hash
 
 def generate_reset_token():
@@ -95,10 +96,10 @@ def send_reset_email(email: str, reset_token: str) -> tuple[bool, str]:
         print(f"Error enviando correo: {str(e)}")
         return False, f"Error al enviar el correo: {str(e)}"
 
-def initiate_password_reset(email: str) -> tuple[bool, str]:
+def initiate_password_reset(email: str, db: Session = None) -> tuple[bool, str]:
     """Inicia el proceso de recuperación de contraseña"""
     print(f"\n=== Iniciando recuperación de contraseña para: {email} ===")
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         user = db.query(User).filter(User.email == email).first()
         if not user:
@@ -127,11 +128,12 @@ def initiate_password_reset(email: str) -> tuple[bool, str]:
         db.rollback()
         return False, f"Error en el proceso de recuperación: {str(e)}"
     finally:
-        db.close()
+        if owns_session:
+            db.close()
 
-def reset_password(token: str, new_password: str) -> tuple[bool, str]:
+def reset_password(token: str, new_password: str, db: Session = None) -> tuple[bool, str]:
     """Restablece la contraseña usando el token"""
-    db = SessionLocal()
+    db, owns_session = open_session(db)
     try:
         user = db.query(User).filter(
             User.reset_token == token,
@@ -153,4 +155,5 @@ def reset_password(token: str, new_password: str) -> tuple[bool, str]:
         db.rollback()
         return False, f"Error al restablecer la contraseña: {str(e)}"
     finally:
-        db.close()
\ No newline at end of file
+        if owns_session:
+            db.close()
\ No newline at end of file